@@ -1,7 +1,9 @@
 import re
+import sys
 import logging
+import threading
 
-from django.db import models,transaction
+from django.db import models,transaction,connection
 from django.dispatch import receiver
 from django.utils import timezone
 from django.db.models.signals import pre_save, pre_delete,post_save,post_delete
@@ -28,13 +30,56 @@ class Application(models.Model,SignalEnable):
 
     def delete(self,using=None):
         logger.info('Delete {0}:{1}'.format(type(self),self.name))
-        with transaction.atomic():
+        with ApplicationsBatch():
             super(Application,self).delete(using)
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         with transaction.atomic():
             super(Application,self).save(force_insert,force_update,using,update_fields)
 
+    def set_layers(self,layers):
+        """
+        Replace the layers of the application in bulk.
+        layers: the ordered list of publishs and wms layers; the order of a layer is its position in the list, starting from 1
+        The applications property of each affected publish and wms layer is updated only once.
+        """
+        with ApplicationsBatch() as batch:
+            existing_layers = list(Application_Layers.objects.filter(application=self))
+            publishs = dict([(o.publish_id,o) for o in existing_layers if o.publish_id])
+            wmslayers = dict([(o.wmslayer_id,o) for o in existing_layers if o.wmslayer_id])
+            kept_layers = set()
+            new_layers = []
+            order = 0
+            for layer in layers:
+                order += 1
+                if isinstance(layer,Publish):
+                    o = publishs.get(layer.pk)
+                elif isinstance(layer,WmsLayer):
+                    o = wmslayers.get(layer.pk)
+                else:
+                    raise ValidationError("Must be either publish or wmslayer.")
+
+                if not o:
+                    o = Application_Layers(application=self,order=order)
+                    if isinstance(layer,Publish):
+                        o.publish = layer
+                    else:
+                        o.wmslayer = layer
+                    new_layers.append(o)
+                else:
+                    kept_layers.add(o.pk)
+                    if o.order != order:
+                        Application_Layers.objects.filter(pk=o.pk).update(order=order)
+                batch.changed(o)
+
+            removed_layers = [o for o in existing_layers if o.pk not in kept_layers]
+            if removed_layers:
+                Application_Layers.objects.filter(pk__in=[o.pk for o in removed_layers]).delete()
+            if new_layers:
+                Application_Layers.objects.bulk_create(new_layers)
+            for o in removed_layers:
+                batch.changed(o)
+
     def __str__(self):
         return self.name
 
@@ -48,7 +93,7 @@ class Application_Layers(models.Model,SignalEnable):
     order = models.PositiveIntegerField(blank=False,null=False)
 
     def delete(self,using=None):
-        with transaction.atomic():
+        with ApplicationsBatch():
             super(Application_Layers,self).delete(using)
 
     def clean(self):
@@ -75,7 +120,7 @@ class Application_Layers(models.Model,SignalEnable):
                 raise ValidationError("No changes.")
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        with transaction.atomic():
+        with ApplicationsBatch():
             super(Application_Layers,self).save(force_insert,force_update,using,update_fields)
 
     def __str__(self):
@@ -86,46 +131,113 @@ class Application_Layers(models.Model,SignalEnable):
         verbose_name = "Application's Layer"
 
 
+class ApplicationsBatch(object):
+    """
+    A transaction which updates the applications property of the affected publishs and wms layers only once.
+
+    All the changes of Application_Layers in the batch should be done in the with block;
+    the affected publishs and wms layers are collected by the signals or by changed(),
+    and their applications property is recomputed from the database by a few aggregate queries before the transaction is committed.
+    Batches can be nested, the outermost batch does the update.
+    """
+    _local = threading.local()
+
+    _applications_sql = "COALESCE((SELECT string_agg(a.name || ':' || l.\"order\", ',' ORDER BY a.name) FROM \"{0}\" l JOIN \"{1}\" a ON l.application_id = a.id WHERE l.{2} = t.id),'')"
+
+    _update_publish_applications_sql = """
+UPDATE "{0}" AS p SET applications = s.applications, last_modify_time = %s, pending_actions = NULLIF(COALESCE(p.pending_actions,0) | %s,0)
+FROM (SELECT t.id, {1} AS applications FROM "{0}" t WHERE t.id = ANY(%s)) AS s
+WHERE p.id = s.id AND p.applications IS DISTINCT FROM s.applications
+"""
+
+    _query_wmslayer_applications_sql = "SELECT t.id, {1} FROM \"{0}\" t WHERE t.id = ANY(%s)"
+
+    def __enter__(self):
+        self._atomic = transaction.atomic()
+        self._atomic.__enter__()
+        if not hasattr(self._local,"depth"):
+            self._local.depth = 0
+            self._local.publishs = set()
+            self._local.wmslayers = set()
+        self._local.depth += 1
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self._local.depth -= 1
+        try:
+            if self._local.depth == 0:
+                publishs,wmslayers = self._local.publishs,self._local.wmslayers
+                del self._local.depth
+                del self._local.publishs
+                del self._local.wmslayers
+                if exc_type is None:
+                    ApplicationsBatch.update(publishs,wmslayers)
+        except:
+            if exc_type is None:
+                self._atomic.__exit__(*sys.exc_info())
+                raise
+        return self._atomic.__exit__(exc_type,exc_value,traceback)
+
+    @classmethod
+    def in_batch(cls):
+        return getattr(cls._local,"depth",0) > 0
+
+    @classmethod
+    def changed(cls,instance):
+        """
+        declare the publish or wms layer of the Application_Layers object is affected
+        """
+        if instance.publish_id:
+            cls._local.publishs.add(instance.publish_id)
+        elif instance.wmslayer_id:
+            cls._local.wmslayers.add(instance.wmslayer_id)
+
+    @classmethod
+    def update(cls,publishs,wmslayers):
+        """
+        recompute the applications property of the publishs and wms layers
+        """
+        if publishs:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(cls._update_publish_applications_sql.format(
+                    Publish._meta.db_table,
+                    cls._applications_sql.format(Application_Layers._meta.db_table,Application._meta.db_table,"publish_id")
+                ),[timezone.now(),PublishAction().column_changed("applications").actions or 0,list(publishs)])
+            finally:
+                cursor.close()
+
+        if wmslayers:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(cls._query_wmslayer_applications_sql.format(
+                    WmsLayer._meta.db_table,
+                    cls._applications_sql.format(Application_Layers._meta.db_table,Application._meta.db_table,"wmslayer_id")
+                ),[list(wmslayers)])
+                applications = dict(cursor.fetchall())
+            finally:
+                cursor.close()
+
+            #save the changed wms layers one by one, changing the status may require publishing the layer
+            for wmslayer in WmsLayer.objects.filter(pk__in=applications.keys()):
+                if wmslayer.applications != applications[wmslayer.pk]:
+                    wmslayer.applications = applications[wmslayer.pk]
+                    wmslayer.last_modify_time = timezone.now()
+                    wmslayer.status = wmslayer.next_status(ResourceStatus.UPDATE)
+                    wmslayer.save(update_fields=["status","applications","last_modify_time"])
+
 class Application_LayersEventListener(object):
     @staticmethod
-    def _update_applications(instance,editing_instance=None):
+    def _update_applications(instance):
         """
-        update the applications property of instance's publish or wms layer
-        param instance: the instance stored in db.
-        param editing_instance: the instance in the memory, it is null for deleting and post save.
+        declare the publish or wms layer of the instance is affected,
+        and update the applications property immediately if not in a batch.
         """
-        if instance.publish:
-            if editing_instance and editing_instance.publish == instance.publish:
-                #publish is not changed.
-                pass
-            else:
-                #publish is changed.
-                q = Application_Layers.objects.filter(publish=instance.publish)
-                if editing_instance and editing_instance.pk:
-                    q = q.exclude(pk = editing_instance.pk)
-                q = q.order_by("application__name")
-                applications = ",".join(["{0}:{1}".format(o.application,o.order) for o in q])
-                if instance.publish.applications != applications:
-                    instance.publish.applications = applications
-                    instance.publish.last_modify_time = timezone.now()
-                    instance.publish.pending_actions = PublishAction(instance.publish.pending_actions).column_changed("applications").actions
-                    instance.publish.save(update_fields=["applications","last_modify_time","pending_actions"])
-        
-        elif instance.wmslayer:
-            if editing_instance and editing_instance.wmslayer == instance.wmslayer:
-                #wmslayer not changed.
-                pass
-            else:
-                q = Application_Layers.objects.filter(wmslayer=instance.wmslayer)
-                if editing_instance and editing_instance.pk:
-                    q = q.exclude(pk = editing_instance.pk)
-                q = q.order_by("application__name")
-                applications = ",".join(["{0}:{1}".format(o.application,o.order) for o in q])
-                if instance.wmslayer.applications != applications:
-                    instance.wmslayer.applications = applications
-                    instance.wmslayer.last_modify_time = timezone.now()
-                    instance.wmslayer.status = instance.wmslayer.next_status(ResourceStatus.UPDATE)
-                    instance.wmslayer.save(update_fields=["status","applications","last_modify_time"])
+        if ApplicationsBatch.in_batch():
+            ApplicationsBatch.changed(instance)
+        else:
+            with ApplicationsBatch() as batch:
+                batch.changed(instance)
 
     @staticmethod
     @receiver(post_delete, sender=Application_Layers)
@@ -135,13 +247,14 @@ class Application_LayersEventListener(object):
     @staticmethod
     @receiver(pre_save, sender=Application_Layers)
     def _pre_save(sender, instance, **args):
-        if instance.pk:
-            existed_instance = Application_Layers.objects.get(pk = instance.pk)
-            Application_LayersEventListener._update_applications(existed_instance,instance)
+        if instance.pk and ApplicationsBatch.in_batch():
+            #the previous publish or wms layer is also affected
+            existed_instance = Application_Layers.objects.filter(pk = instance.pk).first()
+            if existed_instance:
+                ApplicationsBatch.changed(existed_instance)
 
     @staticmethod
     @receiver(post_save, sender=Application_Layers)
     def _post_save(sender, instance, **args):
         Application_LayersEventListener._update_applications(instance)
         
-
@@ -4,7 +4,7 @@ import os
 import logging
 import traceback
 import time
-from datetime import timedelta
+from datetime import timedelta,datetime
 import requests
 
 from restless.dj import DjangoResource
@@ -34,6 +34,7 @@ from livelayermanager.models import SqlViewLayer as LiveSqlViewLayer
 
 from borg_utils.hg_batch_push import try_set_push_owner, try_clear_push_owner, try_push_to_repository
 from borg_utils.jobintervals import JobInterval
+from borg_utils.catalogue import CatalogueClient
 from borg_utils.borg_config import BorgConfiguration
 from borg_utils.resource_status import ResourceStatus,ResourceAction
 from harvest.jobstates import Completed
@@ -135,6 +136,45 @@ class MetadataApi(DjangoResource,BasicHttpAuthMixin):
         return[
             url(r'^metajobs/$',MetadataApi.as_list(),name='publish_meta'),
         ]
+
+    @staticmethod
+    def _upload_catalogue_records(layers):
+        """
+        upload the changed meta data of the publishs to catalogue service together
+        return a tuple (a dict between layer and the uploaded record, the set of unchanged layers);
+        the failed layers are uploaded again one by one later.
+        """
+        candidates = []
+        for layer in layers:
+            try:
+                workspace,name = layer.split(":")
+                pub = Publish.objects.get(workspace__name=workspace,name=name)
+                pub.check_publish_meta_data()
+                candidates.append((layer,pub))
+            except:
+                continue
+
+        #get the records of the publishs which have a meta data fingerprint concurrently, to check whether the meta data is changed
+        checked = [(layer,pub) for layer,pub in candidates if pub.meta_fingerprint and pub.workspace.publish_channel.sync_geoserver_data]
+        records = dict(zip([layer for layer,pub in checked],CatalogueClient.instance().get_records([(pub.workspace.name,pub.table_name) for layer,pub in checked],style_content=True)))
+
+        publication_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        publishs = []
+        meta_datas = []
+        unchanged = set()
+        for layer,pub in candidates:
+            try:
+                if pub.check_meta_data_changed(records.get(layer)):
+                    #the failed publishs are left out, and published one by one later
+                    meta_datas.append(pub.catalogue_metadata({"publication_date":publication_date}))
+                    publishs.append(layer)
+                else:
+                    unchanged.add(layer)
+            except:
+                continue
+
+        records = CatalogueClient.instance().update_records(meta_datas,style_content=True)
+        return (dict([(layer,record) for layer,record in zip(publishs,records) if not isinstance(record,Exception)]),unchanged)
      
     @skip_prepare
     def create(self):
@@ -142,6 +182,7 @@ class MetadataApi(DjangoResource,BasicHttpAuthMixin):
         result = None
         try_set_push_owner("meta_resource")
         try:
+            catalogue_records,unchanged_layers = self._upload_catalogue_records(self.data.get('layers') or [])
             for layer in self.data.get('layers') or []:
                 workspace,name = layer.split(":")
                 resp[layer] = {}
@@ -159,7 +200,12 @@ class MetadataApi(DjangoResource,BasicHttpAuthMixin):
                         #try to locate it from publishs, and publish the meta data if found
                         pub = Publish.objects.get(workspace__in=workspaces,name=name)
                         try:
-                            pub.publish_meta_data()
+                            if layer in unchanged_layers:
+                                pub.publish_meta_data(changed=False)
+                                resp[layer]["status"] = True
+                                resp[layer]["message"] = "Not changed."
+                                continue
+                            pub.publish_meta_data(catalogue_record=catalogue_records.get(layer),changed=True)
                             resp[layer]["status"] = True
                             resp[layer]["message"] = "Succeed."
                             continue
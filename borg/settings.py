@@ -173,6 +173,7 @@ HARVEST_CONFIG = {
     "PUBLISH_SCHEMA" : "publish",
     "PUBLISH_VIEW_SCHEMA" : "publish_view",
     "FULL_DATA_DUMP_DIR" : os.path.abspath(os.path.join(DOWNLOAD_ROOT, "full_data")),
+    "CONTENT_STORE_DIR" : os.path.abspath(os.path.join(DOWNLOAD_ROOT, "full_data", "_store")), #the content addressed store of the dump files, style files and meta files
     "STYLE_FILE_DUMP_DIR" : os.path.abspath(os.path.join(DOWNLOAD_ROOT, "style_file")),
     "WMS_LAYER_DIR" : os.path.abspath(os.path.join(DOWNLOAD_ROOT, "wms_layer")),
     "LIVE_LAYER_DIR" : os.path.abspath(os.path.join(DOWNLOAD_ROOT, "live_layer")),
@@ -180,10 +181,50 @@ HARVEST_CONFIG = {
     "LIVE_STORE_DIR" : os.path.abspath(os.path.join(DOWNLOAD_ROOT, "live_store")),
     "UNPUBLISH_DIR" : os.path.abspath(os.path.join(DOWNLOAD_ROOT, "unpublish")),
     "PREVIEW_DIR" : os.path.abspath(PREVIEW_ROOT),
+    "OGRINFO_CACHE_DIR" : os.path.abspath(os.environ.get("OGRINFO_CACHE_DIR") or os.path.join(BASE_DIR, "ogrinfo_cache")), #the folder to cache the ogrinfo and gdalsrsinfo output of the file based data sources
+    "OGRINFO_CACHE_EXPIRE_DAYS" : int(os.environ.get("OGRINFO_CACHE_EXPIRE_DAYS") or 30), #the cached outputs not used in the last N days are removed when the harvest jobs are cleaned; 0 never removes the cached outputs
+    "OGR_BACKEND" : os.environ.get("OGR_BACKEND") or "auto", #"bindings" to use the GDAL python bindings, "subprocess" to run ogrinfo and gdalsrsinfo; "auto" uses the bindings if available
     "WORKSPACE_AS_SCHEMA" : True,
     "MAX_TEST_IMPORT_TIME" : 5, #seconds
     "RETRY_INTERVAL" : 300, #seconds
     "IMPORT_CANCEL_TIME" : 60, #seconds
+    "IMPORT_LOADER" : os.environ.get("IMPORT_LOADER") or "ogr2ogr", #"copy" to stream the features into the harvest DB through COPY, requires the GDAL python bindings
+    "IMPORT_BATCH_SIZE" : int(os.environ.get("IMPORT_BATCH_SIZE") or 20000), #the number of features loaded in one COPY command
+    "UNION_IMPORT_CONCURRENCY" : int(os.environ.get("UNION_IMPORT_CONCURRENCY") or 4), #the number of member layers of a union layer imported in parallel; 1 imports the union layer with one ogr2ogr process
+    "IMPORT_STAGING" : (os.environ.get("IMPORT_STAGING") or "false").lower() in ("true","yes","on"), #import into a staging table and replace the input table with it after the rowid is populated
+    "IMPORT_STAGING_UNLOGGED" : (os.environ.get("IMPORT_STAGING_UNLOGGED") or "false").lower() in ("true","yes","on"), #keep the staged input table unlogged to avoid writing the imported data into WAL; postgres empties unlogged tables after a crash, and the emptied input tables are imported again by the next harvest
+    "ROWID_HASH" : os.environ.get("ROWID_HASH") or "md5", #the hash function used to generate the rowid of input table; "hashtextextended" is faster but requires postgresql 11 or later
+    "BBOX_MODE" : (os.environ.get("BBOX_MODE") or "exact").lower(), #how to get the bbox of a spatial column: "exact" scans the table, "estimated" uses the planner statistics, "incremental" extends the previous bbox with the inserted rows of a differential publish
+    "DIFF_PUBLISH" : (os.environ.get("DIFF_PUBLISH") or "false").lower() in ("true","yes","on"), #only apply the inserted and deleted rows to the publish table if its structure is not changed
+    "PUBLISH_DIFF_HISTORY" : 10, #the number of diffs kept in the diff table of a publish
+    "SOURCE_HASH_COLUMN" : "_source_md5", #the column to store the row hash value of the incrementally imported foreign table
+    "FINGERPRINT_CHUNK_SIZE" : 100000, #the key range of a chunk when computing the fingerprint of a foreign table
+    "FINGERPRINT_MAX_CHUNKS" : 1000, #the chunk size is doubled until the number of chunks is not greater than this value
+    "FINGERPRINT_CONCURRENCY" : int(os.environ.get("FINGERPRINT_CONCURRENCY") or 4), #the number of connections used to compute the fingerprint of a foreign table
+    "DUMP_COMPRESSION" : os.environ.get("DUMP_COMPRESSION") or "1", #the compression of the full data dump, a gzip level or a compression method with optional level, e.g. "zstd:3"
+    "DUMP_SKIP_UNCHANGED" : (os.environ.get("DUMP_SKIP_UNCHANGED") or "true").lower() in ("true","yes","on"), #reuse the dump file of the previous job if the table content is not changed
+    "DUMP_REUSE_LOOKBACK" : 5, #the number of previous jobs checked for a reusable dump file
+    "CONTENT_STORE" : (os.environ.get("CONTENT_STORE") or "true").lower() in ("true","yes","on"), #store the files of the harvest jobs in the content addressed store
+    "CONTENT_STORE_GRACE_HOURS" : 24, #the unreferenced objects in content store are only removed after this period
+    "DEPENDENCY_GRAPH_CHECK_INTERVAL" : 2, #the cached dependency graph of publishs and normalises is checked against the database at most once in this number of seconds
+    "REALTIME_CHECK_CONCURRENCY" : int(os.environ.get("REALTIME_CHECK_CONCURRENCY") or 4), #the number of threads to check whether the inputs of realtime publishs are up to date
+    "DS_WATCH_MODE" : (os.environ.get("DS_WATCH_MODE") or "auto").lower(), #how to detect the changes of file based datasources, "inotify", "poll" or "auto"(inotify if pyinotify is installed)
+    "DS_CHECK_INTERVAL" : os.environ.get("DS_CHECK_INTERVAL") or "Hourly", #the job interval of checking all file based datasources
+    "DS_STAT_CONCURRENCY" : int(os.environ.get("DS_STAT_CONCURRENCY") or 8), #the number of threads to get the modify time of the datasources
+    "DS_CREATE_JOBS" : (os.environ.get("DS_CREATE_JOBS") or "true").lower() in ("true","yes","on"), #create jobs for the triggered and realtime publishs once their datasources are changed
+    "DS_WATCH_DELAY" : 5, #the changed datasources detected by inotify are harvested together after this number of seconds
+    "DS_WATCH_RELOAD_INTERVAL" : 60, #reload the file based inputs to watch the new datasources in this number of seconds
+    "DDL_CACHE_SIZE" : 1000, #the number of create table sqls cached in each process, the cached sql is reused until the table structure is changed
+    "PLAN_BATCH_JOBS" : (os.environ.get("PLAN_BATCH_JOBS") or "true").lower() in ("true","yes","on"), #execute the inputs and normalises shared by the jobs of a batch only once before running the jobs
+    "MAX_CONCURRENT_JOBS" : int(os.environ.get("MAX_CONCURRENT_JOBS") or 1), #the number of worker processes used to run harvest jobs
+    "STATE_COMMIT_BATCH_SIZE" : int(os.environ.get("STATE_COMMIT_BATCH_SIZE") or 50), #the maximum number of queued changes committed as one changeset to the state repository
+    "STATE_PUSH_DELAY" : int(os.environ.get("STATE_PUSH_DELAY") or 10), #push the changes to the state repository after no push is requested in this number of seconds
+    "STATE_PUSH_MAX_DELAY" : int(os.environ.get("STATE_PUSH_MAX_DELAY") or 60), #the maximum number of seconds a requested push can be delayed
+    "CSW_TIMEOUT" : int(os.environ.get("CSW_TIMEOUT") or 60), #the timeout in seconds of a request to catalogue service
+    "CSW_RETRIES" : int(os.environ.get("CSW_RETRIES") or 3), #the number of retries of a failed request to catalogue service
+    "CSW_RETRY_BACKOFF" : 0.5, #the backoff factor between the retries of a failed request to catalogue service
+    "CSW_CONCURRENCY" : int(os.environ.get("CSW_CONCURRENCY") or 4), #the number of concurrent requests to catalogue service
+    "CSW_BULK_PATH" : os.environ.get("CSW_BULK_PATH") or None, #the path of the bulk endpoint of catalogue service to upload a list of records in one request; upload the records concurrently if not configured
     "BORG_STATE_REPOSITORY" : os.environ.get("BORG_STATE_REPOSITORY", os.path.join(BASE_DIR, "borgcollector-state")),
     "BORG_STATE_USER": os.environ.get("BORG_STATE_USER", "borgcollector"),
     "BORG_STATE_SSH": "ssh -i " + os.environ.get("BORG_STATE_SSH", "~/.ssh/id_rsa"),
@@ -0,0 +1,140 @@
+import os
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from django.conf import settings
+
+from borg_utils.borg_config import BorgConfiguration
+
+logger = logging.getLogger(__name__)
+
+class CatalogueClient(object):
+    """
+    The client of the catalogue service.
+
+    All requests of the process are sent through one session, so the connections to the catalogue service are reused;
+    the requests are retried with exponential backoff if failed with connection error or server busy,
+    and each request is timed out after CSW_TIMEOUT seconds.
+    If CSW_BULK_PATH is configured, a list of records is uploaded in one request to the bulk endpoint;
+    otherwise the records are uploaded concurrently.
+    """
+    RECORDS_PATH = "/catalogue/api/records/"
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance._pid != os.getpid():
+                cls._instance = CatalogueClient()
+            return cls._instance
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.auth = (settings.CSW_USER,settings.CSW_PASSWORD)
+        #records are created or updated by their identifier, retry the post requests too
+        retry = Retry(total=BorgConfiguration.CSW_RETRIES,backoff_factor=BorgConfiguration.CSW_RETRY_BACKOFF,status_forcelist=[502,503,504],method_whitelist=False)
+        adapter = HTTPAdapter(pool_connections=1,pool_maxsize=BorgConfiguration.CSW_CONCURRENCY,max_retries=retry)
+        self.session.mount("http://",adapter)
+        self.session.mount("https://",adapter)
+
+    @staticmethod
+    def _check(res):
+        if 400 <= res.status_code < 600 and res.content:
+            res.reason = "{}({})".format(res.reason,res.content)
+        res.raise_for_status()
+
+    def _url(self,path,style_content=False):
+        return "{}{}{}".format(settings.CSW_URL,path,"?style_content=true" if style_content else "")
+
+    def update_record(self,meta_data,style_content=False):
+        """
+        create or update the record, return the record returned by catalogue service
+        """
+        res = self.session.post(self._url(self.RECORDS_PATH,style_content),json=meta_data,timeout=BorgConfiguration.CSW_TIMEOUT)
+        self._check(res)
+        return res.json()
+
+    def get_record(self,workspace,name,style_content=False):
+        """
+        return the record, in the same format as the record returned by update_record; return None if the record does not exist
+        """
+        res = self.session.get(self._url("{}{}:{}/".format(self.RECORDS_PATH,workspace,name),style_content),timeout=BorgConfiguration.CSW_TIMEOUT)
+        if res.status_code == 404:
+            return None
+        self._check(res)
+        return res.json()
+
+    def get_records(self,keys,style_content=False):
+        """
+        get a list of records concurrently
+        keys: the list of (workspace,name)
+        return the list of records in the same order; the item is None if the record does not exist, or the exception if failed to get the record
+        """
+        def _get(key):
+            try:
+                return self.get_record(key[0],key[1],style_content)
+            except Exception as e:
+                logger.error("Failed to get the record({0}:{1}) from catalogue service.".format(*key),exc_info=True)
+                return e
+
+        if len(keys) <= 1:
+            return [_get(key) for key in keys]
+        return self.pool.map(_get,keys)
+
+    def delete_record(self,workspace,name):
+        """
+        delete the record, ignore if the record does not exist
+        """
+        res = self.session.delete(self._url("{}{}:{}/".format(self.RECORDS_PATH,workspace,name)),timeout=BorgConfiguration.CSW_TIMEOUT)
+        if res.status_code != 404:
+            self._check(res)
+
+    @property
+    def pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(BorgConfiguration.CSW_CONCURRENCY)
+            return self._pool
+
+    def update_record_async(self,meta_data,style_content=False):
+        """
+        create or update the record in a background thread, return a AsyncResult whose get() returns the record or raise the exception
+        """
+        return self.pool.apply_async(self.update_record,(meta_data,style_content))
+
+    def update_records(self,meta_datas,style_content=False):
+        """
+        create or update a list of records
+        return the list of records returned by catalogue service, in the same order; the item is the exception if the record is failed to upload
+        """
+        if not meta_datas:
+            return []
+        if BorgConfiguration.CSW_BULK_PATH:
+            try:
+                res = self.session.post(self._url(BorgConfiguration.CSW_BULK_PATH,style_content),json=meta_datas,timeout=BorgConfiguration.CSW_TIMEOUT * len(meta_datas))
+                self._check(res)
+                return res.json()
+            except Exception as e:
+                logger.error("Failed to upload {0} records to catalogue service in bulk.".format(len(meta_datas)),exc_info=True)
+                return [e] * len(meta_datas)
+
+        def _update(meta_data):
+            try:
+                return self.update_record(meta_data,style_content)
+            except Exception as e:
+                logger.error("Failed to upload the record to catalogue service.",exc_info=True)
+                return e
+
+        if len(meta_datas) == 1:
+            return [_update(meta_datas[0])]
+        return self.pool.map(_update,meta_datas)
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+from collections import Counter
+
+from borg_utils.borg_config import BorgConfiguration
+from borg_utils.utils import file_md5
+
+logger = logging.getLogger(__name__)
+
+class ContentStore(object):
+    """
+    A content addressed file store.
+
+    A file is stored as "<store dir>/<md5[0:2]>/<md5>.<extension>", the same content is stored only once.
+    The objects used by a job are listed in the job's manifest file, which is a json list of object names
+    and removed together with the other files of the job;
+    an object is garbage if it is not referenced by any manifest file and not touched during the grace period.
+    """
+    MANIFEST_SUFFIX = ".manifest.json"
+
+    def __init__(self,root=None,manifest_root=None):
+        self.root = root or BorgConfiguration.CONTENT_STORE_DIR
+        self.manifest_root = manifest_root or BorgConfiguration.FULL_DATA_DUMP_DIR
+
+    @staticmethod
+    def is_enabled():
+        return bool(BorgConfiguration.CONTENT_STORE)
+
+    def object_name(self,md5,extension):
+        return os.path.join(md5[0:2],"{0}.{1}".format(md5,extension))
+
+    def object_path(self,name):
+        return os.path.join(self.root,name)
+
+    def name_of(self,path):
+        """
+        return the object name of the file path; return None if the file is not in the store
+        """
+        path = os.path.abspath(path)
+        if not path.startswith(os.path.join(self.root,"")):
+            return None
+        return os.path.relpath(path,self.root)
+
+    def put(self,path,extension,manifest,md5=None):
+        """
+        Move the file into the store and reference it from the manifest file.
+        Return (the object path,md5)
+        """
+        md5 = md5 or file_md5(path)
+        name = self.object_name(md5,extension)
+        object_path = self.object_path(name)
+        if os.path.exists(object_path):
+            #same content is already stored, touch it to prevent it from being collected
+            os.utime(object_path,None)
+            os.remove(path)
+        else:
+            if not os.path.exists(os.path.dirname(object_path)):
+                os.makedirs(os.path.dirname(object_path))
+            shutil.move(path,object_path)
+        self.reference(manifest,name)
+        return (object_path,md5)
+
+    def reference(self,manifest,name):
+        """
+        add the object into the manifest file
+        """
+        names = self.manifest_objects(manifest)
+        if name in names:
+            return
+        names.append(name)
+        #write to a temporary file first, the garbage collector never reads a partial manifest file
+        fd,tmp_file = tempfile.mkstemp(dir=os.path.dirname(manifest))
+        with os.fdopen(fd,"w") as f:
+            f.write(json.dumps(names))
+        os.rename(tmp_file,manifest)
+
+    @staticmethod
+    def manifest_objects(manifest):
+        if not os.path.exists(manifest):
+            return []
+        with open(manifest) as f:
+            return json.loads(f.read())
+
+    def references(self):
+        """
+        return the reference count of each object
+        """
+        refs = Counter()
+        for dirpath,dirnames,filenames in os.walk(self.manifest_root):
+            if os.path.abspath(dirpath) == os.path.abspath(self.root):
+                dirnames[:] = []
+                continue
+            for f in filenames:
+                if f.endswith(self.MANIFEST_SUFFIX):
+                    try:
+                        refs.update(self.manifest_objects(os.path.join(dirpath,f)))
+                    except:
+                        #can't determine the objects referenced by the manifest, keep all objects
+                        logger.error("Failed to read the manifest file '{0}', skip garbage collection.".format(os.path.join(dirpath,f)),exc_info=True)
+                        return None
+        return refs
+
+    def collect_garbage(self):
+        """
+        remove the objects which are not referenced by any manifest file; return the number of removed objects
+        """
+        if not os.path.exists(self.root):
+            return 0
+        refs = self.references()
+        if refs is None:
+            return 0
+
+        expire_time = time.time() - BorgConfiguration.CONTENT_STORE_GRACE_HOURS * 3600
+        removed = 0
+        for dirpath,dirnames,filenames in os.walk(self.root):
+            for f in filenames:
+                object_path = os.path.join(dirpath,f)
+                if refs[os.path.relpath(object_path,self.root)] > 0:
+                    continue
+                try:
+                    if os.path.getmtime(object_path) >= expire_time:
+                        #maybe just stored by a running job
+                        continue
+                    os.remove(object_path)
+                    removed += 1
+                    logger.debug("Remove unreferenced object '{0}'".format(object_path))
+                except:
+                    logger.warning("Failed to remove the object '{0}'".format(object_path),exc_info=True)
+
+        return removed
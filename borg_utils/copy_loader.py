@@ -0,0 +1,207 @@
+import re
+import time
+import struct
+import binascii
+import logging
+from io import BytesIO
+
+try:
+    from osgeo import ogr
+except ImportError:
+    ogr = None
+
+from borg_utils.borg_config import BorgConfiguration
+
+logger = logging.getLogger(__name__)
+
+class CopyLoader(object):
+    """
+    Load the features of a ogr layer into a postgis table through "COPY FROM STDIN".
+
+    The table is created in the same structure as "ogr2ogr -overwrite -preserve_fid -nlt PROMOTE_TO_MULTI" does,
+    the features are streamed in batches, each batch is one COPY command.
+    progress is called with (loaded rows,total rows,rows per second) after each batch;
+    cancelled is called after each batch, the loading is stopped if it returns True.
+    if unlogged is True, the table is created as an unlogged table.
+    srid is required if the layer has geometry, the geometry column is never created with an unknown srid.
+    """
+    FID_COLUMN = "ogc_fid"
+    GEOMETRY_COLUMN = "wkb_geometry"
+
+    _launder_re = re.compile("[^a-z0-9_]")
+
+    _field_types = None
+
+    @staticmethod
+    def is_available():
+        return ogr is not None
+
+    def __init__(self,cursor,layer,schema,table,srid=None,batch_size=None,progress=None,cancelled=None,unlogged=False):
+        self.cursor = cursor
+        self.layer = layer
+        self.schema = schema
+        self.table = table
+        self.srid = srid
+        self.batch_size = batch_size or BorgConfiguration.IMPORT_BATCH_SIZE
+        self.progress = progress
+        self.cancelled = cancelled
+        self.unlogged = unlogged
+
+    @classmethod
+    def _pg_type(cls,field_defn):
+        if cls._field_types is None:
+            cls._field_types = {
+                ogr.OFTInteger:"integer",
+                ogr.OFTInteger64:"bigint",
+                ogr.OFTReal:"double precision",
+                ogr.OFTString:"varchar",
+                ogr.OFTDate:"date",
+                ogr.OFTTime:"time",
+                ogr.OFTDateTime:"timestamp with time zone",
+                ogr.OFTBinary:"bytea",
+                ogr.OFTIntegerList:"integer[]",
+                ogr.OFTInteger64List:"bigint[]",
+                ogr.OFTRealList:"double precision[]",
+                ogr.OFTStringList:"varchar[]",
+            }
+        field_type = field_defn.GetType()
+        if field_type == ogr.OFTString and field_defn.GetWidth() > 0:
+            return "varchar({0})".format(field_defn.GetWidth())
+        elif field_type == ogr.OFTReal and field_defn.GetWidth() > 0 and field_defn.GetPrecision() > 0:
+            return "numeric({0},{1})".format(field_defn.GetWidth(),field_defn.GetPrecision())
+        return cls._field_types.get(field_type,"varchar")
+
+    def _geometry_type(self):
+        """
+        return the postgis geometry type of the layer, single geometry type is promoted to multi type
+        """
+        geom_type = self.layer.GetGeomType()
+        if geom_type == ogr.wkbNone:
+            return None
+        flat_type = ogr.GT_Flatten(geom_type)
+        name = {
+            ogr.wkbPoint:"MULTIPOINT",
+            ogr.wkbMultiPoint:"MULTIPOINT",
+            ogr.wkbLineString:"MULTILINESTRING",
+            ogr.wkbMultiLineString:"MULTILINESTRING",
+            ogr.wkbPolygon:"MULTIPOLYGON",
+            ogr.wkbMultiPolygon:"MULTIPOLYGON",
+            ogr.wkbGeometryCollection:"GEOMETRYCOLLECTION",
+        }.get(flat_type,"GEOMETRY")
+        if ogr.GT_HasZ(geom_type):
+            name += "Z"
+        return name
+
+    def _columns(self):
+        """
+        return the list of (column name,column type,field index)
+        """
+        defn = self.layer.GetLayerDefn()
+        columns = []
+        for i in range(defn.GetFieldCount()):
+            field_defn = defn.GetFieldDefn(i)
+            columns.append((self._launder_re.sub("_",field_defn.GetName().lower()),self._pg_type(field_defn),i))
+        return columns
+
+    def _create_table(self,columns,geometry_type):
+        sql = "DROP TABLE IF EXISTS \"{0}\".\"{1}\" CASCADE;".format(self.schema,self.table)
+        sql += "CREATE {5}TABLE \"{0}\".\"{1}\" (\"{2}\" serial PRIMARY KEY{3}{4});".format(
+            self.schema,self.table,self.FID_COLUMN,
+            "".join([",\"{0}\" {1}".format(c[0],c[1]) for c in columns]),
+            ",\"{0}\" geometry({1},{2})".format(self.GEOMETRY_COLUMN,geometry_type,self.srid) if geometry_type else "",
+            "UNLOGGED " if self.unlogged else ""
+        )
+        self.cursor.execute(sql)
+
+    def _post_load(self,geometry_type):
+        sql = "SELECT setval(pg_get_serial_sequence('\"{0}\".\"{1}\"','{2}'),(SELECT COALESCE(max(\"{2}\"),0) + 1 FROM \"{0}\".\"{1}\"),false);".format(self.schema,self.table,self.FID_COLUMN)
+        if geometry_type:
+            sql += "CREATE INDEX \"{1}_{2}_geom_idx\" ON \"{0}\".\"{1}\" USING GIST (\"{2}\");".format(self.schema,self.table,self.GEOMETRY_COLUMN)
+        sql += "ANALYZE \"{0}\".\"{1}\";".format(self.schema,self.table)
+        self.cursor.execute(sql)
+
+    @staticmethod
+    def _escape(value):
+        if value is None:
+            return b"\\N"
+        if isinstance(value,(list,tuple)):
+            value = "{" + ",".join(['"{0}"'.format(unicode(v).replace("\\","\\\\").replace('"','\\"')) for v in value]) + "}"
+        elif isinstance(value,bool):
+            value = "t" if value else "f"
+        elif not isinstance(value,basestring):
+            value = unicode(value)
+        if isinstance(value,unicode):
+            value = value.encode("utf-8")
+        return value.replace(b"\\",b"\\\\").replace(b"\t",b"\\t").replace(b"\n",b"\\n").replace(b"\r",b"\\r")
+
+    def _ewkb(self,geom):
+        """
+        return the hex ewkb of the geometry, promoted to multi geometry
+        """
+        flat_type = ogr.GT_Flatten(geom.GetGeometryType())
+        if flat_type == ogr.wkbPoint:
+            geom = ogr.ForceToMultiPoint(geom)
+        elif flat_type == ogr.wkbLineString:
+            geom = ogr.ForceToMultiLineString(geom)
+        elif flat_type == ogr.wkbPolygon:
+            geom = ogr.ForceToMultiPolygon(geom)
+        wkb = bytes(geom.ExportToWkb(ogr.wkbNDR))
+        geom_type = struct.unpack(b"<I",wkb[1:5])[0]
+        #add the srid flag and srid after the geometry type
+        return binascii.hexlify(wkb[0:1] + struct.pack(b"<II",geom_type | 0x20000000,self.srid) + wkb[5:])
+
+    def _copy(self,column_names,rows):
+        data = BytesIO(b"".join(rows))
+        self.cursor.copy_expert("COPY \"{0}\".\"{1}\" ({2}) FROM STDIN".format(self.schema,self.table,",".join(["\"{0}\"".format(c) for c in column_names])),data)
+
+    def load(self):
+        """
+        Load all features into the table.
+        Return True if all features are loaded; False if cancelled.
+        """
+        columns = self._columns()
+        geometry_type = self._geometry_type()
+        if geometry_type and not self.srid:
+            raise ValueError("The srid of the layer is required to load the features into table {0}.{1}".format(self.schema,self.table))
+        self._create_table(columns,geometry_type)
+
+        column_names = [self.FID_COLUMN] + [c[0] for c in columns] + ([self.GEOMETRY_COLUMN] if geometry_type else [])
+        total = self.layer.GetFeatureCount()
+        loaded = 0
+        skipped = 0
+        begin_time = time.time()
+        rows = []
+        cancelled = False
+
+        self.layer.ResetReading()
+        feature = self.layer.GetNextFeature()
+        while feature is not None:
+            try:
+                #use the feature sequence as fid if the data source has no fid
+                values = [feature.GetFID() if feature.GetFID() >= 0 else loaded + skipped + len(rows) + 1]
+                values += [feature.GetField(c[2]) if feature.IsFieldSet(c[2]) else None for c in columns]
+                if geometry_type:
+                    geom = feature.GetGeometryRef()
+                    values.append(self._ewkb(geom) if geom is not None else None)
+                rows.append(b"\t".join([self._escape(v) for v in values]) + b"\n")
+            except:
+                #same as -skipfailures
+                skipped += 1
+                logger.warning("Failed to load the feature({0}) into table {1}.{2}".format(feature.GetFID(),self.schema,self.table),exc_info=True)
+            feature = self.layer.GetNextFeature()
+
+            if len(rows) >= self.batch_size or (feature is None and rows):
+                self._copy(column_names,rows)
+                loaded += len(rows)
+                rows = []
+                if self.progress:
+                    elapsed = time.time() - begin_time
+                    self.progress(loaded,total,int(loaded / elapsed) if elapsed > 0 else loaded)
+                if feature is not None and self.cancelled and self.cancelled():
+                    cancelled = True
+                    break
+
+        if skipped:
+            logger.info("{0} features are skipped when loading into table {1}.{2}".format(skipped,self.schema,self.table))
+        self._post_load(geometry_type)
+        return not cancelled
@@ -1,11 +1,13 @@
-import tempfile
-import os
-import subprocess
+import hashlib
+import threading
+from collections import OrderedDict
 from sqlalchemy import create_engine
 
 from django.conf import settings
 from django.db import connection
 
+from borg_utils.borg_config import BorgConfiguration
+
 class _DbUtil(object):
     _query_index_constraint_sql = """
 SELECT s.conname ,s.contype
@@ -28,6 +30,31 @@ WHERE np.nspname='{0}' and ct.relname='{1}'
 
     _query_all_views = "select relname from pg_class c join pg_namespace n on c.relnamespace=n.oid where n.nspname='{schema}' and c.relkind in ('v','m')"
 
+    _query_relation_version_sql = """
+SELECT c.oid,c.relfilenode,concat_ws(';',c.xmin,
+    (SELECT string_agg(CAST(a.xmin AS text),',' ORDER BY a.attnum) FROM pg_attribute a WHERE a.attrelid = c.oid),
+    (SELECT string_agg(CAST(d.xmin AS text),',' ORDER BY d.oid) FROM pg_attrdef d WHERE d.adrelid = c.oid),
+    (SELECT string_agg(CAST(s.xmin AS text),',' ORDER BY s.oid) FROM pg_constraint s WHERE s.conrelid = c.oid),
+    (SELECT string_agg(CAST(i.xmin AS text),',' ORDER BY i.indexrelid) FROM pg_index i WHERE i.indrelid = c.oid),
+    (SELECT string_agg(CAST(r.xmin AS text),',' ORDER BY r.oid) FROM pg_rewrite r WHERE r.ev_class = c.oid))
+FROM pg_class c JOIN pg_namespace n ON c.relnamespace = n.oid
+WHERE {0} AND c.relname = '{1}' AND c.relkind in ('r','v','m')
+"""
+
+    _query_relation_ddl_sql = """
+SELECT c.relkind,
+    ARRAY(SELECT CAST(a.attname AS text) FROM pg_attribute a WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped ORDER BY a.attnum),
+    ARRAY(SELECT format_type(a.atttypid,a.atttypmod) FROM pg_attribute a WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped ORDER BY a.attnum),
+    ARRAY(SELECT a.attnotnull FROM pg_attribute a WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped ORDER BY a.attnum),
+    ARRAY(SELECT pg_get_expr(d.adbin,d.adrelid) FROM pg_attribute a LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped ORDER BY a.attnum),
+    ARRAY(SELECT CAST(s.conname AS text) FROM pg_constraint s WHERE s.conrelid = c.oid ORDER BY s.contype,s.conname),
+    ARRAY(SELECT pg_get_constraintdef(s.oid) FROM pg_constraint s WHERE s.conrelid = c.oid ORDER BY s.contype,s.conname),
+    ARRAY(SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i JOIN pg_class ci ON i.indexrelid = ci.oid WHERE i.indrelid = c.oid AND NOT EXISTS (SELECT 1 FROM pg_constraint s WHERE s.conindid = i.indexrelid) ORDER BY ci.relname),
+    CASE WHEN c.relkind in ('v','m') THEN pg_get_viewdef(c.oid) ELSE NULL END
+FROM pg_class c
+WHERE c.oid = {0}
+"""
+
     """
     a set of utility method to access db
     """
@@ -49,30 +76,69 @@ WHERE np.nspname='{0}' and ct.relname='{1}'
     def database(self):
         return self._db;
 
-    def get_create_table_sql(self,table,schema="public"):
-        if not self._env:
-            self._env = os.environ.copy()
-            if self._password:
-                self._env["PGPASSWORD"] = self._password
-
-            self._table_schema_dump_cmd = ["pg_dump", "-h", self._host, "-d", self._db, "-U", self._user, "-F", "p", "-w", "-x", "-O", "--no-security-labels", "--no-tablespaces", "-s"]
-            if self._port:
-                self._table_schema_dump_cmd += ["-p", str(self._port)]
-
-        #get the input table structure
-        f = tempfile.NamedTemporaryFile(delete=False)
-        f.close()
-        cmd = self._table_schema_dump_cmd + ["-t", schema + "." + table, "-f", f.name]
-        output = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE, env=self._env).communicate()
-        if output[1].strip() :
-            raise Exception(output[1])
+    def get_create_table_sql(self,table,schema="public",cursor=None):
+        """
+        Return the create sql of the table or view, generated from the catalogue.
+        The sql is cached by the table's oid, relfilenode and the xmin of its catalogue rows,
+        so it is only generated again if the table structure is changed.
+        """
+        close = False
+        if not cursor:
+            cursor = self.cursor()
+            close = True
+
         try:
-            reader = open(f.name,'r') 
-            return ''.join([s for s in reader if not (s.startswith('SET') or s.startswith('--')) and s.strip() ])
+            if schema == "pg_temp":
+                schema_condition = "c.relnamespace = pg_my_temp_schema()"
+            else:
+                schema_condition = "n.nspname = '{0}'".format(schema)
+            row = self.get(self._query_relation_version_sql.format(schema_condition,table),cursor)
+            if not row:
+                raise Exception("The table/view({0}.{1}) does not exist.".format(schema,table))
+            key = (self.id,row[0],row[1],hashlib.md5(row[2] or "").hexdigest())
+            sql = _DDL_CACHE.get(key)
+            if sql is not None:
+                return sql
+
+            row = self.get(self._query_relation_ddl_sql.format(row[0]),cursor)
+            columns = zip(row[1] or [],row[2] or [],row[3] or [],row[4] or [])
+            constraints = zip(row[5] or [],row[6] or [])
+            sql = _DbUtil.create_table_sql(schema,table,row[0],columns,constraints,row[7] or [],row[8])
+            _DDL_CACHE.put(key,sql)
+            return sql
         finally:
-            if reader:
-                reader.close()
-            os.unlink(f.name)
+            if close:
+                cursor.close()
+                cursor = None
+
+    @staticmethod
+    def create_table_sql(schema,table,kind,columns,constraints,indexes,viewdef=None):
+        """
+        Return the create sql of a table or view.
+        kind: the relkind of the relation
+        columns: list of (name,type,not null,default)
+        constraints: list of (name,definition)
+        indexes: list of index definitions, which don't belong to a constraint
+        viewdef: the definition of the view
+        """
+        if kind in ('v','m'):
+            return "CREATE {0}VIEW \"{1}\".\"{2}\" AS\n{3}\n".format("MATERIALIZED " if kind == "m" else "",schema,table,viewdef or "")
+
+        lines = []
+        for column in columns:
+            line = "    \"{0}\" {1}".format(column[0],column[1])
+            if column[3] is not None:
+                line += " DEFAULT {0}".format(column[3])
+            if column[2]:
+                line += " NOT NULL"
+            lines.append(line)
+        for constraint in constraints:
+            lines.append("    CONSTRAINT \"{0}\" {1}".format(constraint[0],constraint[1]))
+
+        sql = "CREATE TABLE \"{0}\".\"{1}\" (\n{2}\n);\n".format(schema,table,",\n".join(lines))
+        for index in indexes:
+            sql += "{0};\n".format(index)
+        return sql
 
     def cursor(self):
         if self._connection:
@@ -191,6 +257,31 @@ WHERE np.nspname='{0}' and ct.relname='{1}'
         return views;
 
 
+class _LRUCache(object):
+    """
+    A thread safe cache which keeps the most recently used items
+    """
+    def __init__(self,size):
+        self._size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self,key):
+        with self._lock:
+            value = self._items.pop(key,None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def put(self,key,value):
+        with self._lock:
+            self._items.pop(key,None)
+            self._items[key] = value
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+_DDL_CACHE = _LRUCache(BorgConfiguration.DDL_CACHE_SIZE)
+
 _DB_UTILS = {
 }
 
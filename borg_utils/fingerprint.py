@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import create_engine
+
+from borg_utils.borg_config import BorgConfiguration
+
+logger = logging.getLogger(__name__)
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+def _get_engine(db_url,pool_size):
+    """
+    return a engine with a connection pool shared by all fingerprints of the same database
+    """
+    with _engines_lock:
+        engine = _engines.get(db_url)
+        if not engine:
+            engine = create_engine(db_url,pool_size=pool_size,max_overflow=0)
+            _engines[db_url] = engine
+        return engine
+
+def dispose_engines():
+    """
+    close all the pooled connections of the shared engines;
+    should be called before forking, otherwise the forked processes would reuse the connections of the parent process
+    """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+
+class TableFingerprint(object):
+    """
+    Fingerprint of a table, which consists of the digests of the chunks of the table.
+
+    The table is split into chunks by the integer key column;
+    chunk i contains the rows whose key is in the range [i * size, (i + 1) * size),
+    so the chunk boundaries are stable between checks and only the changed chunks have different digests;
+    the rows whose key is null are in a dedicated chunk "null".
+    If no key column is specified, the whole table is one chunk.
+    The chunks are hashed concurrently over a pool of connections.
+
+    The fingerprint is a json compatible dictionary:
+    {"key":key column, "size":chunk size, "chunks":{chunk index:[row count, digest]}}
+    """
+    RANGE_SQL = "SELECT min(\"{2}\"), max(\"{2}\") FROM \"{0}\".\"{1}\";"
+    NULL_CHUNK = "null"
+    CHUNK_SQL = "SELECT count(*), md5(string_agg(h,',' ORDER BY h)) FROM (SELECT md5(CAST(t.* as text)) AS h FROM \"{0}\".\"{1}\" as t {2}) as s;"
+
+    def __init__(self,db_url,schema,table,key_column=None,chunk_size=None,concurrency=None):
+        self.db_url = db_url
+        self.schema = schema
+        self.table = table
+        self.key_column = key_column
+        self.chunk_size = chunk_size or BorgConfiguration.FINGERPRINT_CHUNK_SIZE
+        self.concurrency = concurrency or BorgConfiguration.FINGERPRINT_CONCURRENCY
+
+    @staticmethod
+    def range_condition(key_column,ranges):
+        """
+        return the where clause for the list of key ranges [lower,upper); range None means the rows whose key is null
+        """
+        return "WHERE " + " OR ".join([("(\"{0}\" IS NULL)".format(key_column) if r is None else "(\"{0}\" >= {1} AND \"{0}\" < {2})".format(key_column,*r)) for r in ranges])
+
+    def _execute(self,engine,sql):
+        conn = engine.connect()
+        try:
+            return conn.execute(sql).fetchone()
+        finally:
+            conn.close()
+
+    def _chunks(self,engine):
+        """
+        return the chunk size and the list of chunk indexes
+        """
+        if not self.key_column:
+            return (None,[None])
+
+        min_key,max_key = self._execute(engine,self.RANGE_SQL.format(self.schema,self.table,self.key_column))
+        if min_key is None:
+            #empty table or all the keys are null
+            return (self.chunk_size,[self.NULL_CHUNK])
+        min_key,max_key = int(min_key),int(max_key)
+        size = self.chunk_size
+        #double the chunk size until the number of chunks is acceptable, the chunk boundaries are still stable
+        while (max_key // size) - (min_key // size) + 1 > BorgConfiguration.FINGERPRINT_MAX_CHUNKS:
+            size *= 2
+        return (size,range(min_key // size,max_key // size + 1) + [self.NULL_CHUNK])
+
+    def compute(self):
+        """
+        compute and return the fingerprint of the table
+        """
+        engine = _get_engine(self.db_url,self.concurrency)
+        size,chunks = self._chunks(engine)
+
+        def _hash_chunk(index):
+            if index is None:
+                condition = ""
+            elif index == self.NULL_CHUNK:
+                condition = TableFingerprint.range_condition(self.key_column,[None])
+            else:
+                condition = TableFingerprint.range_condition(self.key_column,[(index * size,(index + 1) * size)])
+            row = self._execute(engine,self.CHUNK_SQL.format(self.schema,self.table,condition))
+            return (index,row)
+
+        result = {}
+        if len(chunks) > 1 and self.concurrency > 1:
+            pool = ThreadPool(min(self.concurrency,len(chunks)))
+            try:
+                rows = pool.map(_hash_chunk,chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            rows = [_hash_chunk(index) for index in chunks]
+
+        for index,row in rows:
+            if row[0]:
+                #ignore the empty chunks
+                result[str(index)] = [row[0],row[1]]
+
+        return {"key":self.key_column,"size":size,"chunks":result}
+
+    @staticmethod
+    def row_count(fingerprint):
+        return sum([c[0] for c in fingerprint["chunks"].values()])
+
+    @staticmethod
+    def changed_chunks(previous,current):
+        """
+        Return the list of changed key ranges (lower,upper) and None for the null key chunk between the two fingerprints; empty list if not changed.
+        Return None if the fingerprints are not comparable chunk by chunk, the whole table should be treated as changed.
+        """
+        if not previous or not current:
+            return None
+        if previous.get("key") != current.get("key") or previous.get("size") != current.get("size"):
+            return None
+
+        changed = []
+        size = current["size"]
+        for index in set(previous["chunks"].keys()) | set(current["chunks"].keys()):
+            if previous["chunks"].get(index) != current["chunks"].get(index):
+                if index == "None":
+                    #the whole table is one chunk
+                    return None
+                elif index == TableFingerprint.NULL_CHUNK:
+                    changed.append(None)
+                else:
+                    changed.append((int(index) * size,(int(index) + 1) * size))
+
+        changed.sort()
+        return changed
+
+    @staticmethod
+    def digest(fingerprint):
+        """
+        return a digest of the whole fingerprint
+        """
+        m = hashlib.md5()
+        for index in sorted(fingerprint["chunks"].keys()):
+            m.update("{0}:{1}:{2};".format(index,*fingerprint["chunks"][index]))
+        return m.hexdigest()
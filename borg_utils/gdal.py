@@ -1,15 +1,158 @@
 import subprocess
 import os
+import re
+import json
+import glob
+import hashlib
+import logging
+import time
+import tempfile
 
+from borg_utils.borg_config import BorgConfiguration
+
+logger = logging.getLogger(__name__)
+
+_datasource_re = re.compile("<SrcDataSource[^>]*>(?P<data_source>[^<]*)</SrcDataSource>")
+_vrt_file_placeholder = "<VRT_FILE>"
+
+def _file_signatures(path):
+    """
+    Return the list of (path,size,mtime) of the files which the data source consists of;
+    a shape file also consists of the files with the same name but different extension.
+    Return None if the data source is not a local file or folder.
+    """
+    if os.path.isfile(path):
+        files = glob.glob(os.path.splitext(path)[0] + ".*")
+        if path not in files:
+            files.append(path)
+    elif os.path.isdir(path):
+        files = [os.path.join(path,f) for f in os.listdir(path)]
+        files.append(path)
+    else:
+        return None
+
+    result = []
+    for f in sorted(files):
+        st = os.stat(f)
+        result.append((f,st.st_size,st.st_mtime))
+    return result
+
+def _cache_key(cmd,filename):
+    """
+    Return the cache key of the command output, which is built from the command,
+    the content of the vrt file and the size and modify time of the data source files.
+    Return None if the output can't be cached.
+    """
+    if not BorgConfiguration.OGRINFO_CACHE_DIR or not os.path.isfile(filename):
+        return None
+
+    md5 = hashlib.md5()
+    md5.update(" ".join([_vrt_file_placeholder if c == filename else c for c in cmd]).encode("utf-8"))
+    with open(filename,"rb") as f:
+        content = f.read()
+    if content.lstrip().startswith(b"<"):
+        #vrt file, the output depends on the vrt content and the data source files
+        md5.update(content)
+        datasources = [ds.strip() for ds in _datasource_re.findall(content.decode("utf-8"))]
+        if not datasources:
+            return None
+    else:
+        datasources = [filename]
+
+    for ds in datasources:
+        signatures = _file_signatures(ds)
+        if signatures is None:
+            #not a file based data source
+            return None
+        md5.update(json.dumps(signatures).encode("utf-8"))
+
+    return md5.hexdigest()
+
+def _cache_file(key):
+    return os.path.join(BorgConfiguration.OGRINFO_CACHE_DIR,key[0:2],key + ".json")
+
+def run_cached(cmd,filename):
+    """
+    Run the gdal command against the file and return (returncode,stdout,stderr).
+    The output of the succeeded command is cached on disk, and reused until the file or its data source files are changed;
+    the modify time of the cache file is updated when it is used, so the cache files not used recently can be pruned.
+    """
+    key = None
+    try:
+        key = _cache_key(cmd,filename)
+        if key and os.path.exists(_cache_file(key)):
+            with open(_cache_file(key)) as f:
+                output = json.loads(f.read())
+            os.utime(_cache_file(key),None)
+            return (0,output.replace(_vrt_file_placeholder,filename),"")
+    except:
+        logger.warning("Failed to read the cached output of '{0}'".format(" ".join(cmd)),exc_info=True)
+
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = p.communicate()
+
+    if key and p.returncode == 0:
+        try:
+            cache_file = _cache_file(key)
+            if not os.path.exists(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            #write to a temporary file first, other processes never read a partial cache file
+            fd,tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+            with os.fdopen(fd,"w") as f:
+                f.write(json.dumps(output[0].decode("utf-8").replace(filename,_vrt_file_placeholder)))
+            os.rename(tmp_file,cache_file)
+        except:
+            logger.warning("Failed to cache the output of '{0}'".format(" ".join(cmd)),exc_info=True)
+
+    return (p.returncode,output[0],output[1])
+
+def prune_cache(expire_days=None):
+    """
+    Remove the cached outputs which are not used in the last expire_days days.
+    Return the number of removed cache files.
+    """
+    expire_days = BorgConfiguration.OGRINFO_CACHE_EXPIRE_DAYS if expire_days is None else expire_days
+    if not BorgConfiguration.OGRINFO_CACHE_DIR or expire_days <= 0 or not os.path.isdir(BorgConfiguration.OGRINFO_CACHE_DIR):
+        return 0
+
+    outdated_time = time.time() - expire_days * 86400
+    removed = 0
+    for root,dirs,files in os.walk(BorgConfiguration.OGRINFO_CACHE_DIR):
+        for f in files:
+            cache_file = os.path.join(root,f)
+            try:
+                if os.path.getmtime(cache_file) < outdated_time:
+                    os.remove(cache_file)
+                    removed += 1
+            except:
+                #removed by other process
+                pass
+    return removed
+
+_gdal_version = None
+_gdal_version_re = re.compile("GDAL\s+(?P<version>[0-9]+(\.[0-9]+)*)")
+
+def gdal_version():
+    """
+    return the version of the installed gdal tools as a tuple of integers; return () if not available
+    """
+    global _gdal_version
+    if _gdal_version is None:
+        try:
+            output = subprocess.check_output(["ogrinfo","--version"],stderr=subprocess.STDOUT)
+            m = _gdal_version_re.search(output)
+            _gdal_version = tuple([int(v) for v in m.group("version").split(".")]) if m else ()
+        except:
+            _gdal_version = ()
+    return _gdal_version
 
 def detect_epsg(filename):
-    
+
     gdal_cmd = ['gdalsrsinfo', '-e', filename]
-    gdal = subprocess.Popen(gdal_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    gdal_output = gdal.communicate()
+    gdal_output = run_cached(gdal_cmd,filename)
 
     result = None
-    for line in gdal_output[0].split('\n'):
+    for line in gdal_output[1].split('\n'):
         if line.startswith('EPSG') and line != 'EPSG:-1':
             result = line
             break
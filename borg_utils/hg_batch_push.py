@@ -1,10 +1,10 @@
-import hglib
 import threading
 import logging
 
 logger = logging.getLogger(__name__)
 
 from borg_utils.borg_config import BorgConfiguration
+from borg_utils.state_repository import StateRepository
 
 def try_set_push_owner(owner,enforce=False):
     if enforce or getattr(threading.current_thread,"push_owner",None) in [None,owner]:
@@ -34,22 +34,9 @@ def try_push_to_repository(pusher,hg=None,enforce=False):
     if not enforce and pusher != getattr(threading.current_thread,"push_owner",None):
         #pusher is not the current push owner, return
         return
+    #the changesets committed by other mercurial clients; the changes submitted to StateRepository are counted by itself
     changesets = getattr(threading.current_thread,"committed_changes",0) 
-    if changesets <= 0:
-        #no committed changes, not need to push
-        return
-
-    if BorgConfiguration.DEBUG:
-        logger.info("Push {0} changesets to the repository".format(changesets))
-    else:
-        logger.debug("Push {0} changesets to the repository".format(changesets))
-
-    if hg is None:
-        hg = hglib.open(BorgConfiguration.BORG_STATE_REPOSITORY)
-        try:
-            hg.push(ssh=BorgConfiguration.BORG_STATE_SSH)
-        finally:
-            hg.close()
-    else:
-        hg.push(ssh=BorgConfiguration.BORG_STATE_SSH)
+    if changesets > 0:
+        StateRepository.instance().mark_committed(changesets)
 
+    StateRepository.instance().push()
@@ -0,0 +1,232 @@
+import re
+import subprocess
+import logging
+
+try:
+    from osgeo import ogr, gdal
+except ImportError:
+    ogr = None
+    gdal = None
+
+from borg_utils.borg_config import BorgConfiguration
+from borg_utils.gdal import run_cached, detect_epsg
+
+logger = logging.getLogger(__name__)
+
+class Field(object):
+    """
+    A field of a layer
+    """
+    def __init__(self,name,type,width=None,precision=None):
+        self.name = name
+        self.type = type
+        self.width = width
+        self.precision = precision
+
+    def __repr__(self):
+        return "Field({0}:{1}({2}.{3}))".format(self.name,self.type,self.width,self.precision)
+
+class LayerInfo(object):
+    """
+    The summary information of a layer, same as the output of "ogrinfo -so"
+    extent is a tuple (minx,miny,maxx,maxy), or None if the layer is non spatial
+    """
+    def __init__(self,name,geometry=None,feature_count=None,extent=None,srs_wkt=None,fields=None,text=None):
+        self.name = name
+        self.geometry = geometry
+        self.feature_count = feature_count
+        self.extent = extent
+        self.srs_wkt = srs_wkt
+        self.fields = fields or []
+        self._text = text
+
+    @property
+    def text(self):
+        """
+        the text in the same format as the output of "ogrinfo -so"
+        """
+        if self._text is None:
+            lines = ["", "Layer name: {0}".format(self.name), "Geometry: {0}".format(self.geometry), "Feature Count: {0}".format(self.feature_count)]
+            if self.extent:
+                lines.append("Extent: ({0:f}, {1:f}) - ({2:f}, {3:f})".format(*self.extent))
+            lines.append("Layer SRS WKT:")
+            lines.append(self.srs_wkt or "(unknown)")
+            for f in self.fields:
+                lines.append("{0}: {1} ({2}.{3})".format(f.name,f.type,f.width or 0,f.precision or 0))
+            self._text = "\n".join(lines) + "\n"
+        return self._text
+
+class SubprocessBackend(object):
+    """
+    Get the data source information by running ogrinfo and gdalsrsinfo
+    """
+    name = "subprocess"
+
+    _field_re = re.compile("[ \t]*(?P<type>[a-zA-Z0-9]+)[ \t]*(\([ \t]*(?P<width>[0-9]+)\.(?P<precision>[0-9]+)\))?[ \t]*")
+    _datasource_info_re = re.compile("[(\n)|(\r\n)](?P<key>[a-zA-Z0-9_\-][a-zA-Z0-9_\- ]*[a-zA-Z0-9_\-]?)[ \t]*:(?P<value>[^\r\n]*([(\r\n)|(\n)](([ \t]+[^\r\n]*)|(GEOGCS[^\r\n]*)))*)")
+    _extent_re = re.compile("\(\s*(?P<minx>[0-9eE\.\+\-]+)\s*,\s*(?P<miny>[0-9eE\.\+\-]+)\s*\)\s*-\s*\(\s*(?P<maxx>[0-9eE\.\+\-]+)\s*,\s*(?P<maxy>[0-9eE\.\+\-]+)\s*\)")
+
+    def _run(self,cmd,datasource):
+        if datasource.startswith("PG:"):
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+            output = p.communicate()
+            return (p.returncode,output[0],output[1])
+        else:
+            return run_cached(cmd,datasource)
+
+    def layer_info(self,datasource,layer=None):
+        if layer:
+            cmd = ["ogrinfo", "-ro", "-so", datasource, layer]
+        else:
+            cmd = ["ogrinfo", "-ro","-al","-so", datasource]
+
+        returncode,output,error = self._run(cmd,datasource)
+        if returncode != 0:
+            error_msg = error.replace("ERROR 1: Invalid geometry field index : -1","")
+            if error_msg.strip():
+                raise Exception(error_msg)
+            else:
+                raise Exception("orginfo failed with unknown exception")
+
+        info = LayerInfo(None,text=output)
+        for key,value in [(item[0],item[1]) for item in self._datasource_info_re.findall(output)]:
+            if key == "Layer name":
+                if info.name is not None:
+                    #only parse the first layer
+                    break
+                info.name = value.strip()
+            elif key == "Geometry":
+                info.geometry = value.strip()
+            elif key == "Feature Count":
+                try:
+                    info.feature_count = int(value.strip())
+                except:
+                    info.feature_count = None
+            elif key == "Extent":
+                m = self._extent_re.search(value)
+                if m:
+                    info.extent = tuple([float(m.group(k)) for k in ("minx","miny","maxx","maxy")])
+            elif key == "Layer SRS WKT":
+                srs_wkt = value.strip()
+                if srs_wkt and srs_wkt != "(unknown)":
+                    info.srs_wkt = srs_wkt
+            elif key in ("INFO","Metadata") or key.find(" ") >= 0:
+                continue
+            else:
+                m = self._field_re.search(value)
+                if m:
+                    info.fields.append(Field(key,m.group('type'),m.group('width'),m.group('precision')))
+
+        return info
+
+    def layer_name(self,datasource):
+        returncode,output,error = self._run(["ogrinfo", "-q", "-ro", datasource],datasource)
+        output = output + error
+        if returncode != 0 or output.find("ERROR") > -1:
+            raise Exception(output)
+        return output.replace("1: ", "").split(" (")[0].strip()
+
+    def detect_epsg(self,datasource):
+        return detect_epsg(datasource)
+
+class BindingsBackend(object):
+    """
+    Get the data source information in process through the GDAL/OGR python bindings
+    """
+    name = "bindings"
+
+    def _open(self,datasource):
+        ds = ogr.Open(datasource)
+        if ds is None:
+            raise Exception(gdal.GetLastErrorMsg() or "Failed to open the data source '{0}'".format(datasource))
+        return ds
+
+    def _layer(self,ds,layer=None):
+        l = ds.GetLayerByName(layer) if layer else ds.GetLayer(0)
+        if l is None:
+            raise Exception(gdal.GetLastErrorMsg() or "Layer '{0}' does not exist".format(layer))
+        return l
+
+    def open_layer(self,datasource,layer=None):
+        """
+        return (data source,layer); the data source should be kept until the layer is not used
+        """
+        ds = self._open(datasource)
+        return (ds,self._layer(ds,layer))
+
+    def layer_info(self,datasource,layer=None):
+        ds = self._open(datasource)
+        try:
+            l = self._layer(ds,layer)
+            geom_type = l.GetGeomType()
+            info = LayerInfo(l.GetName())
+            info.geometry = ogr.GeometryTypeToName(geom_type)
+            info.feature_count = l.GetFeatureCount()
+            if geom_type != ogr.wkbNone:
+                minx,maxx,miny,maxy = l.GetExtent()
+                info.extent = (minx,miny,maxx,maxy)
+            srs = l.GetSpatialRef()
+            if srs is not None:
+                info.srs_wkt = srs.ExportToPrettyWkt()
+            defn = l.GetLayerDefn()
+            for i in range(defn.GetFieldCount()):
+                fd = defn.GetFieldDefn(i)
+                info.fields.append(Field(fd.GetName(),ogr.GetFieldTypeName(fd.GetType()),str(fd.GetWidth()),str(fd.GetPrecision())))
+            return info
+        finally:
+            ds = None
+
+    def layer_name(self,datasource):
+        ds = self._open(datasource)
+        try:
+            return self._layer(ds).GetName()
+        finally:
+            ds = None
+
+    def detect_epsg(self,datasource):
+        ds = self._open(datasource)
+        try:
+            srs = self._layer(ds).GetSpatialRef()
+            if srs is None:
+                return None
+            srs = srs.Clone()
+            if srs.GetAuthorityName(None) != "EPSG":
+                srs.AutoIdentifyEPSG()
+            if srs.GetAuthorityName(None) == "EPSG" and srs.GetAuthorityCode(None):
+                return "EPSG:{0}".format(srs.GetAuthorityCode(None))
+            return None
+        finally:
+            ds = None
+
+    def features(self,datasource,layer=None):
+        """
+        iterate the features of the layer
+        """
+        ds = self._open(datasource)
+        try:
+            l = self._layer(ds,layer)
+            l.ResetReading()
+            feature = l.GetNextFeature()
+            while feature is not None:
+                yield feature
+                feature = l.GetNextFeature()
+        finally:
+            ds = None
+
+_backends = {}
+
+def get_backend(name=None):
+    """
+    Return the ogr backend configured by OGR_BACKEND.
+    "auto" uses the python bindings if available, otherwise falls back to the subprocess backend.
+    """
+    name = (name or BorgConfiguration.OGR_BACKEND or "auto").lower()
+    if name == "auto":
+        name = BindingsBackend.name if ogr else SubprocessBackend.name
+    elif name == BindingsBackend.name and not ogr:
+        logger.warning("GDAL python bindings are not available, use the subprocess ogr backend.")
+        name = SubprocessBackend.name
+
+    if name not in _backends:
+        _backends[name] = BindingsBackend() if name == BindingsBackend.name else SubprocessBackend()
+    return _backends[name]
@@ -0,0 +1,105 @@
+import re
+import os
+import hashlib
+import logging
+import subprocess
+import tempfile
+
+from borg_utils.borg_config import BorgConfiguration
+
+logger = logging.getLogger(__name__)
+
+class PgDump(object):
+    """
+    Dump a table into a custom format archive with pg_dump.
+
+    The archive is streamed from the stdout of pg_dump into the dump file,
+    and the md5 of the archive is computed while writing, the dump file is never read again.
+    The compression is configured by DUMP_COMPRESSION, which is either a gzip level ("0" - "9")
+    or a compression method with optional level ("gzip:6", "lz4", "zstd:3");
+    lz4 and zstd are only supported by pg_dump 16 or later, gzip level 1 is used if not supported.
+    """
+    CONTENT_HASH_SQL = """
+SELECT md5(string_agg(h,',' ORDER BY h)) FROM (
+    SELECT attname || ':' || format_type(atttypid,atttypmod) AS h FROM pg_attribute WHERE attrelid = '"{0}"."{1}"'::regclass AND attnum > 0 AND NOT attisdropped
+    UNION ALL
+    SELECT regexp_replace(indexdef,'^.* USING ','') FROM pg_indexes WHERE schemaname = '{0}' AND tablename = '{1}'
+    UNION ALL
+    SELECT md5(string_agg(md5_rowhash,',' ORDER BY md5_rowhash)) FROM "{0}"."{1}"
+) as s;
+"""
+    BUFFER_SIZE = 1024 * 1024
+
+    _version_re = re.compile("(?P<version>[0-9]+(\.[0-9]+)*)")
+    _version = None
+
+    def __init__(self,database):
+        self.env = os.environ.copy()
+        self.cmd = ["pg_dump", "-h", database["HOST"], "-d", database["NAME"], "-U", database["USER"], "-b", "-E", "utf-8", "-F", "c", "-w", "-O"]
+        if 'PASSWORD' in database and database['PASSWORD'].strip():
+            self.env["PGPASSWORD"] = database["PASSWORD"]
+        if database["PORT"]:
+            self.cmd += ["-p", str(database["PORT"])]
+        self.cmd += self.compression_args()
+
+    @classmethod
+    def version(cls):
+        """
+        return the version of pg_dump as a tuple of integers; return () if not available
+        """
+        if cls._version is None:
+            try:
+                output = subprocess.check_output(["pg_dump","--version"],stderr=subprocess.STDOUT)
+                m = cls._version_re.search(output)
+                cls._version = tuple([int(v) for v in m.group("version").split(".")]) if m else ()
+            except:
+                cls._version = ()
+        return cls._version
+
+    def compression_args(self):
+        compression = str(BorgConfiguration.DUMP_COMPRESSION).strip().lower()
+        if compression.isdigit():
+            return ["-Z", compression]
+
+        method = compression.split(":")[0]
+        if method == "gzip" or (method in ("lz4","zstd") and self.version() >= (16,)):
+            return ["--compress={0}".format(compression)]
+
+        logger.warning("The compression '{0}' is not supported by pg_dump {1}, use gzip level 1 instead.".format(compression,".".join([str(v) for v in self.version()])))
+        return ["-Z", "1"]
+
+    @classmethod
+    def content_hash(cls,cursor,schema,table):
+        """
+        return the hash of the table structure and the table data
+        the table should be a publish table, the data hash is computed from the indexed row hash column "md5_rowhash"
+        """
+        cursor.execute(cls.CONTENT_HASH_SQL.format(schema,table))
+        return cursor.fetchone()[0]
+
+    def dump(self,schema,table,dump_file):
+        """
+        Dump the table into the dump file and return the md5 of the dump file.
+        Raise exception if failed.
+        """
+        cmd = self.cmd + ["-t", "{0}.{1}".format(schema,table)]
+        md5 = hashlib.md5()
+        #use a temporary file to hold the error output, pg_dump never blocks on a full stderr pipe
+        with tempfile.TemporaryFile() as err:
+            p = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=err,env=self.env)
+            try:
+                with open(dump_file,"wb") as f:
+                    for chunk in iter(lambda: p.stdout.read(self.BUFFER_SIZE),b""):
+                        md5.update(chunk)
+                        f.write(chunk)
+            finally:
+                p.stdout.close()
+                p.wait()
+            err.seek(0)
+            error = err.read()
+
+        logger.debug("execute ({0})\nstderr:{1}".format(cmd,error))
+        if p.returncode != 0 or error.strip():
+            raise Exception(error.strip() or "pg_dump failed with return code {0}".format(p.returncode))
+
+        return md5.hexdigest()
@@ -0,0 +1,185 @@
+import json
+import logging
+
+from django.conf import settings
+
+from borg_utils.borg_config import BorgConfiguration
+from borg_utils.db_util import _DbUtil
+from borg_utils.spatial_table import SpatialTable,SpatialTableCache
+
+logger = logging.getLogger(__name__)
+
+class SchemaIntrospector(object):
+    """
+    Introspect all the tables and views of a schema with a few catalogue queries.
+
+    The columns, constraints, indexes, view definitions and spatial columns of all relations are retrieved
+    by one query each, and the bboxes of the spatial columns are retrieved by a few union queries, estimated from the planner statistics if BBOX_MODE is "estimated";
+    the create sql is generated by _DbUtil.create_table_sql, same as _DbUtil.get_create_table_sql.
+    The result of each relation is a dict with "type", "spatial_info" and "sql",
+    "spatial_info" is the same json as SpatialTable.spatial_info.
+    """
+    BBOX_BATCH_SIZE = 50
+    DEFAULT_BBOX = (108,-45,155,-10)
+
+    _query_columns_sql = """
+SELECT c.relname,c.relkind,a.attname,format_type(a.atttypid,a.atttypmod),a.attnotnull,pg_get_expr(d.adbin,d.adrelid)
+FROM pg_class c JOIN pg_namespace n ON c.relnamespace = n.oid
+    LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+WHERE n.nspname = '{0}' AND c.relkind in ('r','v','m'){1}
+ORDER BY c.relname,a.attnum
+"""
+
+    _query_constraints_sql = """
+SELECT c.relname,s.conname,pg_get_constraintdef(s.oid)
+FROM pg_constraint s JOIN pg_class c ON s.conrelid = c.oid JOIN pg_namespace n ON c.relnamespace = n.oid
+WHERE n.nspname = '{0}'{1}
+ORDER BY c.relname,s.contype,s.conname
+"""
+
+    _query_indexes_sql = """
+SELECT c.relname,pg_get_indexdef(i.indexrelid)
+FROM pg_index i JOIN pg_class ci ON i.indexrelid = ci.oid JOIN pg_class c ON i.indrelid = c.oid JOIN pg_namespace n ON c.relnamespace = n.oid
+WHERE n.nspname = '{0}' AND NOT EXISTS (SELECT 1 FROM pg_constraint s WHERE s.conindid = i.indexrelid){1}
+ORDER BY c.relname,ci.relname
+"""
+
+    _query_views_sql = """
+SELECT c.relname,pg_get_viewdef(c.oid)
+FROM pg_class c JOIN pg_namespace n ON c.relnamespace = n.oid
+WHERE n.nspname = '{0}' AND c.relkind in ('v','m'){1}
+"""
+
+    _query_geometry_columns_sql = "SELECT f_table_name,f_geometry_column,type,srid FROM public.geometry_columns WHERE f_table_catalog = '{0}' AND f_table_schema = '{1}'{2}"
+    _query_geography_columns_sql = "SELECT f_table_name,f_geography_column,type,srid FROM public.geography_columns WHERE f_table_catalog = '{0}' AND f_table_schema = '{1}'{2}"
+    _query_raster_columns_sql = "SELECT r_table_name,r_raster_column FROM public.raster_columns WHERE r_table_catalog = '{0}' AND r_table_schema = '{1}'{2}"
+
+    _query_bbox_sql = "SELECT '{1}','{2}',public.ST_XMIN(a.bbox), public.ST_YMIN(a.bbox), public.ST_XMAX(a.bbox), public.ST_YMAX(a.bbox) FROM (SELECT public.st_extent(\"{2}\") AS bbox  FROM \"{0}\".\"{1}\") a"
+
+    _query_estimated_bbox_sql = "SELECT '{1}','{2}',public.ST_XMIN(a.bbox), public.ST_YMIN(a.bbox), public.ST_XMAX(a.bbox), public.ST_YMAX(a.bbox) FROM (SELECT public.ST_EstimatedExtent('{0}','{1}','{2}') AS bbox) a"
+
+    def __init__(self,dbUtil,schema):
+        self._dbUtil = dbUtil
+        self._schema = schema
+
+    @staticmethod
+    def _table_filter(column,tables):
+        if tables is None:
+            return ""
+        return " AND {0} in ({1})".format(column,",".join(["'{0}'".format(t) for t in tables]))
+
+    def introspect(self,tables=None):
+        """
+        return a dict between the relation name and its info
+        tables: only introspect the specified relations if not None
+        """
+        if tables is not None and not tables:
+            return {}
+
+        result = {}
+        cursor = None
+        try:
+            cursor = self._dbUtil.cursor()
+
+            #columns
+            relations = {}
+            for row in self._dbUtil.query(self._query_columns_sql.format(self._schema,self._table_filter("c.relname",tables)),cursor):
+                if not self._dbUtil._user_tables(row[0]):
+                    continue
+                relation = relations.get(row[0])
+                if not relation:
+                    relation = {"kind":row[1],"columns":[],"constraints":[],"indexes":[],"viewdef":None,"spatial_info":[[],[],[]]}
+                    relations[row[0]] = relation
+                if row[2]:
+                    relation["columns"].append(row[2:])
+
+            if not relations:
+                return result
+
+            for row in self._dbUtil.query(self._query_constraints_sql.format(self._schema,self._table_filter("c.relname",tables)),cursor):
+                if row[0] in relations:
+                    relations[row[0]]["constraints"].append(row[1:])
+
+            for row in self._dbUtil.query(self._query_indexes_sql.format(self._schema,self._table_filter("c.relname",tables)),cursor):
+                if row[0] in relations:
+                    relations[row[0]]["indexes"].append(row[1])
+
+            for row in self._dbUtil.query(self._query_views_sql.format(self._schema,self._table_filter("c.relname",tables)),cursor):
+                if row[0] in relations:
+                    relations[row[0]]["viewdef"] = row[1]
+
+            #spatial columns, same as SpatialTable._initialize and SpatialTable._retrieve_crs
+            spatial_columns = []
+            for index,sql,table_column in (
+                (0,self._query_geometry_columns_sql,"f_table_name"),
+                (1,self._query_geography_columns_sql,"f_table_name"),
+                (2,self._query_raster_columns_sql,"r_table_name")):
+                for row in self._dbUtil.query(sql.format(self._dbUtil.database,self._schema,self._table_filter(table_column,tables)),cursor):
+                    if row[0] not in relations:
+                        continue
+                    if index == 2:
+                        column = [row[1],None,None,None]
+                    else:
+                        column = [row[1],row[2],None,"EPSG:{}".format(row[3]) if row[3] is not None else settings.DEFAULT_CRS]
+                        spatial_columns.append((row[0],index,column))
+                    relations[row[0]]["spatial_info"][index].append(column)
+
+            #bbox, same as SpatialTable._column_bbox
+            pending_columns = spatial_columns
+            if BorgConfiguration.BBOX_MODE == "estimated":
+                #estimate the bbox of the geometry columns from the planner statistics, null if the statistics are not available
+                geometry_columns = [c for c in spatial_columns if c[1] == 0]
+                bboxes = self._query_bboxes(self._query_estimated_bbox_sql,geometry_columns,cursor)
+                for table,index,column in geometry_columns:
+                    bbox = bboxes.get((table,column[0]))
+                    if bbox and bbox[0] is not None:
+                        column[2] = (bbox[0],bbox[1],bbox[2],bbox[3])
+                pending_columns = [c for c in spatial_columns if c[2][2] is None]
+
+            bboxes = self._query_bboxes(self._query_bbox_sql,pending_columns,cursor)
+            for table,index,column in pending_columns:
+                bbox = bboxes.get((table,column[0]))
+                if bbox and (any(bbox) if index == 0 else bbox[0]):
+                    column[2] = (bbox[0],bbox[1],bbox[2],bbox[3])
+                else:
+                    column[2] = self.DEFAULT_BBOX
+        finally:
+            if cursor:
+                cursor.close()
+
+        for name,relation in relations.items():
+            info = {
+                "type":"Table" if relation["kind"] == "r" else "Views",
+                "spatial_info":json.dumps(relation["spatial_info"]),
+                "sql":_DbUtil.create_table_sql(self._schema,name,relation["kind"],relation["columns"],relation["constraints"],relation["indexes"],relation["viewdef"])
+            }
+            self._update_cache(name,info)
+            result[name] = info
+
+        return result
+
+    def _query_bboxes(self,sql,spatial_columns,cursor):
+        """
+        query the bboxes of the spatial columns with a few union queries
+        return a dict between (table,column) and the bbox row
+        """
+        bboxes = {}
+        for i in range(0,len(spatial_columns),self.BBOX_BATCH_SIZE):
+            batch = spatial_columns[i:i + self.BBOX_BATCH_SIZE]
+            rows = self._dbUtil.query(" UNION ALL ".join([sql.format(self._schema,table,column[0]) for table,index,column in batch]),cursor)
+            bboxes.update(dict([((row[0],row[1]),row[2:]) for row in rows]))
+        return bboxes
+
+    def _update_cache(self,name,info):
+        """
+        keep the cached spatial table consistent with the introspected info
+        """
+        key = (self._dbUtil.id,self._schema,name)
+        o = SpatialTableCache.get(key)
+        if o:
+            o.load(info["spatial_info"])
+        else:
+            o = SpatialTable(self._dbUtil,self._schema,name,spatial_info=info["spatial_info"])
+            SpatialTableCache[key] = o
+        setattr(o,"_create_sql",info["sql"])
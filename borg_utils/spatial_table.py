@@ -1,6 +1,7 @@
 from django.conf import settings
 import os
 from .db_util import defaultDbUtil
+from .borg_config import BorgConfiguration
 import random
 import json
 import traceback
@@ -31,7 +32,14 @@ class SpatialTable(object):
     _create_index_sql = "CREATE INDEX \"{2}\" ON \"{0}\".\"{1}\" USING GIST ({3})"
     _drop_index_sql = "DROP INDEX IF EXISTS \"{0}\".\"{1}\""
 
+    #the placeholder bbox of the spatial column without data
+    DEFAULT_BBOX = (108,-45,155,-10)
+
     _retrieve_bbox_sql = "SELECT public.ST_XMIN(a.bbox), public.ST_YMIN(a.bbox), public.ST_XMAX(a.bbox), public.ST_YMAX(a.bbox) FROM (SELECT public.st_extent(\"{2}\") AS bbox  FROM \"{0}\".\"{1}\") a"
+    _retrieve_estimated_bbox_sql = "SELECT public.ST_XMIN(a.bbox), public.ST_YMIN(a.bbox), public.ST_XMAX(a.bbox), public.ST_YMAX(a.bbox) FROM (SELECT public.ST_EstimatedExtent('{0}','{1}','{2}') AS bbox) a"
+    _retrieve_inserted_bbox_sql = "SELECT public.ST_XMIN(a.bbox), public.ST_YMIN(a.bbox), public.ST_XMAX(a.bbox), public.ST_YMAX(a.bbox) FROM (SELECT public.st_extent(\"{2}\") AS bbox  FROM \"{0}\".\"{1}\" WHERE {3}) a"
+    _check_statistics_sql = "SELECT count(1) FROM pg_catalog.pg_stats WHERE schemaname='{0}' AND tablename='{1}' AND attname='{2}'"
+    _analyze_sql = "ANALYZE \"{0}\".\"{1}\""
     _retrieve_geometry_crs_sql = "SELECT srid FROM public.geometry_columns WHERE f_table_schema='{0}' AND f_table_name='{1}' AND f_geometry_column='{2}';"
     _retrieve_geography_crs_sql = "SELECT srid FROM public.geography_columns WHERE f_table_schema='{0}' AND f_table_name='{1}' AND f_geography_column='{2}';"
 
@@ -144,27 +152,78 @@ class SpatialTable(object):
         if self._bbox_retrieved or self._schema is None:
             return
 
-        if self.geometry_columns:
-            row = None
-            for column in self.geometry_columns:
-                row = self._dbUtil.get(SpatialTable._retrieve_bbox_sql.format(self._schema,self._table,column[0]))
-                if any(row):
-                    column[2] =  (row[0],row[1],row[2],row[3])
-                else:
-                    column[2] =  (108,-45,155,-10)
-                
-        if self.geography_columns:
-            row = None
-            for column in self.geography_columns:
-                row = self._dbUtil.get(SpatialTable._retrieve_bbox_sql.format(self._schema,self._table,column[0]))
-                if row[0]:
-                    column[2] =  (row[0],row[1],row[2],row[3])
-                else:
-                    column[2] =  (108,-45,155,-10)
+        for column in self.geometry_columns:
+            column[2] = self._column_bbox(column[0])
+
+        for column in self.geography_columns:
+            column[2] = self._column_bbox(column[0],geography=True)
+
+        self._spatial_info_desc = None
+        self._spatial_info_version = None
+        self._bbox_retrieved = True
+
+    def _column_bbox(self,column,geography=False):
+        """
+        Return the bbox of the spatial column.
+        If BBOX_MODE is "estimated", the bbox of a geometry column is estimated from the planner statistics, and
+        only computed from the table data if the statistics are not available.
+        """
+        row = None
+        if BorgConfiguration.BBOX_MODE == "estimated" and not geography:
+            row = self._estimated_bbox(column)
+        if row is None:
+            row = self._dbUtil.get(SpatialTable._retrieve_bbox_sql.format(self._schema,self._table,column))
+
+        if (row[0] if geography else any(row)):
+            return (row[0],row[1],row[2],row[3])
+        else:
+            return SpatialTable.DEFAULT_BBOX
+
+    def _estimated_bbox(self,column):
+        """
+        Return the bbox estimated from the planner statistics; return None if not available.
+        The table in the borg database is analyzed first if it has no statistics, analyze only samples the table.
+        """
+        try:
+            if not self._dbUtil.exists(SpatialTable._check_statistics_sql.format(self._schema,self._table,column)):
+                if self._dbUtil is not defaultDbUtil:
+                    return None
+                self._dbUtil.execute(SpatialTable._analyze_sql.format(self._schema,self._table))
+                if not self._dbUtil.exists(SpatialTable._check_statistics_sql.format(self._schema,self._table,column)):
+                    return None
+            row = self._dbUtil.get(SpatialTable._retrieve_estimated_bbox_sql.format(self._schema,self._table,column))
+            return row if row and row[0] is not None else None
+        except:
+            if self._dbUtil is defaultDbUtil:
+                #the transaction is broken, can't fall back to the exact bbox
+                raise
+            return None
+
+    def extend_bbox(self,spatial_info,condition):
+        """
+        Set the bbox of each spatial column to the union of its bbox in the previous spatial info and
+        the extent of the rows matching the condition, which are the rows inserted after the previous spatial info;
+        the bbox is computed from the table data if the column is not in the previous spatial info or
+        its previous bbox is the placeholder of an empty column.
+        The deleted rows are not considered, so the bbox can be larger than the extent of the table data.
+        """
+        previous = SpatialTable(self._dbUtil,None,self._table,spatial_info=spatial_info)
+        for columns,geography in ((self.geometry_columns,False),(self.geography_columns,True)):
+            for column in columns:
+                previous_column = previous._get_spatial_column(column_name=column[0])
+                if not previous_column or not previous_column[2] or tuple(previous_column[2]) == SpatialTable.DEFAULT_BBOX:
+                    column[2] = self._column_bbox(column[0],geography)
+                    continue
+                row = self._dbUtil.get(SpatialTable._retrieve_inserted_bbox_sql.format(self._schema,self._table,column[0],condition))
+                bbox = previous_column[2]
+                if row and row[0] is not None:
+                    bbox = (min(bbox[0],row[0]),min(bbox[1],row[1]),max(bbox[2],row[2]),max(bbox[3],row[3]))
+                column[2] = (bbox[0],bbox[1],bbox[2],bbox[3])
 
         self._spatial_info_desc = None
         self._spatial_info_version = None
         self._bbox_retrieved = True
+        return self
 
     def _retrieve_crs(self):
         if self._crs_retrieved or self._schema is None: 
@@ -199,7 +258,7 @@ class SpatialTable(object):
         if any(row):
             return  (row[0],row[1],row[2],row[3])
         else:
-            return  (108,-45,155,-10)
+            return  SpatialTable.DEFAULT_BBOX
 
     def _get_spatial_column(self,column_name=None,index=None):
         if column_name:
@@ -349,6 +408,14 @@ class SpatialTableMixin(object):
         self.spatialTable(schema=schema,refresh=True,bbox=bbox,crs=crs)
         return self
 
+    def extend_spatial_info(self,schema,condition):
+        """
+        refresh the spatial info, but the bbox is extended with the extent of the inserted rows matching the condition
+        """
+        spatial_info = self.spatial_info
+        self.spatialTable(schema=schema,refresh=True,bbox=False,crs=True).extend_bbox(spatial_info,condition)
+        return self
+
     def create_indexes(self,schema=None):
         self.spatialTable(schema).create_indexes()
 
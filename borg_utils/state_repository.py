@@ -0,0 +1,211 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+import hglib
+
+from borg_utils.borg_config import BorgConfiguration
+
+logger = logging.getLogger(__name__)
+
+class StateRepository(object):
+    """
+    A long-lived service to commit and push the changes of the state repository.
+
+    One mercurial command server is kept open and shared by all callers in the process.
+    By default, the submitted file changes are committed and pushed immediately, and the errors are raised to the caller.
+    In a batch (only used by the harvester), the submitted file changes are queued and committed together,
+    either when the number of queued changes reaches STATE_COMMIT_BATCH_SIZE, or when the changes are pushed;
+    and push is debounced: the changes are pushed after no push is requested in STATE_PUSH_DELAY seconds,
+    but not later than STATE_PUSH_MAX_DELAY seconds after the first request.
+    A forked process never uses the command server or the queued changes of its parent.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance._pid != os.getpid():
+                cls._instance = StateRepository()
+            return cls._instance
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+        self._client = None
+        #list of (file list,message)
+        self._changes = []
+        self._unpushed = 0
+        self._timer = None
+        self._push_requested = None
+        #the delay before retrying a failed debounced push, None if the last push is not failed
+        self._retry_delay = None
+        self._local = threading.local()
+        atexit.register(self._exit)
+
+    @property
+    def in_batch(self):
+        return getattr(self._local,"batch",0) > 0
+
+    @contextmanager
+    def batch(self):
+        """
+        queue the changes submitted by the current thread in the with block, and debounce the push requests.
+        the caller should call sync() after the batch to make sure all the changes are pushed.
+        """
+        self._local.batch = getattr(self._local,"batch",0) + 1
+        try:
+            yield self
+        finally:
+            self._local.batch -= 1
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = hglib.open(BorgConfiguration.BORG_STATE_REPOSITORY)
+        return self._client
+
+    def _reset_client(self):
+        if self._client:
+            try:
+                self._client.close()
+            except:
+                pass
+        self._client = None
+
+    def submit(self,files,message,remove_files=None):
+        """
+        Commit the changed files; the files are queued if in a batch.
+        files: the added or modified files
+        remove_files: the files which should be removed from the repository
+        """
+        with self._lock:
+            if remove_files:
+                try:
+                    self.client.remove(files=remove_files)
+                except hglib.error.CommandError:
+                    self._reset_client()
+                    raise
+            self._changes.append((list(files or []) + list(remove_files or []),message))
+            if not self.in_batch or len(self._changes) >= BorgConfiguration.STATE_COMMIT_BATCH_SIZE:
+                self.commit()
+
+    def commit(self):
+        """
+        commit all queued changes as one changeset; return True if a changeset is committed
+        """
+        with self._lock:
+            if not self._changes:
+                return False
+            files = []
+            for change in self._changes:
+                files.extend([f for f in change[0] if f not in files])
+            messages = [change[1] for change in self._changes]
+            if len(messages) > 1:
+                message = "{0} changes\n\n{1}".format(len(messages),"\n".join(messages))
+            else:
+                message = messages[0]
+
+            try:
+                self.client.commit(include=files,addremove=True,user=BorgConfiguration.BORG_STATE_USER,message=message)
+                self._unpushed += 1
+                committed = True
+            except hglib.error.CommandError as e:
+                if e.out != "nothing changed\n":
+                    self._reset_client()
+                    raise
+                committed = False
+            self._changes = []
+            return committed
+
+    def mark_committed(self,changesets=1):
+        """
+        declare the changesets committed by other mercurial clients, which should be pushed too
+        """
+        with self._lock:
+            self._unpushed += changesets
+
+    def push(self,wait=False):
+        """
+        Request to push the committed changes.
+        if wait is True or not in a batch, commit and push immediately; otherwise the push is debounced.
+        """
+        with self._lock:
+            if wait or not self.in_batch:
+                self._cancel_timer()
+                self._push()
+                return
+
+            now = time.time()
+            if self._push_requested is None:
+                self._push_requested = now
+            if self._retry_delay is not None and self._timer:
+                #a failed push will be retried
+                return
+            self._schedule(min(BorgConfiguration.STATE_PUSH_DELAY,max(0,self._push_requested + BorgConfiguration.STATE_PUSH_MAX_DELAY - now)))
+
+    def _schedule(self,delay):
+        self._cancel_timer()
+        self._timer = threading.Timer(delay,self._timer_push)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def sync(self,force=False):
+        """
+        commit and push all the changes now
+        if force is True, push even if no changeset is committed through this service, for example committed by other processes.
+        """
+        if force:
+            self.mark_committed()
+        self.push(wait=True)
+
+    def _cancel_timer(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _timer_push(self):
+        with self._lock:
+            self._timer = None
+            try:
+                self._push()
+            except:
+                #retry with exponential backoff, but not later than STATE_PUSH_MAX_DELAY seconds
+                self._retry_delay = min(max(1,(self._retry_delay or BorgConfiguration.STATE_PUSH_DELAY) * 2),BorgConfiguration.STATE_PUSH_MAX_DELAY)
+                logger.error("Failed to push the changes to the repository, retry in {0} seconds.".format(self._retry_delay),exc_info=True)
+                self._schedule(self._retry_delay)
+
+    def _push(self):
+        with self._lock:
+            self.commit()
+            self._push_requested = None
+            if self._unpushed <= 0:
+                self._retry_delay = None
+                return
+            if BorgConfiguration.DEBUG:
+                logger.info("Push {0} changesets to the repository".format(self._unpushed))
+            else:
+                logger.debug("Push {0} changesets to the repository".format(self._unpushed))
+            try:
+                if not self.client.push(ssh=BorgConfiguration.BORG_STATE_SSH):
+                    logger.warning("No changesets are pushed to the repository.")
+            except hglib.error.CommandError:
+                self._reset_client()
+                raise
+            self._unpushed = 0
+            self._retry_delay = None
+
+    def _exit(self):
+        if self._pid != os.getpid():
+            return
+        try:
+            if self._changes or self._unpushed or self._timer:
+                self.sync()
+        except:
+            logger.error("Failed to push the changes to the repository before exit.",exc_info=True)
+        finally:
+            self._reset_client()
@@ -0,0 +1,256 @@
+import logging
+
+from django.db import connections
+from django.utils import timezone
+
+from tablemanager.models import Input,Normalise
+from harvest.models import Job
+from harvest.jobstates import JobState,JobStateOutcome,Failed,Completed
+from harvest.harveststates import Waiting,Importing,GeneratingRowID,Normalizing
+from borg_utils.borg_config import BorgConfiguration
+
+logger = logging.getLogger(__name__)
+
+def _execute_node(args):
+    """
+    import or normalise a shared input or normalise if it is not up to date.
+    args is a tuple (batch id, node key, owner job id)
+    return a tuple (outcome, message); outcome is "up_to_date", "executed" or "failed"
+    """
+    batch_id,key,owner_id = args
+    try:
+        o = (Input if key[0] == "input" else Normalise).objects.get(pk=key[1])
+        owner = Job.objects.get(pk=owner_id)
+        if o.is_up_to_date(owner):
+            return ("up_to_date",None)
+        if key[0] == "input":
+            result = o.execute(owner.id)
+            if result and result[0] != JobStateOutcome.succeed:
+                return ("failed",result[1])
+            state = Importing.instance()
+            if o.generate_rowid:
+                o.populate_rowid()
+                state = GeneratingRowID.instance()
+        else:
+            o.execute()
+            state = Normalizing.instance()
+
+        o.job_state = state.name
+        o.job_status = True
+        o.job_message = 'Succeed'
+        o.job_batch_id = batch_id
+        o.job_id = owner.id
+        o.save(update_fields=['job_state','job_status','job_message','job_batch_id','job_id'])
+        return ("executed",None)
+    except:
+        return ("failed",JobState.get_exception_message())
+
+def _execute_node_in_worker(args):
+    """
+    execute a shared input or normalise in a worker process
+    """
+    try:
+        return _execute_node(args)
+    finally:
+        connections.close_all()
+
+class _Node(object):
+    """
+    A input or normalise in the dependency graph of a job batch
+    """
+    def __init__(self,key,obj):
+        self.key = key
+        self.obj = obj
+        self.jobs = []
+        self.dependencies = []
+        self.executed = False
+
+    @property
+    def is_input(self):
+        return self.key[0] == "input"
+
+    @property
+    def shared(self):
+        return len(self.jobs) > 1
+
+    def __str__(self):
+        return "{0}({1})".format(self.key[0],self.obj.name)
+
+class BatchPlanner(object):
+    """
+    Plan and execute the inputs and normalises shared by the waiting jobs of a job batch.
+
+    The dependency graph (Input => Normalise => Publish) of all waiting jobs in the batch is built up front,
+    each shared input and normalise is imported or normalised only once in topological order,
+    and the result is recorded in the same way as the harvest states do, so the dependent jobs treat them as executed by the batch.
+
+    The nodes are executed level by level; the nodes in the same level don't depend on each other,
+    and are executed by the worker processes at the same time if a worker pool is provided.
+
+    Inputs and normalises used by only one job are left to the job itself.
+    A failed input or normalise is not retried by the planner in RETRY_INTERVAL seconds;
+    the dependent jobs execute it again by themselves and report the error.
+    """
+    #the last failed time of the shared inputs and normalises, keyed by (batch_id, node key)
+    _failures = {}
+
+    def __init__(self,batch_id):
+        self.batch_id = batch_id
+        self._nodes = None
+        self._order = None
+
+    def _add_node(self,key,obj,job):
+        node = self._nodes.get(key)
+        if not node:
+            node = _Node(key,obj)
+            self._nodes[key] = node
+            self._order.append(node)
+        if job not in node.jobs:
+            node.jobs.append(job)
+        return node
+
+    def _build(self):
+        """
+        build the dependency graph for all waiting jobs in the batch
+        """
+        self._nodes = {}
+        self._order = []
+        for job in Job.objects.filter(batch_id=self.batch_id,state=Waiting.instance().name).order_by('id'):
+            if not job.publish or job.publish.running > 0 or job.user_action:
+                #the job can't run now
+                continue
+            try:
+                inputs = job.inputs
+                normalises = job.normalises
+            except:
+                #the dependency is incorrect, the job will report the error
+                continue
+
+            for i in inputs:
+                self._add_node(("input",i.id),i,job)
+            for n in normalises:
+                self._add_node(("normalise",n.id),n,job)
+
+        #populate the dependencies
+        for node in self._order:
+            if node.is_input:
+                continue
+            n = node.obj
+            node.dependencies.append(self._nodes[("input",n.input_table_id)])
+            for relation in n.relations:
+                if not relation:
+                    continue
+                for normal_table in relation.normal_tables:
+                    if normal_table and normal_table.normalise:
+                        node.dependencies.append(self._nodes[("normalise",normal_table.normalise.id)])
+
+    def _sorted_nodes(self):
+        """
+        return the shared nodes and their dependencies in topological order
+        """
+        result = []
+        visited = set()
+        def visit(node):
+            if node.key in visited:
+                return
+            visited.add(node.key)
+            for d in node.dependencies:
+                visit(d)
+            result.append(node)
+
+        for node in self._order:
+            if node.shared:
+                visit(node)
+        return result
+
+    def _levels(self):
+        """
+        return the list of node levels; a node only depends on the nodes of the previous levels
+        """
+        levels = []
+        node_levels = {}
+        for node in self._sorted_nodes():
+            level = max([node_levels[d.key] + 1 for d in node.dependencies] or [0])
+            node_levels[node.key] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(node)
+        return levels
+
+    def _used_by_other_batch(self,o):
+        """
+        Return True if the input is executed by a different batch and still used by the unfinished jobs of that batch
+        """
+        if not o.job_batch_id or o.job_batch_id == self.batch_id:
+            return False
+        for j in Job.objects.filter(batch_id = o.job_batch_id).exclude(state__in = [Failed.instance().name,Completed.instance().name]):
+            try:
+                if any(i.id == o.id for i in j.inputs):
+                    return True
+            except:
+                continue
+        return False
+
+    def _can_retry(self,node):
+        failed_time = self._failures.get((self.batch_id,node.key))
+        return not failed_time or (timezone.now() - failed_time).total_seconds() >= BorgConfiguration.RETRY_INTERVAL
+
+    def execute(self,pool=None):
+        """
+        execute all shared inputs and normalises of the batch.
+        pool: the pool of worker processes, which is created on first use; execute in process if None
+        return the number of executed inputs and normalises
+        """
+        self._build()
+        executed = 0
+        for nodes in self._levels():
+            runnable = []
+            for node in nodes:
+                o = node.obj
+                if any(not d.executed for d in node.dependencies):
+                    #some dependency is not executed successfully
+                    continue
+
+                state = Importing.instance() if node.is_input else Normalizing.instance()
+                if o.job_batch_id == self.batch_id:
+                    #already executed by this batch
+                    node.executed = bool(o.job_status) and bool(o.job_state) and (state == JobState.get_jobstate(o.job_state) or state.is_upstate(JobState.get_jobstate(o.job_state)))
+                    continue
+
+                if node.is_input and self._used_by_other_batch(o):
+                    continue
+
+                if not self._can_retry(node):
+                    continue
+
+                logger.debug("Batch({0}) begins to execute the {1} shared by {2} jobs".format(self.batch_id,node,len(node.jobs)))
+                runnable.append(node)
+
+            tasks = [(self.batch_id,node.key,node.jobs[0].id) for node in runnable]
+            if pool and len(tasks) > 1:
+                results = pool.get().map(_execute_node_in_worker,tasks)
+            else:
+                results = [_execute_node(task) for task in tasks]
+
+            for node,(outcome,message) in zip(runnable,results):
+                if outcome == "failed":
+                    self._failures[(self.batch_id,node.key)] = timezone.now()
+                    logger.error("Batch({0}) failed to execute the {1}.{2}".format(self.batch_id,node,message))
+                    continue
+                node.executed = True
+                self._failures.pop((self.batch_id,node.key),None)
+                if outcome == "executed":
+                    executed += 1
+
+        return executed
+
+    @staticmethod
+    def execute_all(pool=None):
+        """
+        execute the shared inputs and normalises for all batches which have waiting jobs.
+        pool: the pool of worker processes, which is created on first use; execute in process if None
+        """
+        executed = 0
+        for batch_id in list(Job.objects.filter(state=Waiting.instance().name).values_list("batch_id",flat=True).distinct()):
+            executed += BatchPlanner(batch_id).execute(pool)
+        return executed
@@ -4,48 +4,119 @@ import time
 import threading
 import logging
 import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from datetime import datetime
 
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection,connections
 from django.utils import timezone
 
 from borg_utils.resource_status import ResourceStatus
+from borg_utils.borg_config import BorgConfiguration
 
 from tablemanager.models import Input
+from harvest.jobstatemachine import JobStatemachine
 
 logger = logging.getLogger(__name__)
 
+def _modify_time(ds):
+    """
+    return the last modify time of the data source; return None if not exist
+    """
+    try:
+        return datetime.utcfromtimestamp(os.path.getmtime(ds)).replace(tzinfo=pytz.UTC)
+    except OSError:
+        return None
+
 class HarvestDatasource(object):
     def __init__(self,check,check_interval,async=False):
         self._check = check
         self._check_interval = check_interval
         self._async = async
 
-    def _harvest_ds_time(self):
-        modify_time = None
-        new_modify_time = None
-        counter = 0
+    @staticmethod
+    def watch_mode():
+        """
+        return "inotify" if the datasources are watched by inotify; otherwise return "poll"
+        """
+        mode = (BorgConfiguration.DS_WATCH_MODE or "auto").lower()
+        if mode == "poll":
+            return "poll"
+        elif pyinotify:
+            return "inotify"
+        elif mode == "inotify":
+            logger.warning("pyinotify is not installed, poll the datasources instead.")
+        return "poll"
+
+    @staticmethod
+    def _datasources(inputs=None):
+        """
+        return a dict between the file based input and its datasource list
+        """
+        if inputs is None:
+            inputs = Input.objects.filter(foreign_table__isnull=True).only("id","name","source","ds_modify_time")
+        return dict([(i,i.datasource or []) for i in inputs])
+
+    @staticmethod
+    def _stat(paths):
+        """
+        return a dict between the path and its last modify time; the stats are executed concurrently
+        """
+        paths = list(set(paths))
+        if len(paths) <= 1 or BorgConfiguration.DS_STAT_CONCURRENCY <= 1:
+            return dict([(p,_modify_time(p)) for p in paths])
+        pool = ThreadPool(min(BorgConfiguration.DS_STAT_CONCURRENCY,len(paths)))
+        try:
+            return dict(zip(paths,pool.map(_modify_time,paths)))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _harvest_ds_time(self,inputs=None):
+        """
+        harvest the last modify time of the datasources of the inputs (all file based inputs if None),
+        and create jobs for the triggered and realtime publishs whose inputs are changed if DS_CREATE_JOBS is True
+        """
         reload_style_counter = 0
         delete_style_counter = 0
-        for i in Input.objects.filter(foreign_table__isnull=True):
+        datasources = self._datasources(inputs)
+        modify_times = self._stat([ds for dss in datasources.values() for ds in dss])
+
+        #group the changed inputs by the new modify time, update each group in one query
+        changes = {}
+        for i,dss in datasources.items():
             new_modify_time = None
-            for ds in i.datasource:
-                if os.path.exists(ds):
-                    modify_time = datetime.utcfromtimestamp(os.path.getmtime(ds)).replace(tzinfo=pytz.UTC)
-                    if new_modify_time:
-                        if new_modify_time < modify_time:
-                            new_modify_time = modify_time
-                    else:
-                        new_modify_time = modify_time
-                else:
+            for ds in dss:
+                modify_time = modify_times[ds]
+                if modify_time is None:
                     new_modify_time = None
                     break
+                elif new_modify_time is None or new_modify_time < modify_time:
+                    new_modify_time = modify_time
             if i.ds_modify_time != new_modify_time:
-                i.ds_modify_time = new_modify_time
-                i.save(update_fields=["ds_modify_time"])
-                counter += 1
-        return (counter,reload_style_counter,delete_style_counter)
+                changes.setdefault(new_modify_time,[]).append(i.pk)
+
+        changed_inputs = []
+        for new_modify_time,ids in changes.items():
+            Input.objects.filter(pk__in=ids).update(ds_modify_time=new_modify_time)
+            changed_inputs += ids
+
+        if changed_inputs and BorgConfiguration.DS_CREATE_JOBS:
+            try:
+                counter = JobStatemachine.create_jobs_by_inputs(changed_inputs)
+                if counter:
+                    logger.info("{0} jobs are created for the changed datasources.".format(counter))
+            except:
+                logger.error("Failed to create jobs for the changed datasources.{0}{1}".format(os.linesep,traceback.format_exc()))
+
+        return (len(changed_inputs),reload_style_counter,delete_style_counter)
 
     def _repeated_harvest(self):
         while(True):
@@ -60,7 +131,7 @@ class HarvestDatasource(object):
 
     def __call__(self):
         self._repeated_harvest();
- 
+
     def harvest(self):
         if not self._check: return None
         if self._check_interval > 0:
@@ -76,5 +147,113 @@ class HarvestDatasource(object):
             #one time job
             return self._harvest_ds_time()
 
+class DatasourceWatcher(HarvestDatasource):
+    """
+    Watch the directories of the file based datasources with inotify, and harvest the changed inputs as soon as possible.
+
+    The events are collected for DS_WATCH_DELAY seconds and the changed inputs are harvested together,
+    so a datasource written by several writes is only harvested once.
+    The inputs are reloaded every DS_WATCH_RELOAD_INTERVAL seconds to watch the new datasources.
+    inotify can't detect the changes made by other hosts on a network file system,
+    so the datasources should still be checked by the periodic harvest.
+    The watcher runs in its own process: the harvest process forks the job worker processes,
+    and a watcher thread holding a lock (e.g. the lock of DependencyGraph or logging) at fork time would deadlock the workers.
+    """
+    MASK = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_ATTRIB) if pyinotify else 0
 
+    def __init__(self):
+        super(DatasourceWatcher,self).__init__(True,0,True)
+        #the dict between datasource path and the input ids
+        self._path_inputs = {}
+        #the dict between input id and its datasources
+        self._input_datasources = {}
+        self._watches = {}
+        self._changed_paths = set()
+        self._first_event = None
+        self._overflow = False
+        self._reloaded = None
+
+    def _on_event(self,event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            #some events are lost, harvest all inputs
+            self._overflow = True
+        elif event.pathname in self._path_inputs:
+            self._changed_paths.add(event.pathname)
+        else:
+            return
+        if self._first_event is None:
+            self._first_event = time.time()
+
+    def _reload(self,wm):
+        """
+        reload the inputs, watch the new directories and harvest the inputs whose datasources are changed
+        """
+        datasources = self._datasources()
+        path_inputs = {}
+        for i,dss in datasources.items():
+            for ds in dss:
+                path_inputs.setdefault(ds,[]).append(i.pk)
+
+        directories = set([os.path.dirname(ds) for ds in path_inputs])
+        for d in [d for d in self._watches if d not in directories]:
+            wm.rm_watch(self._watches.pop(d),quiet=True)
+        for d in [d for d in directories if d not in self._watches and os.path.isdir(d)]:
+            wd = wm.add_watch(d,self.MASK,quiet=True).get(d)
+            if wd is not None and wd >= 0:
+                self._watches[d] = wd
+            else:
+                logger.warning("Failed to watch the directory '{0}'".format(d))
+
+        #the inputs which are new or whose datasources are changed
+        inputs = [i for i,dss in datasources.items() if self._input_datasources.get(i.pk) != dss]
+        self._path_inputs = path_inputs
+        self._input_datasources = dict([(i.pk,dss) for i,dss in datasources.items()])
+        self._reloaded = time.time()
+        if inputs:
+            self._harvest_ds_time(inputs)
+
+    def _harvest_changes(self):
+        if self._overflow:
+            counter = self._harvest_ds_time()
+        else:
+            ids = set([pk for path in self._changed_paths for pk in self._path_inputs.get(path,[])])
+            counter = self._harvest_ds_time(Input.objects.filter(pk__in=ids).only("id","name","source","ds_modify_time"))
+        self._changed_paths.clear()
+        self._first_event = None
+        self._overflow = False
+        if counter[0]:
+            logger.info("{} datasources have been changed.".format(counter[0]))
+
+    def watch(self):
+        wm = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(wm,default_proc_fun=self._on_event,timeout=int(BorgConfiguration.DS_WATCH_DELAY * 1000))
+        try:
+            while(True):
+                try:
+                    if self._reloaded is None or time.time() - self._reloaded >= BorgConfiguration.DS_WATCH_RELOAD_INTERVAL:
+                        self._reload(wm)
+
+                    if notifier.check_events():
+                        notifier.read_events()
+                        notifier.process_events()
+
+                    if self._first_event is not None and time.time() - self._first_event >= BorgConfiguration.DS_WATCH_DELAY:
+                        self._harvest_changes()
+                except:
+                    logger.error("Failed to harvest the changed datasources.{0}{1}".format(os.linesep,traceback.format_exc()))
+                    #the database connection maybe broken, reconnect in the next round
+                    connection.close()
+                    time.sleep(BorgConfiguration.DS_WATCH_DELAY)
+        finally:
+            notifier.stop()
+
+    def __call__(self):
+        self.watch()
 
+    def start(self):
+        #the watcher process can't share the database connections with this process
+        connections.close_all()
+        p = multiprocessing.Process(name="watch_ds",target=self)
+        p.daemon = True
+        p.start()
+        return p
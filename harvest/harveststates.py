@@ -5,7 +5,6 @@ import shutil
 import re
 from io import open
 
-import hglib
 import json
 import requests
 from datetime import datetime
@@ -22,11 +21,20 @@ from harvest.models import Job
 from borg_utils.singleton import SingletonMetaclass,Singleton
 from borg_utils.borg_config import BorgConfiguration
 from borg_utils.utils import file_md5
+from borg_utils.pg_dump import PgDump
+from borg_utils.content_store import ContentStore
+from borg_utils.state_repository import StateRepository
+from borg_utils.catalogue import CatalogueClient
 from borg_utils.resource_status import ResourceStatus
 from harvest.jobstates import JobStateOutcome,JobState,Failed,Completed
 
 logger = logging.getLogger(__name__)
 
+#the catalogue records uploaded in background, key is job id
+_catalogue_records = {}
+#the jobs whose data dump is reused from a previous job
+_reused_dumps = set()
+
 class HarvestStateOutcome(JobStateOutcome):
     """
     Declare all possible harvest job state outcome
@@ -458,14 +466,10 @@ class GenerateLayerAccessRule(HarvestState):
             output.write(latest_data)
 
         # Try and commit to repository, if no changes then continue
-        hg = hglib.open(BorgConfiguration.BORG_STATE_REPOSITORY)
         try:
-            hg.commit(include=[output_filename],addremove=True, user=BorgConfiguration.BORG_STATE_USER, message="{} - layer access rules updated".format(job.publish.job_batch_id))
-        except hglib.error.CommandError as e:
-            if e.out != "nothing changed\n":
-                return (HarvestStateOutcome.failed, self.get_exception_message())
-        finally:
-            hg.close()
+            StateRepository.instance().submit([output_filename],"{} - layer access rules updated".format(job.publish.job_batch_id))
+        except:
+            return (HarvestStateOutcome.failed, self.get_exception_message())
 
         return (JobStateOutcome.succeed, None)
 
@@ -479,13 +483,7 @@ class DumpFullData(HarvestState):
         """
         load settings from djago.conf.settings
         """
-        self.database = settings.DATABASES["default"]
-        self.env = os.environ.copy()
-        self.dump_cmd = ["pg_dump", "-h", self.database["HOST"], "-d", self.database["NAME"], "-U", self.database["USER"], "-b", "-E", "utf-8", "-F", "c","-Z","1", "-w", "-O"]
-        if 'PASSWORD' in self.database and  self.database['PASSWORD'].strip():
-            self.env["PGPASSWORD"] = self.database["PASSWORD"]
-        if self.database["PORT"]:
-            self.dump_cmd += ["-p", str(self.database["PORT"])]
+        self.pg_dump = PgDump(settings.DATABASES["default"])
 
         #import ipdb; ipdb.set_trace()
         if not os.path.exists(BorgConfiguration.FULL_DATA_DUMP_DIR):
@@ -504,6 +502,9 @@ class DumpFullData(HarvestState):
         if 'data' in job.metadict:
             del job.metadict['data']
 
+        _catalogue_records.pop(job.id,None)
+        _reused_dumps.discard(job.id)
+
         #create the dir if required
         if not os.path.exists(job.dump_dir):
             #dump dir does not exist, create it
@@ -511,27 +512,91 @@ class DumpFullData(HarvestState):
 
         file_name = job.publish.table_name + ".db"
         dump_file = os.path.join(job.dump_dir,file_name)
-        cmd = self.dump_cmd + ["-t", job.publish.workspace.publish_data_schema + "." + job.publish.table_name, "-f", dump_file]
 
         cursor=connection.cursor()
+        content_hash = None
+        if BorgConfiguration.DUMP_SKIP_UNCHANGED:
+            content_hash = PgDump.content_hash(cursor,job.publish.workspace.schema,job.publish.table_name)
+            data = self._reuse_previous_dump(job,content_hash,dump_file)
+            if data:
+                job.metadict['data'] = data
+                _reused_dumps.add(job.id)
+                self._upload_catalogue_record(job)
+                return (HarvestStateOutcome.succeed,None)
+
         if not previous_state.is_error_state:
             #table with same name maybe published by previous job. drop it if have.
             cursor.execute('drop table if exists "{0}"."{1}" cascade'.format(job.publish.workspace.publish_data_schema,job.publish.table_name))
         #move table to publish schema for dump
         cursor.execute('alter table "{0}"."{1}" set schema {2}'.format(job.publish.workspace.schema,job.publish.table_name,job.publish.workspace.publish_data_schema))
         try:
-            #import ipdb;ipdb.set_trace()
-            output = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE, env=self.env).communicate()
-            logger.debug("execute ({0})\nstdin:{1}\nstdout:{2}".format(cmd,output[0],output[1]))
+            md5 = self.pg_dump.dump(job.publish.workspace.publish_data_schema,job.publish.table_name,dump_file)
+        except:
+            return (HarvestStateOutcome.failed,self.get_exception_message())
         finally:
             #move table back to original schema
             cursor.execute('alter table "{0}"."{1}" set schema "{2}"'.format(job.publish.workspace.publish_data_schema,job.publish.table_name,job.publish.workspace.schema))
 
-        if output[1].strip() :
-            return (HarvestStateOutcome.failed,output[1])
-        else:
-            job.metadict['data'] = {"file":"{}{}".format(BorgConfiguration.MASTER_PATH_PREFIX, dump_file),"md5":file_md5(dump_file)}
-            return (HarvestStateOutcome.succeed,None)
+        #the data is dumped, upload the meta data to catalogue service while storing the dump file
+        self._upload_catalogue_record(job)
+
+        if ContentStore.is_enabled():
+            dump_file,md5 = ContentStore().put(dump_file,"db",job.manifest_file,md5)
+
+        job.metadict['data'] = {"file":"{}{}".format(BorgConfiguration.MASTER_PATH_PREFIX, dump_file),"md5":md5}
+        if content_hash:
+            job.metadict['data']['content_hash'] = content_hash
+        return (HarvestStateOutcome.succeed,None)
+
+    def _upload_catalogue_record(self,job):
+        """
+        upload the meta data to catalogue service in background if required; UpdateCatalogService waits for the result.
+        only called after the data is dumped, so the catalogue never advertises the data which is not published.
+        The meta data is always uploaded if the data is changed, the publication date is changed.
+        """
+        if job.publish.workspace.publish_channel.sync_geoserver_data and (job.id not in _reused_dumps or job.publish.is_meta_data_changed):
+            meta_data = job.publish.catalogue_metadata({"publication_date":datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")})
+            _catalogue_records[job.id] = CatalogueClient.instance().update_record_async(meta_data,style_content=True)
+
+    def _reuse_previous_dump(self,job,content_hash,dump_file):
+        """
+        If the table content is the same as the one dumped by a previous job, link the previous dump file into the job's dump dir,
+        and return the data meta; otherwise return None
+        """
+        if not content_hash:
+            return None
+        for previous_job in Job.objects.filter(publish=job.publish,id__lt=job.id).exclude(metadata__isnull=True).exclude(metadata="").order_by("-id")[0:BorgConfiguration.DUMP_REUSE_LOOKBACK]:
+            try:
+                data = previous_job.metadict.get('data')
+            except:
+                continue
+            if not data or data.get('content_hash') != content_hash:
+                continue
+            previous_file = data['file'][len(BorgConfiguration.MASTER_PATH_PREFIX):]
+            if not os.path.exists(previous_file):
+                continue
+            try:
+                store = ContentStore()
+                object_name = store.name_of(previous_file)
+                if object_name:
+                    #the dump file is a content store object, reference it from this job's manifest
+                    os.utime(previous_file,None)
+                    store.reference(job.manifest_file,object_name)
+                    dump_file = previous_file
+                else:
+                    if os.path.exists(dump_file):
+                        os.remove(dump_file)
+                    try:
+                        #hard link to keep the dump file after the previous job is cleaned
+                        os.link(previous_file,dump_file)
+                    except OSError:
+                        shutil.copyfile(previous_file,dump_file)
+            except:
+                logger.warning("Failed to reuse the dump file '{0}' of job {1}".format(previous_file,previous_job.id),exc_info=True)
+                return None
+            logger.info("The table '{0}' is not changed since job {1}, reuse the dump file.".format(job.publish.table_name,previous_job.id))
+            return {"file":"{}{}".format(BorgConfiguration.MASTER_PATH_PREFIX, dump_file),"md5":data['md5'],"content_hash":content_hash}
+        return None
 
 class UpdateCatalogService(HarvestState):
     """
@@ -545,7 +610,25 @@ class UpdateCatalogService(HarvestState):
 
     def execute(self,job,previous_state):
         p = job.publish
-        meta_data = p.update_catalogue_service(style_dump_dir=job.dump_dir,md5=True,extra_datas={"publication_date":datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")})
+        store = ContentStore() if ContentStore.is_enabled() else None
+        catalogue_record = _catalogue_records.pop(job.id,None)
+        data_reused = job.id in _reused_dumps
+        _reused_dumps.discard(job.id)
+        #reuse the previous meta file only if both the data and the meta data are not changed
+        if store and data_reused and catalogue_record is None and p.meta_fingerprint and not p.is_meta_data_changed:
+            meta = self._reuse_previous_meta(job,store)
+            if meta:
+                job.metadict['meta'] = meta
+                return (HarvestStateOutcome.succeed,None)
+
+        meta_data = p.update_catalogue_service(style_dump_dir=job.dump_dir,md5=True,extra_datas={"publication_date":datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")},catalogue_record=catalogue_record)
+
+        if store and meta_data.get("styles"):
+            #move the style files into content store
+            for style in meta_data["styles"].values():
+                if "file" in style:
+                    style_file,style["md5"] = store.put(style["file"][len(BorgConfiguration.MASTER_PATH_PREFIX):],"sld",job.manifest_file,style.get("md5"))
+                    style["file"] = "{}{}".format(BorgConfiguration.MASTER_PATH_PREFIX, style_file)
 
         #write meta data file
         file_name = "{}.meta.json".format(p.table_name)
@@ -553,10 +636,51 @@ class UpdateCatalogService(HarvestState):
         with open(meta_file,"wb") as output:
             json.dump(meta_data, output, indent=4)
 
-        job.metadict['meta'] = {"file":"{}{}".format(BorgConfiguration.MASTER_PATH_PREFIX, meta_file),"md5":file_md5(meta_file)}
+        md5 = file_md5(meta_file)
+        if store:
+            meta_file,md5 = store.put(meta_file,"meta.json",job.manifest_file,md5)
+
+        job.metadict['meta'] = {"file":"{}{}".format(BorgConfiguration.MASTER_PATH_PREFIX, meta_file),"md5":md5}
+
+        p.save_meta_fingerprint()
+        if p.meta_fingerprint:
+            job.metadict['meta']['fingerprint'] = p.meta_fingerprint
 
         return (HarvestStateOutcome.succeed,None)
 
+    def _reuse_previous_meta(self,job,store):
+        """
+        If the meta data is not changed since the last completed job, reference the meta file and style files of the last job
+        and return the meta; otherwise return None
+        """
+        previous_job = Job.objects.filter(publish=job.publish,id__lt=job.id,state=Completed.instance().name).order_by("-id").first()
+        if not previous_job:
+            return None
+        try:
+            meta = previous_job.metadict.get('meta')
+            if not meta or meta.get('fingerprint') != job.publish.meta_fingerprint:
+                #the meta data was published by other ways after the job
+                return None
+            meta_file = meta['file'][len(BorgConfiguration.MASTER_PATH_PREFIX):]
+            files = [meta_file]
+            with open(meta_file,"rb") as f:
+                meta_data = json.loads(f.read())
+            for style in (meta_data.get("styles") or {}).values():
+                if "file" in style:
+                    files.append(style["file"][len(BorgConfiguration.MASTER_PATH_PREFIX):])
+            names = [store.name_of(f) for f in files]
+            if not all(names) or not all([os.path.exists(f) for f in files]):
+                return None
+            for f,name in zip(files,names):
+                os.utime(f,None)
+                store.reference(job.manifest_file,name)
+        except:
+            logger.warning("Failed to reuse the meta file of job {0}".format(previous_job.id),exc_info=True)
+            return None
+
+        logger.info("The meta data of publish '{0}' is not changed since job {1}, reuse the meta file.".format(job.publish.name,previous_job.id))
+        return meta
+
 class SubmitToVersionControl(HarvestState):
     """
     The state is for submiting the harvest information to version control system and all slave server can obtain the harvest information and apply all the changes
@@ -587,24 +711,16 @@ class SubmitToVersionControl(HarvestState):
             json.dump(job.metadict, output, indent=4)
 
         # Try and add file to repository, if no changes then continue
-        hg = hglib.open(BorgConfiguration.BORG_STATE_REPOSITORY)
         try:
-            hg.add(files=[file_name])
-
             #remove meta json file and empty gwc json file
             files =[p.output_filename_abs(action) for action in ['meta','empty_gwc'] ]
             files =[ f for f in files if os.path.exists(f)]
-            if files:
-                hg.remove(files=files)
 
-            files.append(file_name)
-
-            hg.commit(include=files,addremove=True, user=BorgConfiguration.BORG_STATE_USER, message="{} - updated {}.{}".format(p.job_batch_id, p.workspace.name, p.name))
-        except hglib.error.CommandError as e:
-            if e.out != "nothing changed\n":
-                return (HarvestStateOutcome.failed, self.get_exception_message())
-        finally:
-            hg.close()
+            StateRepository.instance().submit([file_name],"{} - updated {}.{}".format(p.job_batch_id, p.workspace.name, p.name),remove_files=files)
+            #commit now, the job fails if the changes can't be committed; only the push is deferred
+            StateRepository.instance().commit()
+        except:
+            return (HarvestStateOutcome.failed, self.get_exception_message())
 
         return (HarvestStateOutcome.succeed, None)
 
@@ -629,17 +745,8 @@ class PostCompleted(HarvestState):
         4. set job's "finised"
         """
         if previous_state != Waiting.instance():
-            #push the changes to repository
-            #import ipdb;ipdb.set_trace()
-            hg = hglib.open(BorgConfiguration.BORG_STATE_REPOSITORY)
-            try:
-                if not hg.push(ssh=BorgConfiguration.BORG_STATE_SSH):
-                    logger.warning("push (job_id={0}, job_batch_id={1}, publish={2}) to repository failed.".format(job.id,job.batch_id,job.publish.name))
-
-            except hglib.error.CommandError:
-                return (HarvestStateOutcome.failed, self.get_exception_message())
-            finally:
-                hg.close()
+            #request to push the changes to repository, the changes of the jobs finished at around the same time are pushed together
+            StateRepository.instance().push()
 
         with transaction.atomic():
             p = job.publish
@@ -5,6 +5,8 @@ import logging
 from tablemanager.models import Publish,Input,Normalise
 from harvest.models import Job
 from harvest.jobstates import Completed
+from borg_utils.content_store import ContentStore
+from borg_utils.gdal import prune_cache
 
 class HarvestJobCleaner(object):
     """
@@ -65,4 +67,14 @@ class HarvestJobCleaner(object):
         else:
             self.logger.info("Not find any outdated jobs.")
 
+        #remove the content store objects which are not referenced by the remaining jobs
+        removed_objects = ContentStore().collect_garbage()
+        if removed_objects:
+            self.logger.info("{0} unreferenced objects have been removed from content store.".format(removed_objects))
+
+        #remove the cached ogrinfo outputs which are not used recently
+        removed_files = prune_cache()
+        if removed_files:
+            self.logger.info("{0} outdated ogrinfo cache files have been removed.".format(removed_files))
+
         return deleted_jobs
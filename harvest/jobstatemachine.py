@@ -2,21 +2,69 @@ import logging
 import json
 from datetime import timedelta,datetime
 import time
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
-from django.db import transaction,models
+from django.db import transaction,models,connection,connections
 from django.utils import timezone
 from django.conf import settings
 from django.core.files import File
 
-from tablemanager.models import Publish, Workspace
+from tablemanager.models import Publish, Workspace, Input, DependencyGraph
 from harvest.models import Job,JobLog
 from harvest.jobstates import JobStateOutcome,Failed,Completed,JobState
 from harvest.harveststates import Waiting
+from harvest.batchplanner import BatchPlanner
 from borg_utils.jobintervals import JobInterval
 from borg_utils.borg_config import BorgConfiguration
+from borg_utils.state_repository import StateRepository
+from borg_utils.fingerprint import dispose_engines
 
 logger = logging.getLogger(__name__)
 
+def _run_job_group(args):
+    """
+    run a group of jobs in a worker process.
+    args is a tuple (job ids, first_run)
+    """
+    job_ids,first_run = args
+    try:
+        with StateRepository.instance().batch():
+            return JobStatemachine._run_jobs(Job.objects.filter(pk__in = job_ids).order_by('id'),first_run)
+    finally:
+        connections.close_all()
+        #commit the queued changes, the parent process pushes all the changesets when all groups are finished
+        StateRepository.instance().commit()
+
+class _WorkerPool(object):
+    """
+    A pool of worker processes which is created on first use
+    """
+    def __init__(self,processes):
+        self.processes = processes
+        self._pool = None
+
+    def get(self):
+        if self._pool is None:
+            #worker processes can't share the database connections with the parent process
+            connections.close_all()
+            dispose_engines()
+            self._pool = multiprocessing.Pool(processes=self.processes,maxtasksperchild=1)
+        return self._pool
+
+    def terminate(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def join(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
 class JobStatemachine(object):
     @staticmethod
     def create_job_by_name(publish_name,job_interval=JobInterval.Manually,job_batch_id=None):
@@ -99,37 +147,105 @@ class JobStatemachine(object):
 
         return (True,job.id)
 
+    @staticmethod
+    def _check_inputs(inputs,check_job,concurrency=None):
+        """
+        check whether the inputs are up to date, each input is checked only once.
+        return a dict between input id and the checking result
+        """
+        concurrency = concurrency or BorgConfiguration.REALTIME_CHECK_CONCURRENCY
+
+        def _check(i):
+            try:
+                return (i.pk,i.is_up_to_date(check_job,False))
+            except:
+                logger.error("Failed to check whether the input({0}) is up to date".format(i.name),exc_info=True)
+                return (i.pk,False)
+            finally:
+                if threading.current_thread() is not main_thread:
+                    #the database connection is opened by the worker thread
+                    connection.close()
+
+        main_thread = threading.current_thread()
+        if concurrency <= 1 or len(inputs) <= 1:
+            return dict([_check(i) for i in inputs])
+
+        pool = ThreadPool(min(concurrency,len(inputs)))
+        try:
+            return dict(pool.map(_check,inputs))
+        finally:
+            pool.close()
+            pool.join()
+
     @staticmethod
     def create_jobs(interval_choice,job_batch_id=None):
         """
         create the jobs based on publish status
         All jobs will be sorted agaist with publish.priority
+        For realtime jobs, the inputs shared by publishs are checked only once.
         """
-        job = None
-        log = None
-        jobs = []
         job_batch_id = job_batch_id or interval_choice.job_batch_id()
 
-        check_job = Job(id=-1,batch_id="CK" + job_batch_id) if interval_choice == JobInterval.Realtime else None
-        up_to_date = False
-        
-        for p in Publish.objects.filter(interval = interval_choice.name, waiting = 0).order_by('priority'):
+        publishs = [p for p in Publish.objects.filter(interval = interval_choice.name, waiting = 0).select_related("workspace").order_by('priority') if p.publish_status.publish_enabled]
+
+        if interval_choice == JobInterval.Realtime and publishs:
+            #Realtime publish, check whether input is up to date.
+            check_job = Job(id=-1,batch_id="CK" + job_batch_id)
+            graph = DependencyGraph.get()
+            publish_inputs = {}
+            for p in publishs:
+                try:
+                    publish_inputs[p.pk] = graph.inputs(graph.normalises_of_publish(p.pk),p.input_table_id)
+                except:
+                    logger.error("Failed to find the inputs of publish({0})".format(p.name),exc_info=True)
+                    publish_inputs[p.pk] = None
+
+            inputs = Input.objects.in_bulk(set([i for ids in publish_inputs.values() if ids for i in ids]))
+            results = JobStatemachine._check_inputs(inputs.values(),check_job)
+            #create job for the publishs with any outdated input
+            publishs = [p for p in publishs if publish_inputs[p.pk] is None or not all([results.get(i) for i in publish_inputs[p.pk]])]
+
+        return JobStatemachine._bulk_create_jobs(publishs,job_batch_id,"Create by {0} cron job".format(interval_choice),interval_choice.name)
+
+    @staticmethod
+    def create_jobs_by_inputs(input_ids,job_batch_id=None):
+        """
+        create the jobs for the triggered and realtime publishs which use any of the changed inputs
+        return the number of created jobs
+        """
+        input_ids = set(input_ids)
+        if not input_ids:
+            return 0
+        job_batch_id = job_batch_id or JobInterval.Triggered.job_batch_id()
+
+        graph = DependencyGraph.get()
+        publishs = []
+        for p in Publish.objects.filter(interval__in = [JobInterval.Triggered.name,JobInterval.Realtime.name], waiting = 0).select_related("workspace").order_by('priority'):
             if not p.publish_status.publish_enabled:
-                #publish is disabled, ignore
                 continue
+            try:
+                inputs = graph.inputs(graph.normalises_of_publish(p.pk),p.input_table_id)
+            except:
+                logger.error("Failed to find the inputs of publish({0})".format(p.name),exc_info=True)
+                continue
+            if input_ids & set(inputs):
+                publishs.append(p)
+
+        return JobStatemachine._bulk_create_jobs(publishs,job_batch_id,"Create by datasource change")
 
-            if interval_choice == JobInterval.Realtime:
-                #Realtime publish, check whether input is up to date.
-                up_to_date = True
-                for i in p.inputs:
-                    if not i.is_up_to_date(check_job,False):
-                        #input is not up to date, clear importing info to avoid double check for foreign table.
-                        up_to_date = False
-                        break
-                if up_to_date:
-                    continue
-
-            p.waiting = models.F("waiting") + 1
+    @staticmethod
+    def _bulk_create_jobs(publishs,job_batch_id,message,job_type=None):
+        """
+        create one waiting job for each publish in a few bulk queries
+        job_type is the interval name of the jobs; the publish's interval is used if None
+        return the number of created jobs
+        """
+        if not publishs:
+            return 0
+
+        jobs = []
+        logs = []
+        for p in publishs:
             job = Job(
                         batch_id = job_batch_id,
                         publish = p,
@@ -139,30 +255,30 @@ class JobStatemachine(object):
                         created = timezone.now(),
                         launched = None,
                         finished = None,
-                        job_type = interval_choice.name
+                        job_type = job_type or p.interval
                     )
+            jobs.append(job)
 
-            #add log
-            log = JobLog(
+        with transaction.atomic():
+            Publish.objects.filter(pk__in = [p.pk for p in publishs]).update(waiting = models.F("waiting") + 1)
+            Job.objects.bulk_create(jobs)
+            #bulk_create doesn't set the primary key, query the ids of the created jobs
+            job_ids = dict(Job.objects.filter(batch_id = job_batch_id,publish__in = publishs).values_list("publish_id","id"))
+            now = timezone.now()
+            for p in publishs:
+                #add log
+                logs.append(JobLog(
+                        job_id = job_ids[p.pk],
                         state = "Create",
                         outcome = "Create",
-                        message = "Create by {0} cron job".format(interval_choice),
-                        next_state = job.state,
-                        start_time = timezone.now(),
-                        end_time = timezone.now())
-
-            jobs.append((p,job,log))
-
-        with transaction.atomic():
-            for p,job,log in jobs:
-                p.save(update_fields=['waiting'])
-                job.save()
-                log.job_id = job.id
-                log.save()
+                        message = message,
+                        next_state = Waiting.instance().name,
+                        start_time = now,
+                        end_time = now))
+            JobLog.objects.bulk_create(logs)
 
         return len(jobs)
 
-
     @staticmethod
     def send_user_action(job_id,job_state,user_action):
         """
@@ -187,31 +303,125 @@ class JobStatemachine(object):
             raise Exception("Job is on the state {0} instead of required state {1}".format(job.state, required_state_name))
 
     @staticmethod
-    def run_all_jobs(first_run=True):
+    def _job_group_keys(job):
+        """
+        return the keys of all the resources which can't be harvested by two jobs at the same time.
+        """
+        keys = [("publish",job.publish_id)]
+        try:
+            keys += [("input",i.id) for i in job.inputs]
+            keys += [("normalise",n.id) for n in job.normalises]
+        except:
+            #the dependency is incorrect, run the job separately and let the state machine report the error
+            pass
+        return keys
+
+    @staticmethod
+    def _group_jobs(jobs):
+        """
+        split the jobs into groups.
+        jobs sharing the same publish, input or normalise are put into the same group, and run sequentially;
+        jobs in different groups are independent and can run at the same time.
+        return a list of job id list sorted by the first job's id.
+        """
+        parents = {}
+        def find(key):
+            while parents[key] != key:
+                parents[key] = parents[parents[key]]
+                key = parents[key]
+            return key
+
+        job_keys = []
+        for j in jobs:
+            keys = JobStatemachine._job_group_keys(j)
+            for key in keys:
+                if key not in parents:
+                    parents[key] = key
+            root = find(keys[0])
+            for key in keys[1:]:
+                parents[find(key)] = root
+            job_keys.append((j.id,keys[0]))
+
+        groups = {}
+        for job_id,key in job_keys:
+            groups.setdefault(find(key),[]).append(job_id)
+
+        return sorted(groups.values(),key=lambda g:g[0])
+
+    @staticmethod
+    def _run_jobs(jobs,first_run=True):
         """
-        run all jobs sequentially
+        run the jobs sequentially
+        return a list [succeed_jobs,failed_jobs,ignored_jobs,error_jobs]
         """
-        succeed_jobs = 0
-        failed_jobs = 0
-        ignored_jobs = 0
-        error_jobs = 0
-        for j in Job.objects.exclude(state__in = [Failed.instance().name,Completed.instance().name]).order_by('id'):
+        result = [0,0,0,0]
+        for j in jobs:
             try:
                 JobStatemachine.run(j,first_run)
                 if j.state == "Completed":
                     if j.launched is None:
-                        ignored_jobs += 1
+                        result[2] += 1
                     else:
-                        succeed_jobs += 1
+                        result[0] += 1
                 elif j.state == "Failed":
-                    failed_jobs += 1
+                    result[1] += 1
                 else:
-                    error_jobs += 1
+                    result[3] += 1
             except:
                 logger.error("job(id={0},name={1}) runs into a exception{2}".format(j.id,j.publish.name,JobState.get_exception_message()))
-                error_jobs += 1
+                result[3] += 1
+
+        return result
+
+    @staticmethod
+    def run_all_jobs(first_run=True,concurrency=None):
+        """
+        run all jobs.
+        if batch planning is enabled, the inputs and normalises shared by the waiting jobs of a batch are executed first.
+        if concurrency is greater than 1, independent jobs are run by a pool of worker processes at the same time;
+        otherwise run all jobs sequentially
+        """
+        concurrency = concurrency or BorgConfiguration.MAX_CONCURRENT_JOBS
+        pool = _WorkerPool(concurrency) if concurrency > 1 else None
+        try:
+            if BorgConfiguration.PLAN_BATCH_JOBS:
+                #execute the shared inputs and normalises only once for each batch, the independent ones are executed by the worker processes at the same time
+                BatchPlanner.execute_all(pool)
 
-        return (succeed_jobs,failed_jobs,ignored_jobs,error_jobs)
+            jobs = Job.objects.exclude(state__in = [Failed.instance().name,Completed.instance().name]).order_by('id')
+            if pool is None:
+                return JobStatemachine._run_jobs_in_process(jobs,first_run)
+
+            groups = JobStatemachine._group_jobs(jobs)
+            if len(groups) <= 1:
+                return JobStatemachine._run_jobs_in_process(jobs,first_run)
+
+            logger.debug("Run {0} jobs in {1} groups with {2} worker processes".format(sum([len(g) for g in groups]),len(groups),concurrency))
+            result = [0,0,0,0]
+            try:
+                for group_result in pool.get().imap_unordered(_run_job_group,[(g,first_run) for g in groups]):
+                    result = [x + y for x,y in zip(result,group_result)]
+            finally:
+                #push the changesets committed by the worker processes
+                StateRepository.instance().sync(force=True)
+
+            return tuple(result)
+        except:
+            if pool:
+                pool.terminate()
+            raise
+        finally:
+            if pool:
+                pool.join()
+
+    @staticmethod
+    def _run_jobs_in_process(jobs,first_run):
+        try:
+            with StateRepository.instance().batch():
+                return tuple(JobStatemachine._run_jobs(jobs,first_run))
+        finally:
+            #push the changes of all jobs at once
+            StateRepository.instance().sync()
 
     @staticmethod
     def run_job(job_id,step=False):
@@ -13,7 +13,8 @@ from borg_utils.jobintervals import JobInterval
 from harvest.jobstatemachine import JobStatemachine
 from harvest.models import Process
 from harvest.jobcleaner import HarvestJobCleaner
-from harvest.harvest_ds import HarvestDatasource
+from harvest.harvest_ds import HarvestDatasource,DatasourceWatcher
+from borg_utils.borg_config import BorgConfiguration
 
 logger = logging.getLogger(__name__)
 
@@ -139,7 +140,7 @@ class HarvestJob(RepeatedJob):
 
     def execute(self,time):
         try:
-            return JobStatemachine.run_all_jobs(self._first_run)
+            return JobStatemachine.run_all_jobs(self._first_run,self._options["concurrency"])
         finally:
             self._first_run = False
 
@@ -199,6 +200,13 @@ class Command(BaseCommand):
             help='Enable running harvest job feature.'
         ),
 
+        make_option(
+            '--concurrency',
+            action='store',
+            dest='concurrency',
+            help='The number of worker processes used to run harvest jobs; default is the configured MAX_CONCURRENT_JOBS'
+        ),
+
         make_option(
             '--check-ds',
             action='store_true',
@@ -248,11 +256,21 @@ class Command(BaseCommand):
 
         #add run jobs;
         if options["run_job"]:
-            jobs.append(HarvestJob(JobInterval.Minutely))
+            if options['concurrency']:
+                try:
+                    options['concurrency'] = int(options['concurrency'])
+                    if options['concurrency'] <= 0:
+                        options['concurrency'] = None
+                except:
+                    options['concurrency'] = None
+            jobs.append(HarvestJob(JobInterval.Minutely,options))
 
         #check datasource
         if options["check_ds"]:
-            jobs.append(CheckDsJob(JobInterval.Hourly))
+            if HarvestDatasource.watch_mode() == "inotify":
+                #detect the local changes immediately, the periodic check is still required for the changes made on other hosts
+                DatasourceWatcher().start()
+            jobs.append(CheckDsJob(JobInterval.get_interval(BorgConfiguration.DS_CHECK_INTERVAL)))
 
         #clean outdated jobs
         if options["clean_job"] or options["clean_job_now"]:
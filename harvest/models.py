@@ -131,6 +131,16 @@ class Job(models.Model):
         else:
             return None
 
+    @property
+    def manifest_file(self):
+        """
+        the file listing the content store objects used by this job
+        """
+        if self.publish:
+            return os.path.join(self.dump_dir,self.publish.table_name + ".manifest.json")
+        else:
+            return None
+
     def __str__(self):
         return str(self.pk)
 
@@ -1,14 +1,15 @@
 import os
 import json
 import logging
-import itertools
 import hglib
 import re
-import requests
+import time
+import threading
 from datetime import datetime
 
 from django.db import transaction
 from django.db import models
+from django.db import connection
 from django.utils import timezone
 from django.utils.six import with_metaclass
 from django.utils import timezone
@@ -25,6 +26,7 @@ from borg_utils.resource_status import ResourceStatus,ResourceStatusMixin,Resour
 from borg_utils.transaction import TransactionMixin
 from borg_utils.signals import refresh_select_choices
 from borg_utils.hg_batch_push import try_set_push_owner, try_clear_push_owner, increase_committed_changes, try_push_to_repository
+from borg_utils.catalogue import CatalogueClient
 from borg_utils.utils import file_md5
 
 logger = logging.getLogger(__name__)
@@ -104,30 +106,13 @@ class LayerGroup(models.Model,ResourceStatusMixin,TransactionMixin):
         finally:
             self.try_clear_transaction("layergroup_delete")
 
-    def check_circular_dependency(self,editing_group_layer=None,parents=None):
+    def check_circular_dependency(self,editing_group_layer=None):
         """
         check whether it has some cycle dependencies.
         """
-        if parents:
-            parents.append(self)
-        else:
-            parents = [self]
+        LayerGroupGraph.get().check_circular_dependency(self.pk,editing_group_layer)
 
-        queryset = LayerGroupLayers.objects.filter(group = self)
-        if editing_group_layer :
-            if editing_group_layer.pk:
-                queryset = queryset.exclude(pk = editing_group_layer.pk)
-            queryset = itertools.chain(queryset,[editing_group_layer])
-
-        for group_layer in queryset:
-            if group_layer.sub_group:
-                if group_layer.sub_group in parents:
-                    #cycle dependency found
-                    raise ValidationError("Found a circular dependency:{0}".format("=>".join([g.name for g in parents + [group_layer.sub_group]])))
-                else:
-                    group_layer.sub_group.check_circular_dependency(None,parents)
-
-    def get_inclusions(self,editing_group_layer=None, check_multi_inclusion = True, included_publishs=None, included_layers=None, included_groups=None):
+    def get_inclusions(self,editing_group_layer=None, check_multi_inclusion = True):
         """
         Get all included layers and sub groups.
         If in editing mode, editing_group_layer should be the edting layer gorup
@@ -137,52 +122,19 @@ class LayerGroup(models.Model,ResourceStatusMixin,TransactionMixin):
             second element is a dictionary between included layers and its immediately including group; 
             third element is a dictionary between included groups and its immediately including group;
         """
-        if not included_publishs:
-            included_publishs = {}
-
-        if not included_layers:
-            included_layers = {}
+        inclusions = LayerGroupGraph.get().inclusions(self.pk,editing_group_layer,check_multi_inclusion)
 
-        if not included_groups:
-            included_groups = {}
+        #load all the including group layers in one query
+        group_layer_ids = set([group_layer_id for included in inclusions for group_layer_id in included.values()])
+        if editing_group_layer:
+            group_layer_ids.discard(editing_group_layer.pk)
+        group_layers = LayerGroupLayers.objects.select_related("group","layer","publish","sub_group__workspace").in_bulk(group_layer_ids)
+        if editing_group_layer:
+            group_layers[editing_group_layer.pk] = editing_group_layer
 
-        queryset = LayerGroupLayers.objects.filter(group = self)
-        if editing_group_layer :
-            if editing_group_layer.pk:
-                queryset = queryset.exclude(pk = editing_group_layer.pk)
-            queryset = itertools.chain(queryset,[editing_group_layer])
-
-        for group_layer in queryset:
-            if group_layer.publish:
-                if check_multi_inclusion and group_layer.publish in included_publishs:
-                    if included_publishs[group_layer.publish].group == group_layer.group:
-                        raise ValidationError("Found multiple inclusion:Publish {0} is already included by {1}".format(group_layer.publish.name,included_publishs[group_layer.publish].group.name))
-                    else:
-                        raise ValidationError("Found multiple inclusion:Publish {0} is included by {1} and {2}".format(group_layer.publish.name,included_publishs[group_layer.publish].group.name,group_layer.group.name))
-                else:
-                    included_publishs[group_layer.publish] = group_layer
-
-            elif group_layer.layer:
-                if check_multi_inclusion and group_layer.layer in included_layers:
-                    if included_layers[group_layer.layer].group == group_layer.group:
-                        raise ValidationError("Found multiple inclusion:Layer {0} is already included by {1}".format(group_layer.layer.name,included_layers[group_layer.layer].group.name))
-                    else:
-                        raise ValidationError("Found multiple inclusion:Layer {0} is included by {1} and {2}".format(group_layer.layer.name,included_layers[group_layer.layer].group.name,group_layer.group.name))
-                else:
-                    included_layers[group_layer.layer] = group_layer
-
-            elif group_layer.sub_group:
-                if check_multi_inclusion and group_layer.sub_group in included_groups:
-                    if included_groups[group_layer.sub_group].group == group_layer.group:
-                        raise ValidationError("Found multiple inclusion:sub group {0} is already included by {1}".format(group_layer.sub_group.name,included_groups[group_layer.sub_group].group.name))
-                    else:
-                        raise ValidationError("Found multiple inclusion:sub group {0} is included by {1} and {2}".format(group_layer.sub_group.name,included_groups[group_layer.sub_group].group.name,group_layer.group.name))
-                else:
-                    included_groups[group_layer.sub_group] = group_layer
-                    sub_inclusion = group_layer.sub_group.get_inclusions(None,check_multi_inclusion,included_publishs,included_layers,included_groups)
-                    included_publishs.update(sub_inclusion[0])
-                    included_layers.update(sub_inclusion[1])
-                    included_groups.update(sub_inclusion[2])
+        included_publishs = dict([(group_layers[group_layer_id].publish,group_layers[group_layer_id]) for group_layer_id in inclusions[0].values()])
+        included_layers = dict([(group_layers[group_layer_id].layer,group_layers[group_layer_id]) for group_layer_id in inclusions[1].values()])
+        included_groups = dict([(group_layers[group_layer_id].sub_group,group_layers[group_layer_id]) for group_layer_id in inclusions[2].values()])
 
         return (included_publishs,included_layers,included_groups)
         
@@ -224,11 +176,7 @@ class LayerGroup(models.Model,ResourceStatusMixin,TransactionMixin):
         meta_data = self.builtin_metadata
         if extra_datas:
             meta_data.update(extra_datas)
-        res = requests.post("{}/catalogue/api/records/".format(settings.CSW_URL),json=meta_data,auth=(settings.CSW_USER,settings.CSW_PASSWORD))
-        if 400 <= res.status_code < 600 and res.content:
-            res.reason = "{}({})".format(res.reason,res.content)
-        res.raise_for_status()
-        meta_data = res.json()
+        meta_data = CatalogueClient.instance().update_record(meta_data)
 
         #add extra data to meta data
         meta_data["workspace"] = self.workspace.name
@@ -253,9 +201,7 @@ class LayerGroup(models.Model,ResourceStatusMixin,TransactionMixin):
         unpublish layer group
         """
         #remove it from catalogue service
-        res = requests.delete("{}/catalogue/api/records/{}:{}/".format(settings.CSW_URL,self.workspace.name,self.name),auth=(settings.CSW_USER,settings.CSW_PASSWORD))
-        if res.status_code != 404:
-            res.raise_for_status()
+        CatalogueClient.instance().delete_record(self.workspace.name,self.name)
 
         json_filename = self.json_filename_abs('unpublish');
 
@@ -493,6 +439,134 @@ class LayerGroupLayers(models.Model,TransactionMixin):
         verbose_name_plural="Layer group layers"
 
 
+class LayerGroupGraph(object):
+    """
+    The process wide cache of the layer group inclusions.
+
+    The graph only keeps the ids, and is loaded by two queries.
+    It is invalidated by the post save and post delete signals of LayerGroup and LayerGroupLayers in this process;
+    the changes made by other processes are detected by a signature query,
+    which is executed at most once every DEPENDENCY_GRAPH_CHECK_INTERVAL seconds.
+    """
+    _signature_sql = (
+        "SELECT md5(concat_ws('|',"
+        "(SELECT string_agg(CAST(ROW(id,name) AS text),';' ORDER BY id) FROM \"{0}\"),"
+        "(SELECT string_agg(CAST(ROW(id,group_id,layer_id,publish_id,sub_group_id,\"order\") AS text),';' ORDER BY id) FROM \"{1}\")));"
+    )
+
+    _lock = threading.Lock()
+    _graph = None
+    _checked = None
+
+    def __init__(self,signature):
+        self.signature = signature
+        self.group_names = dict(LayerGroup.objects.values_list("id","name"))
+        #the dict between group id and the list of its group layers (id,layer_id,publish_id,sub_group_id) sorted by order
+        self.group_layers = {}
+        for row in LayerGroupLayers.objects.order_by("group","order").values_list("id","group_id","layer_id","publish_id","sub_group_id"):
+            self.group_layers.setdefault(row[1],[]).append((row[0],row[2],row[3],row[4]))
+
+    @classmethod
+    def get(cls):
+        """
+        return the up to date layer group graph
+        """
+        with cls._lock:
+            now = time.time()
+            if cls._graph and cls._checked and now - cls._checked < BorgConfiguration.DEPENDENCY_GRAPH_CHECK_INTERVAL:
+                return cls._graph
+
+            cursor = connection.cursor()
+            try:
+                cursor.execute(cls._signature_sql.format(LayerGroup._meta.db_table,LayerGroupLayers._meta.db_table))
+                signature = cursor.fetchone()[0]
+            finally:
+                cursor.close()
+
+            if not cls._graph or cls._graph.signature != signature:
+                cls._graph = LayerGroupGraph(signature)
+            cls._checked = now
+            return cls._graph
+
+    @classmethod
+    def invalidate(cls):
+        with cls._lock:
+            cls._graph = None
+            cls._checked = None
+
+    def _group_layers(self,group_id,editing_group_layer=None):
+        group_layers = self.group_layers.get(group_id) or []
+        if editing_group_layer:
+            if editing_group_layer.pk:
+                group_layers = [l for l in group_layers if l[0] != editing_group_layer.pk]
+            group_layers = group_layers + [(editing_group_layer.pk,editing_group_layer.layer_id,editing_group_layer.publish_id,editing_group_layer.sub_group_id)]
+        return group_layers
+
+    def _group_name(self,group_id):
+        return self.group_names.get(group_id) or LayerGroup.objects.get(pk=group_id).name
+
+    def _object_name(self,model,object_id):
+        if model is LayerGroup:
+            return self._group_name(object_id)
+        return model.objects.get(pk=object_id).name
+
+    def check_circular_dependency(self,group_id,editing_group_layer=None,parents=None):
+        """
+        check whether the group has some cycle dependencies, same as the recursive check on the database.
+        """
+        parents = (parents or []) + [group_id]
+        for group_layer in self._group_layers(group_id,editing_group_layer):
+            sub_group_id = group_layer[3]
+            if not sub_group_id:
+                continue
+            if sub_group_id in parents:
+                #cycle dependency found
+                raise ValidationError("Found a circular dependency:{0}".format("=>".join([self._group_name(g) for g in parents + [sub_group_id]])))
+            self.check_circular_dependency(sub_group_id,None,parents)
+
+    def _check_multi_inclusion(self,model,desc,included,target_id,group_id):
+        """
+        raise ValidationError if the target is already included
+        """
+        if target_id not in included:
+            return
+        name = self._object_name(model,target_id)
+        included_group_id = included[target_id][1]
+        if included_group_id == group_id:
+            raise ValidationError("Found multiple inclusion:{0} {1} is already included by {2}".format(desc,name,self._group_name(included_group_id)))
+        else:
+            raise ValidationError("Found multiple inclusion:{0} {1} is included by {2} and {3}".format(desc,name,self._group_name(included_group_id),self._group_name(group_id)))
+
+    def inclusions(self,group_id,editing_group_layer=None,check_multi_inclusion=True):
+        """
+        Return a three elements tuple:
+            first element is a dictionary between included publish id and the id of its immediately including group layer;
+            second element is a dictionary between included layer id and the id of its immediately including group layer;
+            third element is a dictionary between included group id and the id of its immediately including group layer;
+        the id of the editing group layer is used for the editing group layer, which is None for a new group layer.
+        """
+        #the value is (group layer id,group id) during traversing
+        included = ({},{},{})
+        self._collect_inclusions(group_id,editing_group_layer,check_multi_inclusion,included)
+        return tuple([dict([(k,v[0]) for k,v in d.items()]) for d in included])
+
+    def _collect_inclusions(self,group_id,editing_group_layer,check_multi_inclusion,included):
+        for group_layer in self._group_layers(group_id,editing_group_layer):
+            group_layer_id,layer_id,publish_id,sub_group_id = group_layer
+            if publish_id:
+                if check_multi_inclusion:
+                    self._check_multi_inclusion(Publish,"Publish",included[0],publish_id,group_id)
+                included[0][publish_id] = (group_layer_id,group_id)
+            elif layer_id:
+                if check_multi_inclusion:
+                    self._check_multi_inclusion(WmsLayer,"Layer",included[1],layer_id,group_id)
+                included[1][layer_id] = (group_layer_id,group_id)
+            elif sub_group_id:
+                if check_multi_inclusion:
+                    self._check_multi_inclusion(LayerGroup,"sub group",included[2],sub_group_id,group_id)
+                included[2][sub_group_id] = (group_layer_id,group_id)
+                self._collect_inclusions(sub_group_id,None,check_multi_inclusion,included)
+
 class LayerGroupEventListener(object):
     @staticmethod
     @receiver(pre_delete, sender=LayerGroup)
@@ -506,6 +580,7 @@ class LayerGroupEventListener(object):
     @staticmethod
     @receiver(post_delete, sender=LayerGroup)
     def _post_delete(sender, instance, **args):
+        LayerGroupGraph.invalidate()
         refresh_select_choices.send(instance,choice_family="layergroup")
 
     @staticmethod
@@ -560,6 +635,9 @@ class LayerGroupEventListener(object):
     @staticmethod
     @receiver(post_save, sender=LayerGroup)
     def _post_save(sender, instance, **args):
+        if not args.get("update_fields") or "name" in args["update_fields"]:
+            LayerGroupGraph.invalidate()
+
         if (hasattr(instance,"new_object") and getattr(instance,"new_object")):
             delattr(instance,"new_object")
             refresh_select_choices.send(instance,choice_family="layergroup")
@@ -577,6 +655,7 @@ class LayerGroupLayersEventListener(object):
     @staticmethod
     @receiver(post_delete, sender=LayerGroupLayers)
     def _post_delete(sender, instance, **args):
+        LayerGroupGraph.invalidate()
         if instance.is_current_transaction("layer_delete"):
             #trigged by itself
             instance.group.status = instance.group.next_status(ResourceAction.UPDATE)
@@ -586,6 +665,7 @@ class LayerGroupLayersEventListener(object):
     @staticmethod
     @receiver(post_save, sender=LayerGroupLayers)
     def _post_save(sender, instance, **args):
+        LayerGroupGraph.invalidate()
         if instance.is_current_transaction("layer_save"):
             instance.group.status = instance.group.next_status(ResourceAction.UPDATE)
             instance.group.last_modify_time = timezone.now()
@@ -0,0 +1,86 @@
+from django.test import SimpleTestCase
+from django.core.exceptions import ValidationError
+
+from layergroup.models import LayerGroupGraph
+
+class _LayerGroupGraph(LayerGroupGraph):
+    """
+    the layer group graph built from hand-made id dicts instead of the database
+    """
+    def __init__(self,group_layers):
+        self.signature = None
+        self.group_names = dict([(g,"group{0}".format(g)) for g in group_layers])
+        #the dict between group id and the list of its group layers (id,layer_id,publish_id,sub_group_id)
+        self.group_layers = group_layers
+
+    def _object_name(self,model,object_id):
+        return "{0}{1}".format(model.__name__.lower(),object_id)
+
+class _EditingGroupLayer(object):
+    def __init__(self,pk,layer_id=None,publish_id=None,sub_group_id=None):
+        self.pk = pk
+        self.layer_id = layer_id
+        self.publish_id = publish_id
+        self.sub_group_id = sub_group_id
+
+class LayerGroupGraphTest(SimpleTestCase):
+    """
+    group 1 includes publish 11, layer 21 and group 2; group 2 includes publish 12 and group 3; group 3 includes layer 22.
+    """
+    def _graph(self,extra=None):
+        group_layers = {
+            1:[(101,None,11,None),(102,21,None,None),(103,None,None,2)],
+            2:[(201,None,12,None),(202,None,None,3)],
+            3:[(301,22,None,None)],
+        }
+        group_layers.update(extra or {})
+        return _LayerGroupGraph(group_layers)
+
+    def test_inclusions(self):
+        publishs,layers,groups = self._graph().inclusions(1)
+        self.assertEqual(publishs,{11:101,12:201})
+        self.assertEqual(layers,{21:102,22:301})
+        self.assertEqual(groups,{2:103,3:202})
+
+    def test_inclusions_of_sub_group(self):
+        self.assertEqual(self._graph().inclusions(2),({12:201},{22:301},{3:202}))
+
+    def test_inclusions_with_editing_group_layer(self):
+        graph = self._graph()
+        #replace the layer 21 with the publish 13
+        publishs,layers,groups = graph.inclusions(1,_EditingGroupLayer(102,publish_id=13))
+        self.assertEqual(publishs,{11:101,12:201,13:102})
+        self.assertEqual(layers,{22:301})
+        #a new group layer has no id
+        publishs,layers,groups = graph.inclusions(3,_EditingGroupLayer(None,publish_id=14))
+        self.assertEqual(publishs,{14:None})
+
+    def test_multiple_inclusion_in_same_group(self):
+        graph = self._graph({3:[(301,22,None,None),(302,22,None,None)]})
+        with self.assertRaises(ValidationError) as cm:
+            graph.inclusions(1)
+        self.assertEqual(cm.exception.messages[0],"Found multiple inclusion:Layer wmslayer22 is already included by group3")
+
+    def test_multiple_inclusion_in_different_groups(self):
+        graph = self._graph({3:[(301,22,None,None),(302,None,11,None)]})
+        with self.assertRaises(ValidationError) as cm:
+            graph.inclusions(1)
+        self.assertEqual(cm.exception.messages[0],"Found multiple inclusion:Publish publish11 is included by group1 and group3")
+        #the multiple inclusion check can be disabled
+        publishs,layers,groups = graph.inclusions(1,check_multi_inclusion=False)
+        self.assertEqual(publishs,{11:302,12:201})
+
+    def test_no_circular_dependency(self):
+        self._graph().check_circular_dependency(1)
+
+    def test_circular_dependency(self):
+        graph = self._graph({3:[(301,22,None,None),(302,None,None,1)]})
+        with self.assertRaises(ValidationError) as cm:
+            graph.check_circular_dependency(1)
+        self.assertEqual(cm.exception.messages[0],"Found a circular dependency:group1=>group2=>group3=>group1")
+
+    def test_circular_dependency_with_editing_group_layer(self):
+        graph = self._graph()
+        with self.assertRaises(ValidationError) as cm:
+            graph.check_circular_dependency(3,_EditingGroupLayer(None,sub_group_id=1))
+        self.assertEqual(cm.exception.messages[0],"Found a circular dependency:group3=>group1=>group2=>group3")
@@ -6,7 +6,6 @@ import shutil
 import os
 import hglib
 from datetime import datetime
-import requests
 
 from django.conf import settings
 from django.db import models
@@ -24,10 +23,12 @@ from borg_utils.resource_status import ResourceStatus,ResourceStatusMixin,Resour
 from borg_utils.transaction import TransactionMixin
 from borg_utils.db_util import DbUtil
 from borg_utils.spatial_table import SpatialTableMixin
+from borg_utils.schema_introspector import SchemaIntrospector
 from borg_utils.signals import inherit_support_receiver
 from borg_utils.models import BorgModel,SQLField
 from borg_utils.utils import file_md5
 from borg_utils.hg_batch_push import try_set_push_owner, try_clear_push_owner, increase_committed_changes, try_push_to_repository
+from borg_utils.catalogue import CatalogueClient
 
 logger = logging.getLogger(__name__)
 
@@ -136,29 +137,40 @@ class Datasource(BorgModel,ResourceStatusMixin,TransactionMixin):
     def refresh(self):
         self.try_begin_transaction("datasource_refresh")
         try:
-            #modify the table data
+            #introspect the filtered tables and views in a few queries
             now = timezone.now()
-            tables = self.dbUtil.get_all_tables(self.schema)
-            views = self.dbUtil.get_all_views(self.schema)
+            table_names = [t for t in self.dbUtil.get_all_tables(self.schema) + self.dbUtil.get_all_views(self.schema) if self.filter_table(t) and not Layer.is_system_table(t)]
+            tables = SchemaIntrospector(self.dbUtil,self.schema).introspect(table_names)
             now = timezone.now()
 
-        
-            #refresh tables and views
-            for typename, tables in [["Table", tables],["Views", views]]:
-                for table_name in tables:
-                    if not self.filter_table(table_name):
-                        continue
-                    layer, created = Layer.objects.get_or_create(datasource=self, 
-                        table=table_name, 
-                        defaults={
-                            "type": typename, 
-                            "last_refresh_time": now,
-                            "geoserver_setting":default_layer_geoserver_setting_json,
-                            "status":ResourceStatus.New.name
-                        }
-                    )
-                    layer.refresh(now)
-            
+            #refresh tables and views, only save the changed layers
+            layers = dict([(layer.table,layer) for layer in Layer.objects.filter(datasource=self)])
+            new_layers = []
+            unchanged_layers = []
+            for table_name,info in tables.items():
+                layer = layers.get(table_name)
+                if not layer:
+                    new_layers.append(Layer(
+                        datasource=self,
+                        table=table_name,
+                        type=info["type"],
+                        spatial_info=info["spatial_info"],
+                        sql=info["sql"],
+                        geoserver_setting=default_layer_geoserver_setting_json,
+                        status=ResourceStatus.New.name,
+                        last_refresh_time=now,
+                        last_modify_time=now
+                    ))
+                elif layer.apply_table_info(info,now):
+                    layer.save()
+                else:
+                    unchanged_layers.append(layer.pk)
+
+            if new_layers:
+                Layer.objects.bulk_create(new_layers)
+            if unchanged_layers:
+                Layer.objects.filter(pk__in=unchanged_layers).update(last_refresh_time=now)
+
             Layer.objects.filter(datasource=self).exclude(last_refresh_time=now).delete()
 
             for viewlayer in self.sqlviewlayer_set.all():
@@ -328,19 +340,30 @@ class Layer(BorgModel,ResourceStatusMixin,TransactionMixin,SpatialTableMixin):
             time = time or timezone.now()
             if Layer.is_system_table(self.table):
                 return False
-            self.last_refresh_time = time
-            new_spatial_info = self.refresh_spatial_info().get_spatial_info()
-            if not self.sql or self.sql != self.get_create_table_sql() or self.spatial_info != new_spatial_info:
-                self.spatial_info = new_spatial_info
-                self.last_modify_time = time
-                self.sql = self.get_create_table_sql()
-                self.status = self.next_status(ResourceAction.UPDATE)
+            info = SchemaIntrospector(self.db_util,self.table_schema).introspect([self.table]).get(self.table)
+            if not info:
+                raise ValidationError("The table/view({0}.{1}) does not exist.".format(self.table_schema,self.table))
+            self.apply_table_info(info,time)
             self.save()
 
             return True
         finally:
             self.try_clear_transaction("livelayer_refresh")
 
+    def apply_table_info(self,info,time):
+        """
+        update the layer with the introspected table info
+        return True if the table is changed
+        """
+        self.last_refresh_time = time
+        if not self.sql or self.sql != info["sql"] or self.spatial_info != info["spatial_info"]:
+            self.spatial_info = info["spatial_info"]
+            self.last_modify_time = time
+            self.sql = info["sql"]
+            self.status = self.next_status(ResourceAction.UPDATE)
+            return True
+        return False
+
     @property
     def builtin_metadata(self):
         meta_data = {}
@@ -388,11 +411,7 @@ class Layer(BorgModel,ResourceStatusMixin,TransactionMixin,SpatialTableMixin):
         bbox = meta_data.get("bounding_box",None)
         crs = meta_data.get("crs",None)
         #update catalog service
-        res = requests.post("{}/catalogue/api/records/?style_content=true".format(settings.CSW_URL),json=meta_data,auth=(settings.CSW_USER,settings.CSW_PASSWORD))
-        if 400 <= res.status_code < 600 and res.content:
-            res.reason = "{}({})".format(res.reason,res.content)
-        res.raise_for_status()
-        meta_data = res.json()
+        meta_data = CatalogueClient.instance().update_record(meta_data,style_content=True)
 
         #process styles
         styles = meta_data.get("styles",[])
@@ -501,9 +520,7 @@ class Layer(BorgModel,ResourceStatusMixin,TransactionMixin,SpatialTableMixin):
 
         #remove it from catalogue service
         #remove it from catalogue service
-        res = requests.delete("{}/catalogue/api/records/{}:{}/".format(settings.CSW_URL,self.datasource.workspace.name,self.kmi_name),auth=(settings.CSW_USER,settings.CSW_PASSWORD))
-        if res.status_code != 404:
-            res.raise_for_status()
+        CatalogueClient.instance().delete_record(self.datasource.workspace.name,self.kmi_name)
 
         json_filename = self.json_filename_abs('unpublish');
         try_set_push_owner("livelayer")
@@ -747,11 +764,7 @@ class SqlViewLayer(BorgModel,ResourceStatusMixin,TransactionMixin,SpatialTableMi
         bbox = meta_data.get("bounding_box",None)
         crs = meta_data.get("crs",None)
         #update catalog service
-        res = requests.post("{}/catalogue/api/records/?style_content=true".format(settings.CSW_URL),json=meta_data,auth=(settings.CSW_USER,settings.CSW_PASSWORD))
-        if 400 <= res.status_code < 600 and res.content:
-            res.reason = "{}({})".format(res.reason,res.content)
-        res.raise_for_status()
-        meta_data = res.json()
+        meta_data = CatalogueClient.instance().update_record(meta_data,style_content=True)
 
         #process styles
         styles = meta_data.get("styles",[])
@@ -861,9 +874,7 @@ class SqlViewLayer(BorgModel,ResourceStatusMixin,TransactionMixin,SpatialTableMi
 
         #remove it from catalogue service
         #remove it from catalogue service
-        res = requests.delete("{}/catalogue/api/records/{}:{}/".format(settings.CSW_URL,self.datasource.workspace.name,self.kmi_name),auth=(settings.CSW_USER,settings.CSW_PASSWORD))
-        if res.status_code != 404:
-            res.raise_for_status()
+        CatalogueClient.instance().delete_record(self.datasource.workspace.name,self.kmi_name)
 
         json_filename = self.json_filename_abs('unpublish');
         try_set_push_owner("livelayer")
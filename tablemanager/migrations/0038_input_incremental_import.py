@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2017-06-20 03:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tablemanager', '0037_auto_20170607_1051'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='input',
+            name='incremental_import',
+            field=models.BooleanField(default=False, help_text="If true, only the rows inserted or deleted in the foreign table will be imported, based on the row data's hash value"),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2017-06-22 01:45
+from __future__ import unicode_literals
+
+from django.db import migrations
+import tablemanager.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tablemanager', '0038_input_incremental_import'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foreigntable',
+            name='change_detect_sql',
+            field=tablemanager.models.SQLField(blank=True, help_text='Optional. A query returning a single value which changes whenever the data is changed, e.g. SELECT max(<last modified column>) FROM "{{schema}}"."{{self.name}}"', null=True),
+        ),
+    ]
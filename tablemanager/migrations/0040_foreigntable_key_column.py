@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2017-06-26 05:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tablemanager', '0039_foreigntable_change_detect_sql'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foreigntable',
+            name='key_column',
+            field=models.CharField(blank=True, help_text='Optional. An integer column used to split the table into chunks when computing the table fingerprint', max_length=64, null=True),
+        ),
+    ]
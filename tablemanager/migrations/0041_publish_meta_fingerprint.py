@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2017-06-28 02:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tablemanager', '0040_foreigntable_key_column'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='publish',
+            name='meta_fingerprint',
+            field=models.CharField(editable=False, max_length=32, null=True),
+        ),
+    ]
@@ -13,12 +13,15 @@ import time
 import signal
 import json
 import codecs
+import hashlib
+import copy
 import traceback
 import xml.etree.ElementTree as ET
 from functools import wraps
+from collections import Counter
 from datetime import datetime, timedelta
 from xml.dom import minidom
-import requests
+from multiprocessing.pool import AsyncResult
 
 from django.db import models, connection,transaction,connections
 from django.db.utils import load_backend, DEFAULT_DB_ALIAS
@@ -27,7 +30,7 @@ from django.utils import timezone
 from django.utils.encoding import force_text, python_2_unicode_compatible
 from django.db.models.signals import pre_save, pre_delete,post_save,post_delete
 from django.dispatch import receiver
-from django.core.exceptions import ValidationError,ObjectDoesNotExist
+from django.core.exceptions import ValidationError,ObjectDoesNotExist,ImproperlyConfigured
 from django.core.validators import RegexValidator
 from django.template import Context, Template
 from django.contrib import messages
@@ -35,20 +38,24 @@ from django.conf import settings
 from django.utils.safestring import SafeText
 from django.template.loader import render_to_string
 
-import hglib
 from codemirror import CodeMirrorTextarea
 from sqlalchemy import create_engine
 
-from borg_utils.gdal import detect_epsg
+from borg_utils.gdal import gdal_version
+from borg_utils.ogr_backend import get_backend,BindingsBackend
+from borg_utils.copy_loader import CopyLoader
 from borg_utils.spatial_table import SpatialTableMixin
 from borg_utils.borg_config import BorgConfiguration
 from borg_utils.jobintervals import JobInterval
 from borg_utils.resource_status import ResourceStatus,ResourceStatusMixin
 from borg_utils.db_util import defaultDbUtil
-from borg_utils.hg_batch_push import try_set_push_owner, try_clear_push_owner, increase_committed_changes, try_push_to_repository
+from borg_utils.state_repository import StateRepository
+from borg_utils.hg_batch_push import try_set_push_owner, try_clear_push_owner, try_push_to_repository
+from borg_utils.catalogue import CatalogueClient
 from borg_utils.signals import refresh_select_choices
 from borg_utils.models import BorgModel,SQLField
 from borg_utils.utils import file_md5
+from borg_utils.fingerprint import TableFingerprint
 
 logger = logging.getLogger(__name__)
 
@@ -355,17 +362,48 @@ class ForeignTable(BorgModel):
     name = models.SlugField(max_length=255, unique=True, help_text="The name of foreign table", validators=[validate_slug])
     server = models.ForeignKey(DataSource,limit_choices_to={"type":DatasourceType.DATABASE})
     sql = SQLField(default="CREATE FOREIGN TABLE \"{{schema}}\".\"{{self.name}}\" (<columns>) SERVER {{self.server.name}} OPTIONS (schema '<schema>', table '<table>');")
+    key_column = models.CharField(max_length=64, null=True, blank=True, help_text="Optional. An integer column used to split the table into chunks when computing the table fingerprint")
+    change_detect_sql = SQLField(null=True, blank=True, help_text="Optional. A query returning a single value which changes whenever the data is changed, e.g. SELECT max(<last modified column>) FROM \"{{schema}}\".\"{{self.name}}\"")
     last_modify_time = models.DateTimeField(auto_now=False,auto_now_add=True,editable=False,null=False)
 
     ROW_COUNT_SQL = "SELECT COUNT(*) FROM \"{0}\".\"{1}\";"
-    TABLE_MD5_SQL = "SELECT md5(string_agg(md5(CAST(t.* as text)),',')) FROM (SELECT *  from \"{0}\".\"{1}\") as t;"
+    ROW_HASHES_SQL = "SELECT md5(CAST(t.* as text)) FROM \"{0}\".\"{1}\" as t;"
+    HASHED_VIEW_SQL = "CREATE OR REPLACE VIEW \"{0}\".\"{1}_hashed\" AS SELECT t.*, md5(CAST(t.* as text)) AS \"{2}\" FROM \"{0}\".\"{1}\" as t;"
+    DELTA_VIEW_SQL = (
+        "DROP TABLE IF EXISTS \"{0}\".\"{1}_delta_keys\" CASCADE;"
+        "CREATE TABLE \"{0}\".\"{1}_delta_keys\" (\"{2}\" text PRIMARY KEY);"
+        "INSERT INTO \"{0}\".\"{1}_delta_keys\" SELECT unnest(CAST(%(hashes)s AS text[]));"
+        "CREATE OR REPLACE VIEW \"{0}\".\"{1}_delta\" AS SELECT h.* FROM \"{0}\".\"{1}_hashed\" h JOIN \"{0}\".\"{1}_delta_keys\" k ON h.\"{2}\" = k.\"{2}\";"
+    )
+    DROP_HASH_VIEWS_SQL = (
+        "DROP VIEW IF EXISTS \"{0}\".\"{1}_delta\";"
+        "DROP TABLE IF EXISTS \"{0}\".\"{1}_delta_keys\";"
+        "DROP VIEW IF EXISTS \"{0}\".\"{1}_hashed\";"
+    )
+    FDW_NAME_SQL = "SELECT b.fdwname FROM pg_foreign_server a JOIN pg_foreign_data_wrapper b ON a.srvfdw = b.oid WHERE a.srvname='{0}';"
+    TABLE_OPTIONS_SQL = "SELECT a.ftoptions FROM pg_foreign_table a JOIN pg_class b ON a.ftrelid = b.oid JOIN pg_namespace c ON b.relnamespace = c.oid WHERE b.relname='{1}' AND c.nspname='{0}';"
+    STAT_TABLE_SQL = "CREATE FOREIGN TABLE IF NOT EXISTS \"{0}\".\"{1}_stat\" (schemaname name, relname name, n_tup_ins bigint, n_tup_upd bigint, n_tup_del bigint) SERVER {2} OPTIONS (schema_name 'pg_catalog', table_name 'pg_stat_user_tables');"
+    TABLE_STAT_SQL = "SELECT n_tup_ins, n_tup_upd, n_tup_del FROM \"{0}\".\"{1}_stat\" WHERE schemaname='{2}' AND relname='{3}';"
 
     def drop(self,cursor,schema,name):
         """
-        drop the foreign table from specified schema
+        drop the foreign table and its hash views from specified schema
         """
+        cursor.execute(self.DROP_HASH_VIEWS_SQL.format(schema,name))
+        cursor.execute("DROP FOREIGN TABLE IF EXISTS \"{0}\".\"{1}_stat\";".format(schema,name))
         cursor.execute("DROP FOREIGN TABLE IF EXISTS \"{0}\".\"{1}\" CASCADE;".format(schema,name))
 
+    def _change_detect_sql(self,schema,name):
+        """
+        return the change detect sql for the foreign table with the specified name
+        """
+        origname = self.name
+        self.name = name
+        try:
+            return Template(self.change_detect_sql).render(Context({"schema":schema,"self": self}))
+        finally:
+            self.name = origname
+
     @switch_searchpath()
     def create(self,cursor,schema,name):
         """
@@ -402,6 +440,16 @@ class ForeignTable(BorgModel):
         try:
             self.drop(cursor,schema,name)
             self.create(cursor,schema,name)
+            if self.key_column:
+                sql_result = cursor.execute(TableFingerprint.RANGE_SQL.format(schema,name,self.key_column))
+                row = sql_result.fetchone() if sql_result else cursor.fetchone()
+                if row[0] is not None and not isinstance(row[0],(int,long)):
+                    raise ValidationError("Key column should be an integer column.")
+            if self.change_detect_sql:
+                sql_result = cursor.execute(self._change_detect_sql(schema,name))
+                row = sql_result.fetchone() if sql_result else cursor.fetchone()
+                if not row or len(row) != 1:
+                    raise ValidationError("Change detect sql should return a single value.")
             #after validation, clear testing server and testing foreign table
             self.drop(cursor,schema,name)
         except ValidationError as e:
@@ -427,13 +475,89 @@ class ForeignTable(BorgModel):
         else:
             return cursor.fetchone()[0]
 
+    def _table_statistics(self,cursor,schema):
+        """
+        return the modification counters of the remote table from the remote pg_stat_user_tables;
+        return None if the foreign table is not a postgres_fdw table or the remote table has no statistics.
+        """
+        sql_result = cursor.execute(self.FDW_NAME_SQL.format(self.server.name))
+        row = sql_result.fetchone() if sql_result else cursor.fetchone()
+        if not row or row[0] != "postgres_fdw":
+            return None
+
+        sql_result = cursor.execute(self.TABLE_OPTIONS_SQL.format(schema,self.name))
+        row = sql_result.fetchone() if sql_result else cursor.fetchone()
+        options = dict([o.split("=",1) for o in ((row[0] or []) if row else [])])
+        remote_schema = options.get("schema_name",schema)
+        remote_table = options.get("table_name",self.name)
+
+        cursor.execute(self.STAT_TABLE_SQL.format(schema,self.name,self.server.name))
+        sql_result = cursor.execute(self.TABLE_STAT_SQL.format(schema,self.name,remote_schema,remote_table))
+        row = sql_result.fetchone() if sql_result else cursor.fetchone()
+        if not row:
+            #remote table is a view or has no statistics
+            return None
+        return "{0},{1},{2}".format(*row)
+
     @in_schema("public", db_url=settings.FDW_URL)
-    def table_md5(self,cursor,schema):
-        sql_result = cursor.execute(self.TABLE_MD5_SQL.format(schema,self.name))
-        if sql_result:
-            return sql_result.fetchone()[0]
-        else:
-            return cursor.fetchone()[0]
+    def change_signature(self,cursor,schema):
+        """
+        Return a cheap signature which changes whenever the data of the foreign table is changed.
+        The signature is retrieved from the change detect sql if configured; otherwise from the remote table statistics for postgres_fdw table.
+        Return None if no cheap signature is available, the table md5 should be used instead.
+        """
+        try:
+            if self.change_detect_sql:
+                sql_result = cursor.execute(self._change_detect_sql(schema,self.name))
+                row = sql_result.fetchone() if sql_result else cursor.fetchone()
+                return "sql:{0}".format(row[0] if row else None)
+
+            statistics = self._table_statistics(cursor,schema)
+            if statistics:
+                return "stat:{0}".format(statistics)
+        except:
+            logger.warning("Failed to get the change signature of foreign table({0}).{1}".format(self.name,traceback.format_exc()))
+
+        return None
+
+    def table_fingerprint(self):
+        """
+        return the chunked fingerprint of the foreign table
+        """
+        return TableFingerprint(settings.FDW_URL,"public",self.name,self.key_column).compute()
+
+    @in_schema("public", db_url=settings.FDW_URL)
+    def row_hashes(self,ranges,cursor,schema):
+        """
+        return a Counter between the row hash value and the number of rows with that hash value;
+        if ranges is not None, only return the hash values of the rows in the key ranges
+        """
+        sql = self.ROW_HASHES_SQL.format(schema,self.name)
+        if ranges is not None:
+            sql = "{0} {1};".format(sql.rstrip(";"),TableFingerprint.range_condition(self.key_column,ranges))
+        sql_result = cursor.execute(sql)
+        return Counter([row[0] for row in (sql_result if sql_result else cursor)])
+
+    @in_schema("public", db_url=settings.FDW_URL)
+    def create_hash_views(self,delta_hashes,cursor,schema):
+        """
+        create a view "<name>_hashed" which adds the row hash value to the foreign table;
+        if delta_hashes is not None, create a view "<name>_delta" which only contains the rows with the specified hash values.
+        The views are read by ogr2ogr through its own connection, so they can't be temporary objects;
+        they are dropped by drop_hash_views, and also dropped if failed to create them.
+        """
+        try:
+            cursor.execute(self.HASHED_VIEW_SQL.format(schema,self.name,BorgConfiguration.SOURCE_HASH_COLUMN))
+            if delta_hashes is not None:
+                #pass a dict as the only parameter set, a sequence whose first item is a list is treated as a list of parameter sets by sqlalchemy
+                cursor.execute(self.DELTA_VIEW_SQL.format(schema,self.name,BorgConfiguration.SOURCE_HASH_COLUMN),{"hashes":list(delta_hashes)})
+        except:
+            cursor.execute(self.DROP_HASH_VIEWS_SQL.format(schema,self.name))
+            raise
+
+    @in_schema("public", db_url=settings.FDW_URL)
+    def drop_hash_views(self,cursor,schema):
+        cursor.execute(self.DROP_HASH_VIEWS_SQL.format(schema,self.name))
 
     def delete(self,using=None):
         logger.info('Delete {0}:{1}'.format(type(self),self.name))
@@ -514,6 +638,7 @@ class Input(JobFields,SpatialTableMixin):
     data_source = models.ForeignKey(DataSource,limit_choices_to={"type__in":[DatasourceType.FILE_SYSTEM,DatasourceType.DATABASE]})
     foreign_table = models.ForeignKey(ForeignTable, null=True, blank=True, help_text="Foreign table to update VRT from")
     generate_rowid = models.BooleanField(null=False, default=False, help_text="If true, a _rowid column will be added and filled with row data's hash value")
+    incremental_import = models.BooleanField(null=False, default=False, help_text="If true, only the rows inserted or deleted in the foreign table will be imported, based on the row data's hash value")
     source = DatasourceField(help_text="GDAL VRT definition in xml", unique=True)
     advanced_options = models.CharField(max_length=128, null=True, editable=False,blank=True,help_text="Advanced ogr2ogr options")
     info = models.TextField(editable=False)
@@ -532,11 +657,11 @@ class Input(JobFields,SpatialTableMixin):
 {% endif %}{% if info_dict.attracc %}Attribute accuracy: {{ info_dict.attracc }}
 {% endif %}"""
 
-    _field_re = re.compile("[ \t]*(?P<type>[a-zA-Z0-9]+)[ \t]*(\([ \t]*(?P<width>[0-9]+)\.(?P<precision>[0-9]+)\))?[ \t]*")
-    _datasource_info_re = re.compile("[(\n)|(\r\n)](?P<key>[a-zA-Z0-9_\-][a-zA-Z0-9_\- ]*[a-zA-Z0-9_\-]?)[ \t]*:(?P<value>[^\r\n]*([(\r\n)|(\n)](([ \t]+[^\r\n]*)|(GEOGCS[^\r\n]*)))*)")
 
     DB_TEMPLATE_CONTEXT = {'NAME':'{{db.NAME}}','HOST':'{{db.HOST}}',"PORT":'{{db.PORT}}','USER':'{{db.USER}}','PASSWORD':'{{db.PASSWORD}}'}
 
+    _check_column_sql = "SELECT count(1) FROM pg_attribute a JOIN pg_class b ON a.attrelid = b.oid JOIN pg_namespace c ON b.relnamespace = c.oid WHERE a.attnum > 0 AND NOT a.attisdropped AND a.attname='{2}' AND b.relname='{1}' AND c.nspname='{0}' "
+
     @property
     def rowid_column(self):
         return BorgConfiguration.ROWID_COLUMN
@@ -722,27 +847,40 @@ class Input(JobFields,SpatialTableMixin):
                 if self.job_run_time <= self.last_modify_time:
                     return False
 
+                if self.importing_dict.get("unlogged") and self._is_truncated():
+                    #the unlogged input table is emptied by a database crash
+                    return False
+
                 if self.foreign_table:
                     if not job:
                         return None
                     elif job.job_type == JobInterval.Triggered.name:
                         return False
                     elif job.batch_id:
-                        if "table_md5" in self.importing_dict and "row_count" in self.importing_dict:
-                            if self.foreign_table.table_row_count() != self.importing_dict["row_count"]:
-                                #inputing table has different number of rows with inputed table
-                                self.importing_info = None
-                                self.save(update_fields=['importing_info'])
-                                return False
-                            if self.foreign_table.table_md5() == self.importing_dict["table_md5"]:
+                        if "change_signature" in self.importing_dict:
+                            signature = self.foreign_table.change_signature()
+                            if signature is not None:
+                                if signature == self.importing_dict["change_signature"]:
+                                    self.importing_dict["check_job_id"] = job.id
+                                    self.importing_dict["check_batch_id"] = job.batch_id
+                                    self.importing_info = json.dumps(self.importing_dict)
+                                    self.save(update_fields=['importing_info'])
+                                    return True
+                                else:
+                                    self.importing_info = None
+                                    self.save(update_fields=['importing_info'])
+                                    return False
+                        if "fingerprint" in self.importing_dict:
+                            changed_chunks = TableFingerprint.changed_chunks(self.importing_dict["fingerprint"],self.foreign_table.table_fingerprint())
+                            if changed_chunks == []:
                                 self.importing_dict["check_job_id"] = job.id
                                 self.importing_dict["check_batch_id"] = job.batch_id
                                 self.importing_info = json.dumps(self.importing_dict)
                                 self.save(update_fields=['importing_info'])
                                 return True
                             else:
-                                self.importing_info = None
-                                self.save(update_fields=['importing_info'])
+                                if changed_chunks:
+                                    logger.info("The key ranges {1} of the foreign table({0}) are changed".format(self.foreign_table.name,changed_chunks))
                                 return False
                         else:
                             return False
@@ -773,61 +911,117 @@ class Input(JobFields,SpatialTableMixin):
 
         return False
 
+    def _is_truncated(self):
+        """
+        Return True if the input table doesn't exist or is empty
+        """
+        cursor = None
+        try:
+            cursor = connection.cursor()
+            table = "\"{0}\".\"{1}\"".format(BorgConfiguration.INPUT_SCHEMA,self.name)
+            cursor.execute("SELECT to_regclass('{0}') IS NULL".format(table.replace("'","''")))
+            if cursor.fetchone()[0]:
+                return True
+            cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM {0})".format(table))
+            return cursor.fetchone()[0]
+        finally:
+            close_cursor(cursor)
+
+    _table_catalogue_sql = (
+        "SELECT 'c' AS kind, a.attnum AS seq, a.attname AS name, CASE WHEN a.attnotnull THEN 'NOT NULL' ELSE '' END AS extra, pg_get_expr(d.adbin,d.adrelid) AS definition "
+        "FROM pg_attribute a LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum WHERE a.attrelid = '{0}'::regclass AND a.attnum > 0 AND NOT a.attisdropped "
+        "UNION ALL "
+        "SELECT 'k', 0, c.conname, CAST(c.contype AS text), pg_get_constraintdef(c.oid) FROM pg_constraint c WHERE c.conrelid = '{0}'::regclass AND c.contype IN ('p','u','c','x') "
+        "UNION ALL "
+        "SELECT 'i', 0, i.relname, '', pg_get_indexdef(i.oid) FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid WHERE x.indrelid = '{0}'::regclass AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid) "
+        "UNION ALL "
+        "SELECT 's', 0, a.attname, '', quote_ident(n.nspname) || '.' || quote_ident(s.relname) FROM pg_depend d JOIN pg_class s ON s.oid = d.objid JOIN pg_namespace n ON n.oid = s.relnamespace JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid "
+        "WHERE s.relkind = 'S' AND d.deptype = 'a' AND d.refobjid = '{0}'::regclass "
+        "UNION ALL "
+        "SELECT 'p', 0, CAST(c.relpersistence AS text), CASE WHEN c.relowner = (SELECT r.oid FROM pg_roles r WHERE r.rolname = current_user) THEN '' ELSE quote_ident(pg_get_userbyid(c.relowner)) END, quote_literal(obj_description(c.oid,'pg_class')) "
+        "FROM pg_class c WHERE c.oid = '{0}'::regclass "
+        "UNION ALL "
+        "SELECT 'd', a.attnum, a.attname, '', quote_literal(col_description(a.attrelid,a.attnum)) FROM pg_attribute a "
+        "WHERE a.attrelid = '{0}'::regclass AND a.attnum > 0 AND NOT a.attisdropped AND col_description(a.attrelid,a.attnum) IS NOT NULL "
+        "UNION ALL "
+        "SELECT 'g', 0, g.privilege_type, CASE WHEN g.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(g.grantee)) END, CASE WHEN g.is_grantable THEN ' WITH GRANT OPTION' ELSE '' END "
+        "FROM pg_class c, aclexplode(c.relacl) g WHERE c.oid = '{0}'::regclass "
+        "UNION ALL "
+        "SELECT 'g', a.attnum, g.privilege_type || ' (' || quote_ident(a.attname) || ')', CASE WHEN g.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(g.grantee)) END, CASE WHEN g.is_grantable THEN ' WITH GRANT OPTION' ELSE '' END "
+        "FROM pg_attribute a, aclexplode(a.attacl) g WHERE a.attrelid = '{0}'::regclass AND a.attnum > 0 AND NOT a.attisdropped "
+        "ORDER BY 1, 2"
+    )
+
+    _rowid_hash_expressions = {
+        "md5":"md5(CAST(({0}) AS text))",
+        "hashtextextended":"CAST(hashtextextended(CAST(({0}) AS text),0) AS text)",
+    }
+
     def _populate_rowid(self,cursor,schema):
         """
         generate the rowid for input table
         if the input table is not required to generate rowid, return directly.
-        otherwise,do the follwoing things:
-        1. add a rowid column, and set rowid as primary key
-        2. construnct the sql to update the rowid.
-        3. execute the sql.
+        otherwise,do the follwoing things in one transaction:
+        1. create a new table with the rowid column populated from the input table, unlogged if the input table is unlogged
+        2. move the sequences, defaults, constraints, indexes, owner, grants and comments of the input table to the new table
+        3. replace the input table with the new table, and set rowid as unique key
         """
         if not self.generate_rowid:
             return
 
-        #check whether rowid column exists or not
-        sql = "SELECT count(1) FROM pg_attribute a JOIN pg_class b ON a.attrelid = b.oid JOIN pg_namespace c ON b.relnamespace = c.oid WHERE a.attname='{2}' AND b.relname='{1}' AND c.nspname='{0}' ".format(schema,self.name,self.rowid_column)
-        sql_result = cursor.execute(sql)
-        column_exists = None
-        if sql_result:
-            column_exists = (sql_result.fetchone())[0]
-        else:
-            column_exists = (cursor.fetchone())[0]
-
-        #add rowid column if required
-        if not column_exists:
-            #add column
-            sql = "ALTER TABLE {0}.{1} ADD COLUMN {2} text".format(schema,self.name,self.rowid_column)
-            cursor.execute(sql)
-
-        #construct the update sql
-        sql = "SELECT a.attname FROM pg_attribute a JOIN pg_class b ON a.attrelid = b.oid JOIN pg_namespace c ON b.relnamespace = c.oid WHERE a.attnum > 0 AND a.attname != '{2}' AND b.relname='{1}' AND c.nspname='{0}' ".format(schema,self.name,self.rowid_column)
-        sql_result = cursor.execute(sql)
-        input_table_columns = None
-        if sql_result:
-            input_table_columns = ",".join([x[0] for x in sql_result.fetchall()])
-        else:
-            input_table_columns = ",".join([x[0] for x in cursor.fetchall()])
-        sql = "UPDATE \"{0}\".\"{1}\" set {2} = md5(CAST(({3}) AS text))".format(schema,self.name,self.rowid_column,input_table_columns)
-        cursor.execute(sql)
+        #get the columns, constraints, indexes and sequences of the input table in one query
+        table = "\"{0}\".\"{1}\"".format(schema,self.name)
+        sql_result = cursor.execute(self._table_catalogue_sql.format(table.replace("'","''")))
+        rows = sql_result.fetchall() if sql_result else cursor.fetchall()
+        columns = [row for row in rows if row[0] == "c" and row[2] != self.rowid_column]
+        constraints = [row for row in rows if row[0] == "k"]
+        indexes = [row for row in rows if row[0] == "i"]
+        sequences = [row for row in rows if row[0] == "s"]
+        persistence = [row for row in rows if row[0] == "p"][0]
+        comments = [row for row in rows if row[0] == "d" and row[2] != self.rowid_column]
+        grants = [row for row in rows if row[0] == "g"]
+
+        new_table = "{0}__rowid".format(self.name)
+        input_table_columns = ",".join(["\"{0}\"".format(c[2]) for c in columns])
+        hash_expression = self._rowid_hash_expressions[BorgConfiguration.ROWID_HASH].format(input_table_columns)
+
+        sql = "DROP TABLE IF EXISTS \"{0}\".\"{1}\";".format(schema,new_table)
+        sql += "CREATE {6}TABLE \"{0}\".\"{1}\" AS SELECT {2}, {3} AS \"{4}\" FROM {5};".format(schema,new_table,input_table_columns,hash_expression,self.rowid_column,table,"UNLOGGED " if persistence[2] == "u" else "")
+        for s in sequences:
+            sql += "ALTER SEQUENCE {0} OWNED BY \"{1}\".\"{2}\".\"{3}\";".format(s[4],schema,new_table,s[2])
+        sql += "DROP TABLE {0} CASCADE;".format(table)
+        sql += "ALTER TABLE \"{0}\".\"{1}\" RENAME TO \"{2}\";".format(schema,new_table,self.name)
+        for c in columns:
+            if c[4]:
+                sql += "ALTER TABLE {0} ALTER COLUMN \"{1}\" SET DEFAULT {2};".format(table,c[2],c[4])
+            if c[3]:
+                sql += "ALTER TABLE {0} ALTER COLUMN \"{1}\" SET NOT NULL;".format(table,c[2])
+        for k in constraints:
+            sql += "ALTER TABLE {0} ADD CONSTRAINT \"{1}\" {2};".format(table,k[2],k[4])
+        for i in indexes:
+            sql += "{0};".format(i[4])
+        if persistence[4]:
+            sql += "COMMENT ON TABLE {0} IS {1};".format(table,persistence[4])
+        for d in comments:
+            sql += "COMMENT ON COLUMN {0}.\"{1}\" IS {2};".format(table,d[2],d[4])
+        for g in grants:
+            sql += "GRANT {1} ON TABLE {0} TO {2}{3};".format(table,g[2],g[3],g[4])
+        if persistence[3]:
+            #change the owner at last, the current user may not be able to grant after that
+            sql += "ALTER TABLE {0} OWNER TO {1};".format(table,persistence[3])
 
         #set the rowid as the unique key
-        #first check whether the unique key exists or not
         constraint_name = "{0}_index_{1}".format(self.name,self.rowid_column)
-        sql = "SELECT count(1) FROM pg_constraint a JOIN pg_class b ON a.conrelid = b.oid JOIN pg_namespace c ON b.relnamespace = c.oid WHERE a.conname='{2}' AND b.relname='{1}' AND c.nspname='{0}' ".format(schema,self.name,constraint_name)
-        sql_result = cursor.execute(sql)
-        constraint_exists = None
-        if sql_result:
-            constraint_exists = (sql_result.fetchone())[0]
-        else:
-            constraint_exists = (cursor.fetchone())[0]
-        if not constraint_exists:
-            #unique key does not exist
-            sql = "ALTER TABLE \"{0}\".\"{1}\" ADD CONSTRAINT {3} UNIQUE ({2})".format(schema,self.name,self.rowid_column,constraint_name)
-            cursor.execute(sql)
+        if constraint_name not in [k[2] for k in constraints]:
+            sql += "ALTER TABLE {0} ADD CONSTRAINT {2} UNIQUE (\"{1}\");".format(table,self.rowid_column,constraint_name)
+
+        cursor.execute(sql)
 
     @in_schema(BorgConfiguration.INPUT_SCHEMA)
     def populate_rowid(self,cursor,schema):
+        if self.importing_dict.get("rowid_populated"):
+            #rowid is already populated when importing
+            return
         self._populate_rowid(cursor,schema)
 
     @in_schema(BorgConfiguration.TEST_INPUT_SCHEMA + "," + BorgConfiguration.BORG_SCHEMA)
@@ -872,12 +1066,8 @@ class Input(JobFields,SpatialTableMixin):
         return the data source's layer name
         """
         if hasattr(self, "_layer_name"): return self._layer_name
-        output = subprocess.check_output(["ogrinfo", "-q", "-ro", self.vrt.name], stderr=subprocess.STDOUT)
-        if output.find("ERROR") > -1:
-            raise Exception(l)
-        else:
-            self._layer_name = output.replace("1: ", "").split(" (")[0].strip()
-            return self._layer_name
+        self._layer_name = get_backend().layer_name(self.vrt.name)
+        return self._layer_name
 
     def insert_fields(self):
         origin_source = self.source
@@ -945,22 +1135,8 @@ class Input(JobFields,SpatialTableMixin):
             #get datasource information based on new source string
             self._set_info()
     
-            fields = []
-            
-            #using regrex to parse output into datasource items
-            datasource_items = self._datasource_info_re.findall(self.info)
-            #get all fields from datasource items
-            info_items = [(item[0],item[1]) for item in datasource_items]
-            for k,v in info_items:
-                if k in ("INFO","Layer name","Geometry","Metadata","Feature Count","Extent","Layer SRS WKT"):
-                    continue
-                if k.find(" ") >= 0:
-                    #include a emptry, can't be a column
-                    continue
-                m = self._field_re.search(v)
-                if m:
-                    #convert the column name to lower case
-                    fields.append((k.lower(),m.group('type'),m.group('width'),m.group('precision')))
+            #get all fields from datasource information, convert the column name to lower case
+            fields = [(f.name.lower(),f.type,f.width,f.precision) for f in self._layer_info.fields]
     
             #convert the column name into lower case, 
             for f in field_childs:
@@ -1009,54 +1185,67 @@ class Input(JobFields,SpatialTableMixin):
         if database is None, read the information from data source;
         """
         if database and table:
-            cmd = ["ogrinfo", "-ro", "-so", database, table]
+            info = get_backend().layer_info(database,table)
         else:
-            cmd = ["ogrinfo", "-ro","-al","-so", self.vrt.name]
-
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        output = p.communicate()
-        if p.returncode != 0:
-            error_msg = output[1].replace("ERROR 1: Invalid geometry field index : -1","")
-            if error_msg.strip():
-                raise Exception(error_msg)
-            else:
-                raise Exception("orginfo failed with unknown exception")
+            info = get_backend().layer_info(self.vrt.name)
         try:
             delattr(self,"_info_dict")
         except:
             pass
 
-        self.info = output[0]
+        self._layer_info = info
         if database and table:
             #replace the layername with datasource's layer name
-            self.info = Input._layer_name_re.sub("Layer name: {0}\n".format(self.get_layer_name()),output[0],count=1)
+            self.info = Input._layer_name_re.sub("Layer name: {0}\n".format(self.get_layer_name()),info.text,count=1)
         else:
-            self.info = output[0]
+            self.info = info.text
 
-    def invoke(self ,cursor,schema,job_id=None):
+    def invoke(self ,cursor,schema,job_id=None,vrt=None,append=False,unlogged=False):
         """
         Use ogr2ogr to copy the VRT source defined in Input into the harvest DB.
         Pre-save hook for Input.
 
         can be invoked by havest or user maintain action
+        vrt: the vrt file to import, default is the input's vrt
+        append: append the features to the existing table instead of overwriting it.
+        unlogged: create the table as an unlogged table if supported.
 
         Return True if import successfully; False if import process is terminated.
         """
         validation = not job_id
+        vrt = vrt or self.vrt
 
         # Make sure DB is GIS enabled and then load using ogr2ogr
         database = "PG:dbname='{NAME}' host='{HOST}' port='{PORT}'  user='{USER}' password='{PASSWORD}'".format(**settings.DATABASES["default"])
         table = "{0}.{1}".format(schema,self.name)
         cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
-        cmd = ["ogr2ogr", "-overwrite", "-gt", "20000", "-preserve_fid", "-skipfailures", "--config", "PG_USE_COPY", "YES",
-            "-f", "PostgreSQL", database, self.vrt.name, "-nln", table, "-nlt", "PROMOTE_TO_MULTI", self.layer]
+        if append:
+            #the fid of the appended features can't be preserved, they will conflict with the existing features
+            cmd = ["ogr2ogr", "-append", "-gt", "20000", "-skipfailures", "--config", "PG_USE_COPY", "YES",
+                "-f", "PostgreSQL", database, vrt.name, "-nln", table, "-nlt", "PROMOTE_TO_MULTI", self.layer]
+        else:
+            cmd = ["ogr2ogr", "-overwrite", "-gt", "20000", "-preserve_fid", "-skipfailures", "--config", "PG_USE_COPY", "YES",
+                "-f", "PostgreSQL", database, vrt.name, "-nln", table, "-nlt", "PROMOTE_TO_MULTI", self.layer]
+
+        if unlogged and not append and gdal_version() >= (2,4):
+            cmd += ["-lco", "UNLOGGED=ON"]
 
         if self.advanced_options:
             cmd += self.advanced_options.split()
 
-        srid = detect_epsg(self.vrt.name)
+        srid = get_backend().detect_epsg(vrt.name)
         if srid:
             cmd += ['-a_srs', srid]
+
+        if not validation and not append and not self.advanced_options and BorgConfiguration.UNION_IMPORT_CONCURRENCY > 1:
+            union = self._union_parts(vrt)
+            if union:
+                return self._parallel_union_invoke(cursor,schema,job_id,union[0],union[1],srid,database,table,unlogged)
+
+        #the copy loader can't detect the srid as ogr2ogr does, fall back to ogr2ogr if the srid is not detected
+        if srid and not validation and not append and not self.advanced_options and BorgConfiguration.IMPORT_LOADER == "copy" and CopyLoader.is_available():
+            return self._copy_load(cursor,schema,job_id,vrt,srid,database,table,unlogged)
+
         logger.info(" ".join(cmd))
         cancelled = False
         p = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
@@ -1127,6 +1316,205 @@ class Input(JobFields,SpatialTableMixin):
 
         return not cancelled
 
+    _table_columns_sql = "SELECT a.attname, format_type(a.atttypid,a.atttypmod) FROM pg_attribute a JOIN pg_class b ON a.attrelid = b.oid JOIN pg_namespace c ON b.relnamespace = c.oid WHERE a.attnum > 0 AND NOT a.attisdropped AND b.relname='{1}' AND c.nspname='{0}' ORDER BY a.attnum"
+
+    def _union_parts(self,vrt):
+        """
+        Return (union layer,[(member layer name,member vrt file)]) if the source is a union layer whose members can be imported in parallel;
+        otherwise return None
+        """
+        try:
+            root = ET.parse(vrt.name).getroot()
+        except:
+            return None
+        layers = [l for l in root if l.tag.startswith("OGRVRT")]
+        if len(layers) != 1 or layers[0].tag != "OGRVRTUnionLayer":
+            return None
+        union_layer = layers[0]
+        if union_layer.find("Field") is not None:
+            #the fields are declared in the union layer
+            return None
+        members = [l for l in union_layer if l.tag.startswith("OGRVRT")]
+        if len(members) < 2 or any([m.tag != "OGRVRTLayer" for m in members]):
+            #currently only support union layer which only includes simple layers
+            return None
+
+        parts = []
+        for member in members:
+            part_root = ET.Element("OGRVRTDataSource")
+            part_root.append(copy.deepcopy(member))
+            part_vrt = tempfile.NamedTemporaryFile()
+            part_vrt.write(ET.tostring(part_root,"UTF-8"))
+            part_vrt.flush()
+            parts.append((member.get("name"),part_vrt))
+        return (union_layer,parts)
+
+    def _union_merge_sql(self,cursor,schema,union_layer,parts,part_tables,unlogged=False):
+        """
+        Return the sql to merge the part tables into the input table, the result is the same as importing the union layer.
+        """
+        part_columns = []
+        for part_table in part_tables:
+            sql_result = cursor.execute(self._table_columns_sql.format(schema,part_table))
+            part_columns.append([(row[0],row[1]) for row in (sql_result.fetchall() if sql_result else cursor.fetchall()) if row[0] != "ogc_fid"])
+
+        #populate the columns based on the field strategy
+        field_strategy = (union_layer.findtext("FieldStrategy") or "Union").strip().lower()
+        columns = list(part_columns[0])
+        if field_strategy == "union":
+            for cols in part_columns[1:]:
+                for col in cols:
+                    if col[0] not in [c[0] for c in columns]:
+                        columns.append(col)
+        elif field_strategy == "intersection":
+            for cols in part_columns[1:]:
+                columns = [c for c in columns if c[0] in [col[0] for col in cols]]
+
+        preserve_fid = (union_layer.findtext("PreserveSrcFID") or "").strip().lower() in ("on","yes","true","1")
+        source_layer_field = (union_layer.findtext("SourceLayerFieldName") or "").strip()
+
+        selects = []
+        for index in range(len(part_tables)):
+            names = [c[0] for c in part_columns[index]]
+            select = "SELECT {0} AS __part, ogc_fid AS __fid".format(index)
+            if source_layer_field:
+                select += ", CAST('{0}' AS varchar) AS \"{1}\"".format(parts[index][0].replace("'","''"),source_layer_field)
+            for name,data_type in columns:
+                select += ", CAST({0} AS {1}) AS \"{2}\"".format("\"{0}\"".format(name) if name in names else "NULL",data_type,name)
+            select += " FROM \"{0}\".\"{1}\"".format(schema,part_tables[index])
+            selects.append(select)
+
+        column_names = ([source_layer_field] if source_layer_field else []) + [c[0] for c in columns]
+        sql = "DROP TABLE IF EXISTS \"{0}\".\"{1}\" CASCADE;".format(schema,self.name)
+        sql += "CREATE {5}TABLE \"{0}\".\"{1}\" AS SELECT CAST({2} AS integer) AS ogc_fid{3} FROM ({4}) u;".format(
+            schema,self.name,
+            "__fid" if preserve_fid else "row_number() OVER (ORDER BY __part, __fid)",
+            "".join([", \"{0}\"".format(c) for c in column_names]),
+            " UNION ALL ".join(selects),
+            "UNLOGGED " if unlogged else ""
+        )
+        if not preserve_fid:
+            sql += "ALTER TABLE \"{0}\".\"{1}\" ADD PRIMARY KEY (ogc_fid);".format(schema,self.name)
+        for name,data_type in columns:
+            if data_type.startswith("geometry"):
+                sql += "CREATE INDEX \"{1}_{2}_geom_idx\" ON \"{0}\".\"{1}\" USING GIST (\"{2}\");".format(schema,self.name,name)
+        return sql
+
+    def _parallel_union_invoke(self,cursor,schema,job_id,union_layer,parts,srid,database,table,unlogged=False):
+        """
+        Import the member layers of the union layer into part tables in parallel, and then merge them into the input table in one transaction.
+
+        Return True if import successfully; False if import process is terminated.
+        """
+        from harvest.jobstates import JobStateOutcome
+        part_tables = ["{0}__p{1}".format(self.name,index) for index in range(len(parts))]
+        pending = []
+        for (layer_name,part_vrt),part_table in zip(parts,part_tables):
+            cmd = ["ogr2ogr", "-overwrite", "-gt", "20000", "-preserve_fid", "-skipfailures", "--config", "PG_USE_COPY", "YES", "-lco", "SPATIAL_INDEX=NO",
+                "-f", "PostgreSQL", database, part_vrt.name, "-nln", "{0}.{1}".format(schema,part_table), "-nlt", "PROMOTE_TO_MULTI", layer_name]
+            if srid:
+                cmd += ['-a_srs', srid]
+            pending.append(cmd)
+
+        logger.info("Import the {1} member layers of the input({0}) in parallel".format(self.name,len(pending)))
+        running = []
+        cancelled = False
+        sleep_time = 0
+        cancel_time = BorgConfiguration.IMPORT_CANCEL_TIME * 1000
+        try:
+            while pending or running:
+                while pending and len(running) < BorgConfiguration.UNION_IMPORT_CONCURRENCY:
+                    cmd = pending.pop(0)
+                    logger.info(" ".join(cmd))
+                    running.append(subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE))
+
+                for p in list(running):
+                    if p.poll() is not None:
+                        running.remove(p)
+                        output = p.communicate()
+                        if p.returncode != 0:
+                            if output[1].strip() :
+                                raise Exception(output[1])
+                            else:
+                                raise Exception("ogr2ogr failed with unknown exception")
+
+                time.sleep(0.2)
+                sleep_time += 200
+                if sleep_time >= cancel_time:
+                    sleep_time = 0
+                    job = self._get_job(cursor,job_id)
+                    if job.user_action and job.user_action.lower() == JobStateOutcome.cancelled_by_custodian.lower():
+                        cancelled = True
+                        logger.info("The job({1}) is cancelled, terminate the importing processes for '{0}'".format(self.name,job_id))
+                        #clear the user action
+                        job.user_action = None
+                        self._save_job(cursor,job,["user_action"])
+                        break
+
+            if not cancelled:
+                cursor.execute(self._union_merge_sql(cursor,schema,union_layer,parts,part_tables,unlogged))
+                self._set_info(database,table)
+        finally:
+            for p in running:
+                try:
+                    p.terminate()
+                    p.wait()
+                except:
+                    pass
+            cursor.execute(";".join(["DROP TABLE IF EXISTS \"{0}\".\"{1}\" CASCADE".format(schema,part_table) for part_table in part_tables]))
+
+        return not cancelled
+
+    def _copy_load(self,cursor,schema,job_id,vrt,srid,database,table,unlogged=False):
+        """
+        Stream the features of the VRT source into the harvest DB through "COPY FROM STDIN" in batches.
+        The progress is saved into the job's metadata after each batch, and the cancel request is checked between batches.
+
+        Return True if import successfully; False if import process is cancelled.
+        """
+        from harvest.jobstates import JobStateOutcome
+        logger.info("Load the input({0}) into table {1} through COPY.".format(self.name,table))
+        job = self._get_job(cursor,job_id)
+        metadict = job.metadict
+
+        def _progress(loaded,total,speed):
+            metadict["importing"] = {"input":self.name,"rows":loaded,"total":total,"rows_per_second":speed}
+            self._update_job(cursor,job_id,metadata=json.dumps(metadict))
+
+        def _cancelled():
+            user_action = self._get_job_user_action(cursor,job_id)
+            return bool(user_action and user_action.lower() == JobStateOutcome.cancelled_by_custodian.lower())
+
+        ds,layer = get_backend(BindingsBackend.name).open_layer(vrt.name)
+        try:
+            loader = CopyLoader(cursor,layer,schema,self.name,srid=int(srid.split(":")[1]),progress=_progress,cancelled=_cancelled,unlogged=unlogged)
+            loaded = loader.load()
+        finally:
+            layer = None
+            ds = None
+
+        if not loaded:
+            logger.info("The job({1}) is cancelled, stop loading the input '{0}'".format(self.name,job_id))
+            #clear the user action
+            self._update_job(cursor,job_id,user_action=None)
+            return False
+
+        if "importing" in metadict:
+            del metadict["importing"]
+            self._update_job(cursor,job_id,metadata=json.dumps(metadict))
+        self._set_info(database,table)
+        return True
+
+    @switch_searchpath(searchpath=BorgConfiguration.BORG_SCHEMA)
+    def _get_job_user_action(self,cursor,job_id):
+        from harvest.models import Job
+        return Job.objects.filter(pk=job_id).values_list("user_action",flat=True).first()
+
+    @switch_searchpath(searchpath=BorgConfiguration.BORG_SCHEMA)
+    def _update_job(self,cursor,job_id,**kwargs):
+        from harvest.models import Job
+        Job.objects.filter(pk=job_id).update(**kwargs)
+
     @switch_searchpath(searchpath=BorgConfiguration.BORG_SCHEMA)
     def _get_job(self,cursor,job_id):
         from harvest.models import Job
@@ -1137,24 +1525,198 @@ class Input(JobFields,SpatialTableMixin):
         job.save(update_fields=update_fields)
 
     @switch_searchpath(searchpath=BorgConfiguration.BORG_SCHEMA)
-    def _post_execute(self,cursor):
+    def _post_execute(self,cursor,change_signature=None):
         if self.foreign_table:
-            self.importing_dict["row_count"] = self.foreign_table.table_row_count()
-            self.importing_dict["table_md5"] = self.foreign_table.table_md5()
+            for key in ("row_count","table_md5","change_signature","fingerprint"):
+                if key in self.importing_dict: del self.importing_dict[key]
+            if change_signature is not None:
+                #the change signature is enough to detect the changes, avoid the expensive table fingerprint
+                self.importing_dict["change_signature"] = change_signature
+            #the fingerprint computed before importing
+            fingerprint = getattr(self,"_fingerprint",None)
+            if fingerprint is None and change_signature is None:
+                fingerprint = self.foreign_table.table_fingerprint()
+            if fingerprint is not None:
+                self.importing_dict["fingerprint"] = fingerprint
             if "check_job_id" in self.importing_dict: del self.importing_dict["check_job_id"]
             if "check_batch_id" in self.importing_dict: del self.importing_dict["check_batch_id"]
-            #import ipdb;ipdb.set_trace()
-            self.importing_info = json.dumps(self.importing_dict)
+        if getattr(self,"_rowid_populated",False):
+            self.importing_dict["rowid_populated"] = True
+        elif "rowid_populated" in self.importing_dict:
+            del self.importing_dict["rowid_populated"]
+        if getattr(self,"_unlogged",False):
+            self.importing_dict["unlogged"] = True
+        elif "unlogged" in self.importing_dict:
+            del self.importing_dict["unlogged"]
+        #import ipdb;ipdb.set_trace()
+        self.importing_info = json.dumps(self.importing_dict) if self.importing_dict else None
         self.save(update_fields=["importing_info","job_run_time","info"])
 
+    def _hash_vrt(self,layer_name):
+        """
+        A temporary vrt file which reads the data from the specified layer of the FDW database instead of the foreign table;
+        the layer should be one of the hash views created by the foreign table.
+        Return None if the data source can't be read from other layer.
+        """
+        hash_column = BorgConfiguration.SOURCE_HASH_COLUMN
+        root = ET.fromstring(Template(self.source).render(Context({"self": self,"db":settings.FDW_URL_SETTINGS})).encode("utf-8"))
+        layers = [root] if root.tag == "OGRVRTLayer" else list(root.iter("OGRVRTLayer"))
+        if len(layers) != 1 or layers[0].find("SrcSQL") is not None:
+            return None
+
+        layer = layers[0]
+        src_layer = layer.find("SrcLayer")
+        if src_layer is None:
+            src_layer = ET.SubElement(layer,"SrcLayer")
+        src_layer.text = layer_name
+        if layer.find("Field") is not None:
+            #fields are declared explicitly, add the hash column
+            ET.SubElement(layer,"Field",attrib={"name":hash_column,"src":hash_column,"type":"String","width":"32"})
+
+        vrt = tempfile.NamedTemporaryFile()
+        vrt.write(ET.tostring(root,"UTF-8"))
+        vrt.flush()
+        return vrt
+
+    def _incremental_invoke(self,cursor,schema,job_id):
+        """
+        Import the changed rows of the foreign table into the harvest DB.
+        Each imported row carries its hash value in the column SOURCE_HASH_COLUMN;
+        the rows whose hash value is not in the foreign table any more are deleted,
+        and the rows whose hash value is not in the imported table are appended.
+        A whole table import is performed if the table is not imported incrementally before.
+
+        Return True if import successfully; False if import process is terminated.
+        """
+        hash_column = BorgConfiguration.SOURCE_HASH_COLUMN
+        sql_result = cursor.execute(self._check_column_sql.format(schema,self.name,hash_column))
+        imported = bool((sql_result.fetchone() if sql_result else cursor.fetchone())[0])
+
+        if not imported:
+            vrt = self._hash_vrt("{0}_hashed".format(self.foreign_table.name))
+            if not vrt:
+                logger.info("Can't import the input({0}) incrementally, import the whole table.".format(self.name))
+                return self.invoke(cursor,schema,job_id)
+            self._fingerprint = self.foreign_table.table_fingerprint()
+            self.foreign_table.create_hash_views(None)
+            try:
+                return self.invoke(cursor,schema,job_id,vrt=vrt)
+            finally:
+                self.foreign_table.drop_hash_views()
+
+        #only compare the rows in the changed chunks if the key column is available
+        self._fingerprint = self.foreign_table.table_fingerprint()
+        changed_chunks = None
+        if self.foreign_table.key_column:
+            sql_result = cursor.execute(self._check_column_sql.format(schema,self.name,self.foreign_table.key_column))
+            if (sql_result.fetchone() if sql_result else cursor.fetchone())[0]:
+                changed_chunks = TableFingerprint.changed_chunks(self.importing_dict.get("fingerprint"),self._fingerprint)
+
+        if changed_chunks == []:
+            logger.info("The foreign table({1}) is not changed, no need to import the input({0}).".format(self.name,self.foreign_table.name))
+            remote_hashes = local_hashes = Counter()
+        else:
+            remote_hashes = self.foreign_table.row_hashes(changed_chunks)
+            sql = "SELECT \"{2}\" FROM \"{0}\".\"{1}\"".format(schema,self.name,hash_column)
+            if changed_chunks:
+                sql = "{0} {1}".format(sql,TableFingerprint.range_condition(self.foreign_table.key_column,changed_chunks))
+            sql_result = cursor.execute(sql)
+            local_hashes = Counter([row[0] for row in (sql_result if sql_result else cursor)])
+        #identical rows have the same hash value; if the number of rows with a hash value is changed,
+        #delete all the imported rows with that hash value and import all the rows with that hash value again.
+        changed_hashes = set([h for h in set(local_hashes) | set(remote_hashes) if local_hashes[h] != remote_hashes[h]])
+        deleted_hashes = set([h for h in changed_hashes if local_hashes[h]])
+        inserted_hashes = set([h for h in changed_hashes if remote_hashes[h]])
+        logger.info("Import the input({0}) incrementally, {1} rows are deleted, {2} rows are inserted.".format(self.name,sum([local_hashes[h] for h in deleted_hashes]),sum([remote_hashes[h] for h in inserted_hashes])))
+
+        if deleted_hashes:
+            cursor.execute("DELETE FROM \"{0}\".\"{1}\" WHERE \"{2}\" = ANY(%s)".format(schema,self.name,hash_column),[list(deleted_hashes)])
+
+        if not inserted_hashes:
+            database = "PG:dbname='{NAME}' host='{HOST}' port='{PORT}'  user='{USER}' password='{PASSWORD}'".format(**settings.DATABASES["default"])
+            self._set_info(database,"{0}.{1}".format(schema,self.name))
+            return True
+
+        #the fid of the appended features is generated by the sequence, make sure it doesn't conflict with the existing features.
+        sql_result = cursor.execute(self._check_column_sql.format(schema,self.name,"ogc_fid"))
+        if (sql_result.fetchone() if sql_result else cursor.fetchone())[0]:
+            cursor.execute("SELECT setval(s,(SELECT COALESCE(max(ogc_fid),0) + 1 FROM \"{0}\".\"{1}\"),false) FROM pg_get_serial_sequence('\"{0}\".\"{1}\"','ogc_fid') s WHERE s IS NOT NULL".format(schema,self.name))
+
+        self.foreign_table.create_hash_views(inserted_hashes)
+        try:
+            return self.invoke(cursor,schema,job_id,vrt=self._hash_vrt("{0}_delta".format(self.foreign_table.name)),append=True)
+        finally:
+            self.foreign_table.drop_hash_views()
+
+    _staging_relations_sql = (
+        "SELECT c.relname, c.relkind FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE i.indrelid = '\"{0}\".\"{1}\"'::regclass "
+        "UNION ALL "
+        "SELECT c.relname, c.relkind FROM pg_class c JOIN pg_depend d ON d.objid = c.oid WHERE c.relkind = 'S' AND d.deptype = 'a' AND d.refobjid = '\"{0}\".\"{1}\"'::regclass"
+    )
+
+    def _staging_invoke(self,cursor,schema,job_id):
+        """
+        Import the data source into a staging table, populate the rowid there,
+        and then replace the input table with the staging table in one short transaction;
+        the readers never see a missing or partially imported input table.
+        If IMPORT_STAGING_UNLOGGED is True, the staging table is unlogged and swapped in as it is,
+        making it logged would write the whole table into WAL again.
+        An unlogged table is emptied by postgres after a crash, so is_up_to_date reimports an emptied unlogged input table.
+        The rowid is populated by _populate_rowid which recreates the staging table with the same persistence.
+
+        Return True if import successfully; False if import process is terminated.
+        """
+        name = self.name
+        staging_name = "{0}__staging".format(name)
+        unlogged = BorgConfiguration.IMPORT_STAGING_UNLOGGED
+        swapped = False
+        try:
+            self.name = staging_name
+            try:
+                if not self.invoke(cursor,schema,job_id,unlogged=unlogged):
+                    return False
+                self._populate_rowid(cursor,schema)
+            finally:
+                self.name = name
+
+            #rename the indexes and sequences to the names used by the input table
+            sql_result = cursor.execute(self._staging_relations_sql.format(schema,staging_name))
+            relations = [(row[0],row[1]) for row in (sql_result.fetchall() if sql_result else cursor.fetchall())]
+            sql = "DROP TABLE IF EXISTS \"{0}\".\"{1}\" CASCADE;ALTER TABLE \"{0}\".\"{2}\" RENAME TO \"{1}\";".format(schema,name,staging_name)
+            for relname,relkind in relations:
+                if relname.startswith(staging_name):
+                    sql += "ALTER {0} \"{1}\".\"{2}\" RENAME TO \"{3}\";".format("SEQUENCE" if relkind == "S" else "INDEX",schema,relname,name + relname[len(staging_name):])
+            cursor.execute(sql)
+            swapped = True
+            self._rowid_populated = self.generate_rowid
+            if unlogged:
+                #an empty table can't be told from a table emptied by a crash
+                sql_result = cursor.execute("SELECT c.relpersistence = 'u' AND EXISTS (SELECT 1 FROM \"{0}\".\"{1}\") FROM pg_class c WHERE c.oid = '\"{0}\".\"{1}\"'::regclass".format(schema,name))
+                self._unlogged = (sql_result.fetchone() if sql_result else cursor.fetchone())[0]
+            return True
+        finally:
+            if not swapped:
+                cursor.execute("DROP TABLE IF EXISTS \"{0}\".\"{1}\" CASCADE;".format(schema,staging_name))
+
     @in_schema(BorgConfiguration.INPUT_SCHEMA)
     def execute(self,job_id ,cursor,schema):
         begin_time = timezone.now()
-        if self.invoke(cursor,schema,job_id):
+        self._fingerprint = None
+        #get the change signature before importing, the changes made during importing will be detected next time
+        change_signature = self.foreign_table.change_signature() if self.foreign_table else None
+        self._rowid_populated = False
+        self._unlogged = False
+        if self.incremental_import and self.foreign_table:
+            imported = self._incremental_invoke(cursor,schema,job_id)
+        elif BorgConfiguration.IMPORT_STAGING:
+            imported = self._staging_invoke(cursor,schema,job_id)
+        else:
+            imported = self.invoke(cursor,schema,job_id)
+        if imported:
             # all data is imported
             self.job_run_time = begin_time
             #save the latest data source information to table
-            self._post_execute(cursor)
+            self._post_execute(cursor,change_signature)
         else:
             #import process is cancelled
             from harvest.jobstates import JobStateOutcome
@@ -1190,6 +1752,9 @@ class Input(JobFields,SpatialTableMixin):
     class Meta:
         ordering = ['data_source','name']
 
+if BorgConfiguration.ROWID_HASH not in Input._rowid_hash_expressions:
+    raise ImproperlyConfigured("ROWID_HASH should be one of {0}".format(", ".join(sorted(Input._rowid_hash_expressions.keys()))))
+
 class InputEventListener(object):
     @staticmethod
     @receiver(pre_delete, sender=Input)
@@ -1380,6 +1945,12 @@ class Normalise(Transform):
         """
         return  a sorted normalises including self and dependent normalises based on dependency relationship
         """
+        if self.pk and not self.editing_mode:
+            #the relationship is not being edited, use the cached dependency graph
+            if not hasattr(self,"_normalises_cache"):
+                normalises = DependencyGraph.load_normalises(DependencyGraph.get().normalises_of_normalise(self.pk))
+                self._normalises_cache = [self if n.pk == self.pk else n for n in normalises]
+            return self._normalises_cache
         return self._normalises()
 
     def _normalises(self,parents=None):
@@ -1884,7 +2455,6 @@ class Workspace(BorgModel):
 
     def publish(self):
         try_set_push_owner("workspace")
-        hg = None
         try:
             json_files = []
             if self.publish_channel.sync_postgres_data:
@@ -1930,15 +2500,11 @@ class Workspace(BorgModel):
                     json_files.append(access_rule_json_file)
 
             if json_files:
-                hg = hglib.open(BorgConfiguration.BORG_STATE_REPOSITORY)
-                hg.commit(include=json_files,addremove=True, user=BorgConfiguration.BORG_STATE_USER, message="Update workspace {}".format(self.name))
+                StateRepository.instance().submit(json_files,"Update workspace {}".format(self.name))
 
-                increase_committed_changes()
-
-                try_push_to_repository('workspace',hg)
+                try_push_to_repository('workspace')
 
         finally:
-            if hg: hg.close()
             try_clear_push_owner("workspace")
 
     def delete(self,using=None):
@@ -2013,6 +2579,7 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
     create_table_sql = SQLField(null=True, editable=False)
     geoserver_setting = models.TextField(blank=True,null=True,editable=False)
     pending_actions = models.IntegerField(blank=True,null=True,editable=False)
+    meta_fingerprint = models.CharField(max_length=32,null=True,editable=False)
 
     relation_1 = models.OneToOneField('Publish_NormalTable',blank=True,null=True,related_name="publish_1",editable=False)
     relation_2 = models.OneToOneField('Publish_NormalTable',blank=True,null=True,related_name="publish_2",editable=False)
@@ -2084,6 +2651,10 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
         """
         the sorted related normalises
         """
+        if not hasattr(self,"_normalises_cache") and self.pk and not self.editing_mode:
+            #the relationship is not being edited, use the cached dependency graph
+            self._normalises_cache = DependencyGraph.load_normalises(DependencyGraph.get().normalises_of_publish(self.pk))
+
         if not hasattr(self,"_normalises_cache"):
             normalises = []
             for relation in self.relations:
@@ -2134,8 +2705,29 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
         drop related tables and transform functions
         """
         cursor.execute("DROP TABLE IF EXISTS \"{0}\".\"{1}\" CASCADE;".format(publish_schema,self.table_name))
+        cursor.execute("DROP TABLE IF EXISTS \"{0}\".\"{1}_diff\" CASCADE;".format(publish_schema,self.table_name))
         super(Publish,self).drop(cursor,transform_schema)
 
+    _table_columns_sql = "SELECT a.attname, format_type(a.atttypid,a.atttypmod) FROM pg_attribute a JOIN pg_class b ON a.attrelid = b.oid JOIN pg_namespace c ON b.relnamespace = c.oid WHERE a.attnum > 0 AND NOT a.attisdropped AND b.relname='{1}' AND c.nspname='{0}' ORDER BY a.attnum"
+
+    def _table_columns(self,cursor,schema,table):
+        sql_result = cursor.execute(self._table_columns_sql.format(schema,table))
+        return [(row[0],row[1]) for row in (sql_result.fetchall() if sql_result else cursor.fetchall())]
+
+    def _diff_publish_sql(self,publish_view_schema,publish_schema):
+        """
+        Return the sql to apply the changes between the publish view and the publish table in one transaction,
+        the deleted and inserted row hashes are recorded in the diff table "<table_name>_diff".
+        """
+        return (
+            "CREATE TEMP TABLE \"__publish_{0}\" ON COMMIT DROP AS SELECT * FROM \"{1}\".\"{0}\";\n"
+            "CREATE TABLE IF NOT EXISTS \"{2}\".\"{0}_diff\" (difftime TIMESTAMP WITH TIME ZONE PRIMARY KEY, deletes VARCHAR(32)[], inserts VARCHAR(32)[]);\n"
+            "WITH del AS (DELETE FROM \"{2}\".\"{0}\" t WHERE NOT EXISTS (SELECT 1 FROM \"__publish_{0}\" s WHERE s.md5_rowhash = t.md5_rowhash) RETURNING t.md5_rowhash),\n"
+            "ins AS (INSERT INTO \"{2}\".\"{0}\" SELECT s.* FROM \"__publish_{0}\" s WHERE NOT EXISTS (SELECT 1 FROM \"{2}\".\"{0}\" t WHERE t.md5_rowhash = s.md5_rowhash) RETURNING md5_rowhash)\n"
+            "INSERT INTO \"{2}\".\"{0}_diff\" SELECT now(), (SELECT array_agg(md5_rowhash) FROM del), (SELECT array_agg(md5_rowhash) FROM ins);\n"
+            "DELETE FROM \"{2}\".\"{0}_diff\" WHERE difftime NOT IN (SELECT difftime FROM \"{2}\".\"{0}_diff\" ORDER BY difftime DESC LIMIT {3});"
+            ).format(self.table_name,publish_view_schema,publish_schema,BorgConfiguration.PUBLISH_DIFF_HISTORY)
+
     def invoke(self, cursor,trans_schema,normal_schema,publish_view_schema,publish_schema):
         """
         invoke the function to populate the table data in speicifed schema
@@ -2148,6 +2740,26 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
 
         sql = "CREATE OR REPLACE VIEW \"{3}\".\"{0}\" AS SELECT *, md5(CAST(row.* AS text)) as md5_rowhash FROM \"{2}\".\"{1}\"() as row;".format(self.table_name,self.func_name,trans_schema,publish_view_schema)
         cursor.execute(sql)
+
+        publish_action = self.publish_action
+        if BorgConfiguration.DIFF_PUBLISH and not publish_action.publish_all and not publish_action.publish_data:
+            #only the data is changed, the publish definition (sql, relations, extra indexes) is not changed since last publish
+            table_columns = self._table_columns(cursor,publish_schema,self.table_name)
+            if table_columns and table_columns == self._table_columns(cursor,publish_view_schema,self.table_name):
+                #the publish table has the same structure as the publish view, only apply the changes
+                cursor.execute(self._diff_publish_sql(publish_view_schema,publish_schema))
+                #the indexes are kept, only refresh the spatial info
+                if BorgConfiguration.BBOX_MODE == "incremental" and self.spatial_info:
+                    #extend the previous bbox with the extent of the inserted rows
+                    self.extend_spatial_info(publish_schema,"md5_rowhash = ANY(CAST((SELECT inserts FROM \"{0}\".\"{1}_diff\" ORDER BY difftime DESC LIMIT 1) AS text[]))".format(publish_schema,self.table_name))
+                else:
+                    self.refresh_spatial_info(publish_schema)
+                return
+
+        if BorgConfiguration.DIFF_PUBLISH:
+            #the structure or the definition is changed, the previous diffs are meaningless
+            cursor.execute("DROP TABLE IF EXISTS \"{0}\".\"{1}_diff\";".format(publish_schema,self.table_name))
+
         sql = (
             "DROP TABLE IF EXISTS \"{4}\".\"{0}\" CASCADE;\n"
             #"CREATE TABLE IF NOT EXISTS \"{4}\".\"{0}\" (LIKE \"{3}\".\"{0}\",\n"
@@ -2301,9 +2913,7 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
         shutil.copyfile(published_meta_file,meta_file)
 
         #remove it from catalogue service
-        res = requests.delete("{}/catalogue/api/records/{}:{}/".format(settings.CSW_URL,self.workspace.name,self.table_name),auth=(settings.CSW_USER,settings.CSW_PASSWORD))
-        if res.status_code != 404:
-            res.raise_for_status()
+        CatalogueClient.instance().delete_record(self.workspace.name,self.table_name)
 
         json_out["action"] = 'remove'
         json_out["remove_time"] = timezone.localtime(timezone.now()).strftime("%Y-%m-%d %H:%M:%S.%f")
@@ -2314,23 +2924,19 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
             json.dump(json_out, output, indent=4)
 
         try_set_push_owner("unpublish")
-        hg = None
         try:
-            hg = hglib.open(BorgConfiguration.BORG_STATE_REPOSITORY)
-
             #get all possible files
             files =[self.output_filename_abs(action) for action in ['meta','empty_gwc'] ]
             #get all existing files.
             files =[ f for f in files if os.path.exists(f)]
-            if files:
-                hg.remove(files=files)
-            files.append(json_file)
-            hg.commit(include=files,addremove=True, user=BorgConfiguration.BORG_STATE_USER, message="Removed {}.{}".format(self.workspace.name, self.name))
-            increase_committed_changes()
+            StateRepository.instance().submit([json_file],"Removed {}.{}".format(self.workspace.name, self.name),remove_files=files)
+
+            try_push_to_repository("unpublish")
 
-            try_push_to_repository("unpublish",hg)
+            if self.meta_fingerprint:
+                self.meta_fingerprint = None
+                self.save(update_fields=['meta_fingerprint'])
         finally:
-            if hg: hg.close()
             try_clear_push_owner("unpublish")
 
     @switch_searchpath(searchpath=BorgConfiguration.BORG_SCHEMA)
@@ -2357,26 +2963,45 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
         self.job_run_time = begin_time
         self._post_execute(cursor)
 
-    def publish_meta_data(self):
+    def check_publish_meta_data(self):
+        """
+        raise ValidationError if the meta data can't be published alone
+        """
         if self.publish_status != ResourceStatus.Enabled:
             raise ValidationError("The publish({0}) is disabled".format(self.name))
 
         if not self.workspace.publish_channel.sync_geoserver_data:
             raise ValidationError("The publish channel({1}) of publish({0}) does not support geoserver.".format(self.name,self.workspace.publish_channel.name))
         
+        if self.publish_action.publish_all:
+            raise ValidationError("Publish({0}) requires a full publish including data and metadata".format(self.name))
+
+    def publish_meta_data(self,catalogue_record=None,changed=None):
+        """
+        catalogue_record: the record already uploaded to catalogue service, if not None
+        changed: whether the meta data is changed since last publish; checked by the meta data fingerprint if None
+        Return False if the meta data is not changed and not published; otherwise return True
+        """
+        self.check_publish_meta_data()
         publish_action = self.publish_action
 
-        if publish_action.publish_all:
-            raise ValidationError("Publish({0}) requires a full publish including data and metadata".format(self.name))
+        if changed is None:
+            changed = catalogue_record is not None or self.is_meta_data_changed
+        if not changed:
+            #meta data is not changed, only clear the pending actions
+            actions = publish_action.clear_feature_action().clear_gwc_action().actions
+            if self.pending_actions != actions:
+                self.pending_actions = actions
+                self.save(update_fields=['pending_actions'])
+            return False
 
         try_set_push_owner("publish")
-        hg = None
         try:
             if self.workspace.workspace_as_schema:
                 style_file_folder = os.path.join(BorgConfiguration.STYLE_FILE_DUMP_DIR,self.workspace.publish_channel.name, self.workspace.name)
             else:
                 style_file_folder = os.path.join(BorgConfiguration.STYLE_FILE_DUMP_DIR,self.workspace.publish_channel.name)
-            meta_data = self.update_catalogue_service(style_dump_dir=style_file_folder,md5=True,extra_datas={"publication_date":datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")})
+            meta_data = self.update_catalogue_service(style_dump_dir=style_file_folder,md5=True,extra_datas={"publication_date":datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")},catalogue_record=catalogue_record)
 
             #write meta data file
             file_name = "{}.meta.json".format(self.table_name)
@@ -2397,21 +3022,21 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
             with open(json_file, "wb") as output:
                 json.dump(json_out, output, indent=4)
 
-            hg = hglib.open(BorgConfiguration.BORG_STATE_REPOSITORY)
-            hg.commit(include=[json_file],addremove=True, user=BorgConfiguration.BORG_STATE_USER, message="Update feature's meta data {}.{}".format(self.workspace.name, self.name))
+            StateRepository.instance().submit([json_file],"Update feature's meta data {}.{}".format(self.workspace.name, self.name))
 
-            increase_committed_changes()
-
-            try_push_to_repository('publish',hg)
+            try_push_to_repository('publish')
 
             actions = publish_action.clear_feature_action().clear_gwc_action().actions
             if self.pending_actions != actions:
                 self.pending_actions = actions
                 self.save(update_fields=['pending_actions'])
+
+            self.save_meta_fingerprint()
         finally:
-            if hg: hg.close()
             try_clear_push_owner("publish")
 
+        return True
+
     def empty_gwc(self):
         """
         Empty gwc to the repository
@@ -2433,7 +3058,6 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
 
         json_file = self.output_filename_abs('empty_gwc');
         try_set_push_owner("publish")
-        hg = None
         try:
             json_out = {}
             json_out["name"] = self.table_name
@@ -2449,13 +3073,10 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
             with open(json_file, "wb") as output:
                 json.dump(json_out, output, indent=4)
         
-            hg = hglib.open(BorgConfiguration.BORG_STATE_REPOSITORY)
-            hg.commit(include=[json_file],addremove=True, user="borgcollector", message="Empty GWC of publish {}.{}".format(self.workspace.name, self.name))
-            increase_committed_changes()
+            StateRepository.instance().submit([json_file],"Empty GWC of publish {}.{}".format(self.workspace.name, self.name))
                 
-            try_push_to_repository("publish",hg)
+            try_push_to_repository("publish")
         finally:
-            if hg: hg.close()
             try_clear_push_owner("publish")
 
     @property
@@ -2512,21 +3133,7 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
         meta_data["title"] = self.title
         meta_data["abstract"] = self.abstract
 
-        modify_time = None
-        if self.input_table:
-            for ds in self.input_table.datasource:
-                if os.path.exists(ds):
-                    input_modify_time = datetime.utcfromtimestamp(os.path.getmtime(ds)).replace(tzinfo=pytz.UTC)
-                    if modify_time:
-                        if modify_time < input_modify_time:
-                            modify_time = input_modify_time
-                    else:
-                        modify_time = input_modify_time
-                else:
-                    modify_time = self.last_modify_time
-        else:
-            modify_time = self.last_modify_time
-        meta_data["modified"] = modify_time.astimezone(timezone.get_default_timezone()).strftime("%Y-%m-%d %H:%M:%S.%f") if modify_time else None
+        meta_data["modified"] = self._metadata_modified
 
         #bbox
         if self.is_spatial:
@@ -2560,19 +3167,123 @@ class Publish(Transform,ResourceStatusMixin,SpatialTableMixin):
 
         return meta_data
 
-    def update_catalogue_service(self,style_dump_dir=None,md5=False,extra_datas=None):
+    @property
+    def _metadata_modified(self):
+        modify_time = None
+        if self.input_table:
+            for ds in self.input_table.datasource:
+                if os.path.exists(ds):
+                    input_modify_time = datetime.utcfromtimestamp(os.path.getmtime(ds)).replace(tzinfo=pytz.UTC)
+                    if modify_time:
+                        if modify_time < input_modify_time:
+                            modify_time = input_modify_time
+                    else:
+                        modify_time = input_modify_time
+                else:
+                    modify_time = self.last_modify_time
+        else:
+            modify_time = self.last_modify_time
+        return modify_time.astimezone(timezone.get_default_timezone()).strftime("%Y-%m-%d %H:%M:%S.%f") if modify_time else None
+
+    def catalogue_metadata(self,extra_datas=None):
+        """
+        return the meta data uploaded to catalogue service
+        """
         meta_data = self.builtin_metadata
         if extra_datas:
             meta_data.update(extra_datas)
+        return meta_data
+
+    def compute_meta_fingerprint(self,catalogue_record=None):
+        """
+        Return the fingerprint of the meta data, which is computed from the inputs of the meta data
+        and the record in catalogue service, the record maybe changed in catalogue service directly.
+        catalogue_record: the record returned by catalogue service if already retrieved or uploaded; retrieved from catalogue service if None
+        Return None if the record does not exist in catalogue service.
+        """
+        channel = self.workspace.publish_channel
+        inputs = {
+            "workspace":self.workspace.name,
+            "name":self.table_name,
+            "title":self.title,
+            "abstract":self.abstract,
+            "modified":self._metadata_modified,
+            "bounding_box":self.bbox if self.is_spatial else None,
+            "crs":self.crs if self.is_spatial else None,
+            "geoserver_setting":self.geoserver_setting,
+            "channel":[channel.name,channel.sync_geoserver_data,channel.wfs_version,channel.wfs_endpoint,channel.wms_version,channel.wms_endpoint,channel.gwc_endpoint],
+            "auth_level":self.workspace.auth_level,
+            "styles":[],
+        }
+        record = ""
+        if channel.sync_geoserver_data:
+            for style_format in ["sld","qml","lyr"]:
+                f = self.builtin_style_file(style_format)
+                if f:
+                    inputs["styles"].append([style_format,file_md5(f)])
+            record = catalogue_record
+            if record is None:
+                record = CatalogueClient.instance().get_record(self.workspace.name,self.table_name,style_content=True)
+            if record is None:
+                return None
+            record = json.dumps(record,sort_keys=True)
+
+        md5 = hashlib.md5()
+        md5.update(json.dumps(inputs,sort_keys=True))
+        md5.update(record)
+        return md5.hexdigest()
+
+    @property
+    def is_meta_data_changed(self):
+        """
+        Return True if the meta data is changed since last publish
+        """
+        return self.check_meta_data_changed()
+
+    def check_meta_data_changed(self,catalogue_record=None):
+        """
+        Return True if the meta data is changed since last publish
+        catalogue_record: the record already retrieved from catalogue service; can be a exception if failed to retrieve it
+        """
+        if not self.meta_fingerprint or isinstance(catalogue_record,Exception):
+            return True
+        try:
+            return self.compute_meta_fingerprint(catalogue_record) != self.meta_fingerprint
+        except:
+            logger.warning("Failed to compute the meta data fingerprint of publish({0})".format(self.name),exc_info=True)
+            return True
+
+    def save_meta_fingerprint(self,catalogue_record=None):
+        """
+        save the fingerprint of the published meta data
+        catalogue_record: the record returned by catalogue service when uploading; the record uploaded by update_catalogue_service is used if None
+        """
+        try:
+            self.meta_fingerprint = self.compute_meta_fingerprint(catalogue_record or getattr(self,"_uploaded_catalogue_record",None))
+        except:
+            logger.warning("Failed to compute the meta data fingerprint of publish({0})".format(self.name),exc_info=True)
+            self.meta_fingerprint = None
+        self.save(update_fields=['meta_fingerprint'])
+
+    def update_catalogue_service(self,style_dump_dir=None,md5=False,extra_datas=None,catalogue_record=None):
+        """
+        catalogue_record: the record already uploaded to catalogue service;
+            can be a AsyncResult returned by CatalogueClient.update_record_async
+        """
+        meta_data = self.catalogue_metadata(extra_datas)
         bbox = meta_data.get("bounding_box",None)
         crs = meta_data.get("crs",None)
         #update catalog service
         if self.workspace.publish_channel.sync_geoserver_data:
-            res = requests.post("{}/catalogue/api/records/?style_content=true".format(settings.CSW_URL),json=meta_data,auth=(settings.CSW_USER,settings.CSW_PASSWORD))
-            if 400 <= res.status_code < 600 and res.content:
-                res.reason = "{}({})".format(res.reason,res.content)
-            res.raise_for_status()
-            meta_data = res.json()
+            if catalogue_record is None:
+                meta_data = CatalogueClient.instance().update_record(meta_data,style_content=True)
+            elif isinstance(catalogue_record,AsyncResult):
+                #uploaded in background
+                meta_data = catalogue_record.get(BorgConfiguration.CSW_TIMEOUT * (BorgConfiguration.CSW_RETRIES + 1))
+            else:
+                meta_data = catalogue_record
+            #keep the uploaded record to compute the meta data fingerprint, meta_data is changed below
+            self._uploaded_catalogue_record = copy.deepcopy(meta_data)
             #process styles
             styles = meta_data.get("styles",[])
             #filter out qml and lyr styles
@@ -2820,3 +3531,184 @@ class Publish_NormalTable(BorgModel):
             return self.publish.name if self.publish else ""
 
 
+class DependencyGraph(object):
+    """
+    The process wide cache of the dependency relationship among publishs, normalises, normal tables and inputs.
+
+    The graph only keeps the ids, and is loaded by a few bulk queries.
+    It is invalidated by the post save and post delete signals of the related models in this process;
+    the changes made by other processes are detected by a signature query of the relationship columns,
+    which is executed at most once every DEPENDENCY_GRAPH_CHECK_INTERVAL seconds.
+    """
+    _lock = threading.Lock()
+    _graph = None
+    _checked = None
+
+    def __init__(self,signature):
+        self.signature = signature
+        self.normalise_names = {}
+        self.normalise_inputs = {}
+        self.normalise_relations = {}
+        self.normal_table_names = {}
+        self.normal_table_normalises = {}
+        self.normalise_normal_tables = {}
+        self.publish_inputs = {}
+        self.publish_relations = {}
+        self.publish_normal_tables = {}
+        self._normalises_cache = {}
+        self._publish_normalises_cache = {}
+
+        for row in Normalise.objects.values_list("id","name","input_table_id","relation_1_id","relation_2_id","relation_3_id"):
+            self.normalise_names[row[0]] = row[1]
+            self.normalise_inputs[row[0]] = row[2]
+            self.normalise_relations[row[0]] = row[3:]
+        for row in NormalTable.objects.values_list("id","name","normalise_id"):
+            self.normal_table_names[row[0]] = row[1]
+            self.normal_table_normalises[row[0]] = row[2]
+        for row in Normalise_NormalTable.objects.values_list("id","normal_table_1_id","normal_table_2_id","normal_table_3_id","normal_table_4_id"):
+            self.normalise_normal_tables[row[0]] = row[1:]
+        for row in Publish.objects.values_list("id","input_table_id","relation_1_id","relation_2_id","relation_3_id"):
+            self.publish_inputs[row[0]] = row[1]
+            self.publish_relations[row[0]] = row[2:]
+        for row in Publish_NormalTable.objects.values_list("id","normal_table_1_id","normal_table_2_id","normal_table_3_id","normal_table_4_id"):
+            self.publish_normal_tables[row[0]] = row[1:]
+
+    @staticmethod
+    def _signature_sql():
+        sql = "SELECT md5(concat_ws('|'"
+        for model,columns in (
+            (Normalise,"id,input_table_id,relation_1_id,relation_2_id,relation_3_id"),
+            (NormalTable,"id,normalise_id"),
+            (Normalise_NormalTable,"id,normal_table_1_id,normal_table_2_id,normal_table_3_id,normal_table_4_id"),
+            (Publish,"id,input_table_id,relation_1_id,relation_2_id,relation_3_id"),
+            (Publish_NormalTable,"id,normal_table_1_id,normal_table_2_id,normal_table_3_id,normal_table_4_id")):
+            sql += ",(SELECT string_agg(CAST(ROW({1}) AS text),';' ORDER BY id) FROM \"{0}\")".format(model._meta.db_table,columns)
+        return sql + "));"
+
+    @classmethod
+    def get(cls):
+        """
+        return the up to date dependency graph
+        """
+        with cls._lock:
+            now = time.time()
+            if cls._graph and cls._checked and now - cls._checked < BorgConfiguration.DEPENDENCY_GRAPH_CHECK_INTERVAL:
+                return cls._graph
+
+            cursor = connection.cursor()
+            try:
+                cursor.execute(cls._signature_sql())
+                signature = cursor.fetchone()[0]
+            finally:
+                close_cursor(cursor)
+
+            if not cls._graph or cls._graph.signature != signature:
+                cls._graph = DependencyGraph(signature)
+            cls._checked = now
+            return cls._graph
+
+    @classmethod
+    def invalidate(cls):
+        with cls._lock:
+            cls._graph = None
+            cls._checked = None
+
+    def _normal_table_normalise(self,normal_table_id):
+        normalise_id = self.normal_table_normalises.get(normal_table_id)
+        if not normalise_id or normalise_id not in self.normalise_names:
+            raise ValidationError("NormalTable({0}) does not connect to a normalise function.".format(self.normal_table_names.get(normal_table_id)))
+        return normalise_id
+
+    def normalises_of_normalise(self,normalise_id,parents=None):
+        """
+        return the sorted ids of the normalise and its dependent normalises, same as Normalise.normalises
+        """
+        if normalise_id in self._normalises_cache:
+            return self._normalises_cache[normalise_id]
+
+        normalises = [normalise_id]
+        parents = (parents or []) + [normalise_id]
+        for relation_id in self.normalise_relations.get(normalise_id) or []:
+            for normal_table_id in self.normalise_normal_tables.get(relation_id) or []:
+                if not normal_table_id:
+                    continue
+                dependent_id = self._normal_table_normalise(normal_table_id)
+                if dependent_id in parents:
+                    raise ValidationError("Found a circular dependency:{0}".format("=>".join([self.normalise_names[n] for n in parents + [dependent_id]])))
+                for n in self.normalises_of_normalise(dependent_id,parents):
+                    if n not in normalises:
+                        normalises.append(n)
+
+        self._normalises_cache[normalise_id] = list(reversed(normalises))
+        return self._normalises_cache[normalise_id]
+
+    def normalises_of_publish(self,publish_id):
+        """
+        return the sorted ids of the normalises of the publish, same as Publish.normalises
+        """
+        if publish_id in self._publish_normalises_cache:
+            return self._publish_normalises_cache[publish_id]
+
+        normalises = []
+        for relation_id in self.publish_relations.get(publish_id) or []:
+            for normal_table_id in self.publish_normal_tables.get(relation_id) or []:
+                if not normal_table_id:
+                    continue
+                for n in self.normalises_of_normalise(self._normal_table_normalise(normal_table_id)):
+                    if n not in normalises:
+                        normalises.append(n)
+
+        self._publish_normalises_cache[publish_id] = normalises
+        return normalises
+
+    def inputs(self,normalise_ids,input_id=None):
+        """
+        return the ids of the inputs used by the normalises; input_id is the first input if not None
+        """
+        inputs = [input_id] if input_id else []
+        for n in normalise_ids:
+            if self.normalise_inputs[n] not in inputs:
+                inputs.append(self.normalise_inputs[n])
+        return inputs
+
+    @staticmethod
+    def load_normalises(normalise_ids):
+        """
+        load the normalises with their input tables in one query
+        """
+        normalises = Normalise.objects.select_related("input_table").in_bulk(normalise_ids)
+        return [normalises[n] for n in normalise_ids]
+
+class DependencyGraphEventListener(object):
+    _relationship_fields = set(["input_table","relation_1","relation_2","relation_3","normalise"])
+
+    @staticmethod
+    def _invalidate(update_fields):
+        if update_fields is not None and not (set(update_fields) & DependencyGraphEventListener._relationship_fields):
+            return
+        DependencyGraph.invalidate()
+
+    @staticmethod
+    @receiver([post_save,post_delete], sender=Normalise)
+    def _normalise_changed(sender, instance, **args):
+        DependencyGraphEventListener._invalidate(args.get("update_fields"))
+
+    @staticmethod
+    @receiver([post_save,post_delete], sender=NormalTable)
+    def _normal_table_changed(sender, instance, **args):
+        DependencyGraphEventListener._invalidate(args.get("update_fields"))
+
+    @staticmethod
+    @receiver([post_save,post_delete], sender=Normalise_NormalTable)
+    def _normalise_normal_table_changed(sender, instance, **args):
+        DependencyGraph.invalidate()
+
+    @staticmethod
+    @receiver([post_save,post_delete], sender=Publish)
+    def _publish_changed(sender, instance, **args):
+        DependencyGraphEventListener._invalidate(args.get("update_fields"))
+
+    @staticmethod
+    @receiver([post_save,post_delete], sender=Publish_NormalTable)
+    def _publish_normal_table_changed(sender, instance, **args):
+        DependencyGraph.invalidate()
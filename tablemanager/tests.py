@@ -1,3 +1,115 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
+from django.core.exceptions import ValidationError
+from django.conf import settings
 
-# Create your tests here.
+from sqlalchemy import create_engine
+
+from tablemanager.models import ForeignTable,DependencyGraph
+
+class ForeignTableHashViewsTest(SimpleTestCase):
+    """
+    create_hash_views runs on the sqlalchemy connection of FDW_URL;
+    a plain table is used as the foreign table, the hash views don't depend on the table type.
+    """
+    name = "test_borg_hash_views"
+
+    def setUp(self):
+        self.engine = create_engine(settings.FDW_URL)
+        self.foreign_table = ForeignTable(name=self.name)
+        self.engine.execute("DROP TABLE IF EXISTS public.\"{0}\" CASCADE".format(self.name))
+        self.engine.execute("CREATE TABLE public.\"{0}\" (id integer, name text)".format(self.name))
+        #two identical rows
+        self.engine.execute("INSERT INTO public.\"{0}\" VALUES (1,'a'),(2,'b'),(2,'b'),(3,'c')".format(self.name))
+
+    def tearDown(self):
+        self.foreign_table.drop_hash_views()
+        self.engine.execute("DROP TABLE IF EXISTS public.\"{0}\" CASCADE".format(self.name))
+        self.engine.dispose()
+
+    def _delta_rows(self,hashes):
+        self.foreign_table.create_hash_views(hashes)
+        return self.engine.execute("SELECT id FROM public.\"{0}_delta\" ORDER BY id".format(self.name)).fetchall()
+
+    def test_row_hashes(self):
+        hashes = self.foreign_table.row_hashes(None)
+        self.assertEqual(len(hashes),3)
+        self.assertEqual(sorted(hashes.values()),[1,1,2])
+
+    def test_no_hash(self):
+        self.assertEqual(self._delta_rows(set()),[])
+
+    def test_one_hash(self):
+        hashes = self.foreign_table.row_hashes(None)
+        h = [k for k,v in hashes.items() if v == 1][0]
+        self.assertEqual(len(self._delta_rows(set([h]))),1)
+
+    def test_many_hashes(self):
+        hashes = self.foreign_table.row_hashes(None)
+        #all the identical rows are returned
+        self.assertEqual([r[0] for r in self._delta_rows(set(hashes))],[1,2,2,3])
+
+    def test_drop_hash_views(self):
+        self._delta_rows(set(self.foreign_table.row_hashes(None)))
+        self.foreign_table.drop_hash_views()
+        self.assertEqual(self.engine.execute("SELECT count(*) FROM pg_class WHERE relname in ('{0}_hashed','{0}_delta','{0}_delta_keys')".format(self.name)).fetchone()[0],0)
+
+class DependencyGraphTest(SimpleTestCase):
+    """
+    the dependency graph is built from hand-made id dicts instead of the database.
+    normalise 1 uses the normal tables of normalise 2 and 3, normalise 2 uses the normal table of normalise 3;
+    normal table 10x is populated by normalise x; relation 20x is the relation of normalise x.
+    """
+    def _graph(self,normalise_relations,normal_table_normalises,normalise_normal_tables,publish_relations=None,publish_normal_tables=None):
+        graph = DependencyGraph.__new__(DependencyGraph)
+        graph.signature = None
+        graph.normalise_names = dict([(n,"normalise{0}".format(n)) for n in normalise_relations])
+        graph.normalise_inputs = dict([(n,n * 1000) for n in normalise_relations])
+        graph.normalise_relations = normalise_relations
+        graph.normal_table_names = dict([(t,"normal_table{0}".format(t)) for t in normal_table_normalises])
+        graph.normal_table_normalises = normal_table_normalises
+        graph.normalise_normal_tables = normalise_normal_tables
+        graph.publish_inputs = {}
+        graph.publish_relations = publish_relations or {}
+        graph.publish_normal_tables = publish_normal_tables or {}
+        graph._normalises_cache = {}
+        graph._publish_normalises_cache = {}
+        return graph
+
+    def test_no_dependency(self):
+        graph = self._graph({1:(None,None,None)},{},{})
+        self.assertEqual(graph.normalises_of_normalise(1),[1])
+
+    def test_dependent_normalises_first(self):
+        graph = self._graph({1:(201,None,None),2:(None,None,None),3:(None,None,None)},{102:2,103:3},{201:(102,103,None,None)})
+        normalises = graph.normalises_of_normalise(1)
+        self.assertEqual(sorted(normalises),[1,2,3])
+        self.assertEqual(normalises[-1],1)
+
+    def test_shared_dependency_included_once(self):
+        graph = self._graph({1:(201,None,None),2:(202,None,None),3:(None,None,None)},{102:2,103:3},{201:(102,103,None,None),202:(103,None,None,None)})
+        normalises = graph.normalises_of_normalise(1)
+        self.assertEqual(sorted(normalises),[1,2,3])
+        self.assertEqual(normalises[-1],1)
+        self.assertEqual(graph.inputs(normalises,1000),[1000] + [n * 1000 for n in normalises if n != 1])
+
+    def test_circular_dependency(self):
+        graph = self._graph({1:(201,None,None),2:(202,None,None)},{101:1,102:2},{201:(102,None,None,None),202:(101,None,None,None)})
+        with self.assertRaises(ValidationError) as cm:
+            graph.normalises_of_normalise(1)
+        self.assertIn("Found a circular dependency:normalise1=>normalise2=>normalise1",cm.exception.messages[0])
+
+    def test_normal_table_without_normalise(self):
+        graph = self._graph({1:(201,None,None)},{102:None},{201:(102,None,None,None)})
+        with self.assertRaises(ValidationError) as cm:
+            graph.normalises_of_normalise(1)
+        self.assertIn("NormalTable(normal_table102) does not connect to a normalise function.",cm.exception.messages[0])
+
+    def test_normalises_of_publish(self):
+        graph = self._graph({1:(201,None,None),2:(None,None,None),3:(None,None,None)},{101:1,102:2,103:3},{201:(102,None,None,None)},
+            publish_relations={1:(301,302,None)},publish_normal_tables={301:(101,None,None,None),302:(103,102,None,None)})
+        #the normalises of the publish's normal tables in order, each normalise after its dependent normalises and only once
+        self.assertEqual(graph.normalises_of_publish(1),[2,1,3])
+
+    def test_publish_without_relation(self):
+        graph = self._graph({},{},{},publish_relations={1:(None,None,None)})
+        self.assertEqual(graph.normalises_of_publish(1),[])
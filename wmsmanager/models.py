@@ -30,6 +30,7 @@ from borg_utils.transaction import TransactionMixin
 from borg_utils.signals import refresh_select_choices,inherit_support_receiver
 from borg_utils.resource_status import ResourceStatus,ResourceStatusMixin,ResourceAction
 from borg_utils.hg_batch_push import try_set_push_owner, try_clear_push_owner, increase_committed_changes, try_push_to_repository
+from borg_utils.catalogue import CatalogueClient
 
 logger = logging.getLogger(__name__)
 
@@ -485,11 +486,7 @@ class WmsLayer(models.Model,ResourceStatusMixin,TransactionMixin):
         bbox = meta_data.get("bounding_box",None)
         crs = meta_data.get("crs",None)
         #update catalog service
-        res = requests.post("{}/catalogue/api/records/".format(settings.CSW_URL),json=meta_data,auth=(settings.CSW_USER,settings.CSW_PASSWORD))
-        if 400 <= res.status_code < 600 and res.content:
-            res.reason = "{}({})".format(res.reason,res.content)
-        res.raise_for_status()
-        meta_data = res.json()
+        meta_data = CatalogueClient.instance().update_record(meta_data)
 
         #add extra data to meta data
         meta_data["workspace"] = self.server.workspace.name
@@ -547,9 +544,7 @@ class WmsLayer(models.Model,ResourceStatusMixin,TransactionMixin):
 
     def unpublish(self):
         #remove it from catalogue service
-        res = requests.delete("{}/catalogue/api/records/{}:{}/".format(settings.CSW_URL,self.server.workspace.name,self.kmi_name),auth=(settings.CSW_USER,settings.CSW_PASSWORD))
-        if res.status_code != 404:
-            res.raise_for_status()
+        CatalogueClient.instance().delete_record(self.server.workspace.name,self.kmi_name)
 
         json_filename = self.json_filename_abs('unpublish');
         try_set_push_owner("wmslayer")